@@ -27,12 +27,11 @@ class Backend(Backend.Backend):
         # Interpret special keys
         if 'map_center' in self.cfg and type(self.cfg['map_center']) is dict:
             if self.cfg['map_center']['area_file_conversion_type'] == 'area_center':
-                area = poly.Poly()
                 if 'OSMTRACKER_REGION' in os.environ:
                     area_file = os.environ['OSMTRACKER_REGION']
                 else:
                     area_file = self.cfg['map_center']['area_file']
-                area.load(area_file)
+                area = poly.get_poly(area_file)
                 c = area.center()
                 logger.debug("Loaded area polygon from '{}' with {} points, center {}".format(area_file, len(area), c))
                 self.cfg['map_center'] = '{},{}'.format(c[1], c[0])
@@ -5,7 +5,7 @@ import pprint
 import argparse
 import logging
 import pymongo
-from bson.json_util import dumps, loads
+from bson.json_util import dumps, loads, JSONOptions
 from bson.codec_options import CodecOptions
 import time
 import datetime, pytz
@@ -24,6 +24,7 @@ class DataBase(object):
     STATE_REANALYSING = 'REANALYSING'       # Updates (notes etc)
     STATE_DONE = 'DONE'                     # For now, all analysis completed
     STATE_QUARANTINED = 'QUARANTINED'       # Temporary error experienced
+    ELEMENT_TTL_S = 30*24*3600              # Lifetime of stored element versions
     
     def __init__(self, url='mongodb://localhost:27017/', admin=False, timeout=360):
         self.url = url
@@ -44,6 +45,8 @@ class DataBase(object):
         self.db = pymongo.database.Database(self.client, 'osmtracker', codec_options=CodecOptions(tz_aware=True))
         self.ctx = self.db.context
         self.csets = self.db.chgsets
+        self.decisions = self.db.filter_decisions
+        self.elements = self.db.elements
         self.all_states = [self.STATE_NEW, self.STATE_BOUNDS_CHECK, self.STATE_BOUNDS_CHECKED,
                            self.STATE_ANALYSING1, self.STATE_OPEN, self.STATE_CLOSED,
                            self.STATE_ANALYSING2, self.STATE_REANALYSING, self.STATE_DONE,
@@ -54,6 +57,9 @@ class DataBase(object):
             self.csets.create_index([('state', pymongo.ASCENDING),('state_changed', pymongo.DESCENDING)])
             self.csets.create_index([('state', pymongo.ASCENDING),('updated', pymongo.DESCENDING)])
             self.csets.create_index([('state', pymongo.ASCENDING),('refreshed', pymongo.DESCENDING)])
+            # Filter decisions are removed by the server when they expire
+            self.decisions.create_index('expires', expireAfterSeconds=0)
+            self.elements.create_index('stored', expireAfterSeconds=self.ELEMENT_TTL_S)
 
     def __str__(self):
         return self.url
@@ -66,6 +72,8 @@ class DataBase(object):
         if drop_chgsets:
             cnt = self.chgsets.delete_many({}).deleted_count
             logger.debug('Deleted {} changesets from work queue'.format(cnt))
+            cnt = self.decisions.delete_many({}).deleted_count
+            logger.debug('Deleted {} filter decisions'.format(cnt))
 
     def pointer_meta_update(self, _dict):
         self.ctx.pointer.update({u'_id':0}, {'$set': _dict}, upsert=True)
@@ -179,6 +187,51 @@ class DataBase(object):
         self.csets.replace_one({'_id':cid}, c, upsert=True)
         return c
 
+    def chgset_refresh(self, cid, source):
+        '''Update source of an already admitted changeset without changing its
+           state. Returns False if changeset is not in database'''
+        c = self.csets.update_one({'_id':cid}, {'$set': {u'source': source}})
+        return c.matched_count > 0
+
+    def filter_decision_get(self, cid):
+        '''Get unexpired filter decision for changeset'''
+        now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        return self.decisions.find_one({'_id': cid, 'expires': {'$gt': now}})
+
+    def filter_decision_set(self, cid, passed, bbox=None, ttl=3600):
+        '''Store filter decision for changeset. Decisions expire after ttl seconds'''
+        now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        d = {'_id': cid, u'cid': cid,
+             'passed': passed,
+             'bbox': bbox,
+             'decided': now,
+             'expires': now+datetime.timedelta(seconds=ttl)}
+        self.decisions.replace_one({'_id':cid}, d, upsert=True)
+        return d
+
+    def elements_get(self, etype, refs):
+        '''Get stored OSM element versions given as list of (id, version), see
+           osm.elemstore. Returns dict of elements keyed by (id, version)'''
+        ids = [u'{}/{}/{}'.format(etype, eid, version) for eid, version in refs]
+        elems = {}
+        for e in self.elements.find({'_id': {'$in': ids}}):
+            # Elements have naive timestamps like those from the OSM API
+            elem = loads(e['elem'], json_options=JSONOptions(tz_aware=False))
+            elems[(elem['id'], elem['version'])] = elem
+        return elems
+
+    def elements_put(self, etype, elems):
+        '''Store OSM element versions'''
+        now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        ops = []
+        for elem in elems:
+            eid = u'{}/{}/{}'.format(etype, elem['id'], elem['version'])
+            # Serialized since tags have arbitrary keys
+            ops.append(pymongo.ReplaceOne({'_id': eid}, {'_id': eid, 'elem': dumps(elem), 'stored': now},
+                                          upsert=True))
+        if ops:
+            self.elements.bulk_write(ops, ordered=False)
+
     # TODO: Use chgsets_find_selector()
     def chgset_start_processing(self, istate, nstate, before=None, after=None, timestamp='state_changed', cid=None):
         '''Start a processing of a changeset with state istate and set intermediate state nstate''' 
@@ -312,6 +365,63 @@ class DataBase(object):
             return True
         return False
 
+class MemoryDataBase(object):
+    '''In-memory database with the changeset admission methods used by changeset
+       filtering, e.g. for replaying recorded changesets without MongoDB'''
+    STATE_NEW = DataBase.STATE_NEW
+    STATE_BOUNDS_CHECKED = DataBase.STATE_BOUNDS_CHECKED
+    STATE_QUARANTINED = DataBase.STATE_QUARANTINED
+
+    def __init__(self):
+        self.url = 'memory'
+        self.csets = {}
+        self.decisions = {}
+
+    def __str__(self):
+        return self.url
+
+    def chgset_get(self, cid):
+        return self.csets.get(cid, None)
+
+    def chgset_append(self, cid, source=None):
+        now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        c = {u'cid': cid, 'state': self.STATE_NEW, 'labels': [], 'queued': now,
+             'updated': now, 'refreshed': now, 'state_changed': now}
+        if source:
+            c[u'source'] = source
+        self.csets[cid] = c
+        return dict(c)
+
+    def chgset_refresh(self, cid, source):
+        if cid not in self.csets:
+            return False
+        self.csets[cid][u'source'] = source
+        return True
+
+    def chgset_processed(self, c, state, failed=False, refreshed=False):
+        cset = self.csets[c['cid']]
+        if state:
+            cset['state'] = state
+        if 'labels' in c:
+            cset['labels'] = c['labels']
+
+    def chgset_set_meta(self, cid, meta):
+        self.csets.setdefault(cid, {u'cid': cid})['meta'] = dumps(meta)
+        return True
+
+    def filter_decision_get(self, cid):
+        d = self.decisions.get(cid, None)
+        if d and d['expires'] > datetime.datetime.utcnow().replace(tzinfo=pytz.utc):
+            return d
+        return None
+
+    def filter_decision_set(self, cid, passed, bbox=None, ttl=3600):
+        now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        d = {u'cid': cid, 'passed': passed, 'bbox': bbox, 'decided': now,
+             'expires': now+datetime.timedelta(seconds=ttl)}
+        self.decisions[cid] = d
+        return d
+
 def drop(args, db):
     if args.timeout:
         now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
@@ -2,7 +2,7 @@
 
 import argparse
 import os, io, sys
-import kombu, kombu.mixins, kombu.pools
+import kombu, kombu.mixins, kombu.pools, kombu.common
 import json
 import jsonschema
 import avro.schema, avro.io
@@ -16,13 +16,20 @@ class SchemaRegistry(object):
     def __init__(self):
         self.registry = {
         }
+        self.writers = {}
         self.path = 'schemas'
 
     def schema_get(self, schema, version=1):
-        # FIXME store versions...
-        if schema not in self.registry:
-            self.registry[schema] = avro.schema.parse(open(os.path.join(self.path, schema, str(version))+'.avsc', "rb").read())
-        return self.registry[schema]
+        key = (schema, version)
+        if key not in self.registry:
+            self.registry[key] = avro.schema.parse(open(os.path.join(self.path, schema, str(version))+'.avsc', "rb").read())
+        return self.registry[key]
+
+    def writer_get(self, schema, version=1):
+        key = (schema, version)
+        if key not in self.writers:
+            self.writers[key] = avro.io.DatumWriter(self.schema_get(schema, version))
+        return self.writers[key]
 
 ENVELOPE_SCHEMA = {
     'type': 'object',
@@ -41,6 +48,9 @@ ENVELOPE_SCHEMA = {
     'required': ['schema', 'version', 'message']
 }
 
+class PublishError(Exception):
+    pass
+
 class Amqp(kombu.mixins.ConsumerProducerMixin):
     def __init__(self, url, exchange, exchange_type, declare_queues, handle_queues=None):
         logger.info('AMQP URL={}'.format(url))
@@ -51,26 +61,82 @@ class Amqp(kombu.mixins.ConsumerProducerMixin):
             self.handle_queues = [kombu.Queue(name=n, exchange=self.exchange, routing_key=k, auto_delete=d) for n,k,d in handle_queues]
         logger.info('Exchange {}, queues declared {}, handle queues {}'.format(exchange, declare_queues, handle_queues))
         self.schema_registry = SchemaRegistry()
+        self.prefetch_count = 1
 
     def __del__(self):
         logger.debug('AMQP cleanup...')
 
-    def send(self, message, schema_name, schema_version, routing_key):
-        schema = self.schema_registry.schema_get(schema_name, schema_version)
-        writer = avro.io.DatumWriter(schema)
+    def encode(self, message, schema_name, schema_version):
+        writer = self.schema_registry.writer_get(schema_name, schema_version)
         bytes_writer = io.BytesIO()
         encoder = avro.io.BinaryEncoder(bytes_writer)
         writer.write(message, encoder)
         raw_bytes = bytes_writer.getvalue()
-        msg = {
+        return {
             'schema': schema_name,
             'version': schema_version,
             'message': base64.b64encode(raw_bytes)#json.dumps(message)
         }
+
+    def send(self, message, schema_name, schema_version, routing_key):
+        msg = self.encode(message, schema_name, schema_version)
         self.producer.publish(msg, exchange=self.exchange,
                               declare = self.declare_queues,
                               routing_key=routing_key, retry=True)
 
+    def send_batch(self, messages, schema_name, schema_version, routing_key,
+                   confirm_timeout=30, retries=3):
+        '''Send messages with same schema and routing key. Messages are published
+           back-to-back on one channel without waiting for the broker between
+           messages. With publisher confirms (RabbitMQ), confirmations are
+           awaited once for the whole batch. A batch failing on connection
+           errors is resent, receivers must handle duplicates'''
+        if not messages:
+            return
+        envelopes = [self.encode(m, schema_name, schema_version) for m in messages]
+        conn = self.producer_connection
+        for attempt in range(retries):
+            try:
+                conn.ensure_connection(max_retries=self.connect_max_retries)
+                self.publish_confirmed(conn, envelopes, routing_key, confirm_timeout)
+                break
+            except conn.recoverable_connection_errors as e:
+                if attempt+1 == retries:
+                    raise
+                logger.warning('Batch publish failed, retrying: {}'.format(e))
+        logger.debug('Sent batch of {} messages, schema {}/{}'.format(len(envelopes), schema_name, schema_version))
+
+    def publish_confirmed(self, conn, envelopes, routing_key, confirm_timeout):
+        channel = conn.channel()
+        try:
+            confirms = hasattr(channel, 'confirm_select')
+            if confirms:
+                pending = set(range(1, len(envelopes)+1))
+                nacked = []
+                def confirmed(nack):
+                    def handler(delivery_tag, multiple):
+                        tags = [t for t in pending if t <= delivery_tag] if multiple else [delivery_tag]
+                        for t in tags:
+                            pending.discard(t)
+                            if nack:
+                                nacked.append(t)
+                    return handler
+                channel.confirm_select()
+                channel.events['basic_ack'].add(confirmed(False))
+                channel.events['basic_nack'].add(confirmed(True))
+            for q in self.declare_queues:
+                kombu.common.maybe_declare(q, channel)
+            producer = kombu.Producer(channel, exchange=self.exchange, auto_declare=False)
+            for msg in envelopes:
+                producer.publish(msg, routing_key=routing_key)
+            if confirms:
+                while pending:
+                    conn.drain_events(timeout=confirm_timeout)
+                if nacked:
+                    raise PublishError('Broker rejected {} of {} messages'.format(len(nacked), len(envelopes)))
+        finally:
+            channel.close()
+
     def get_consumers(self, Consumer, channel):
         handle_queues = getattr(self, 'handle_queues', None)
         logger.debug('Consumer queues: {}'.format(handle_queues))
@@ -78,7 +144,7 @@ class Amqp(kombu.mixins.ConsumerProducerMixin):
             queues = handle_queues,
             on_message = self.message_cb,
             accept = {'application/json'},
-            prefetch_count = 1,
+            prefetch_count = self.prefetch_count,
         )]
 
     def message_cb(self, message):
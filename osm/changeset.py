@@ -8,11 +8,19 @@ import pprint
 import geojson as gj
 import geotools
 import poly
+import poll
+import elemstore
+import geomstore
+import bisect
 import logging
 import datetime, pytz
 import requests
 import re
 import json
+import urlparse
+import eventlet
+import eventlet.semaphore
+import eventlet.corolocal
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +29,34 @@ m_alt_source_downloads = prometheus_client.Counter('openstreetmap_api_alt_source
 m_alt_source_download_bytes = prometheus_client.Counter('openstreetmap_api_alt_source_download_bytes',
                                                         'OpenStreetMap API Alternative Source Downloaded Bytes')
 
+# Element versions shared between changesets, disabled if None
+element_store = None
+
+# Max concurrent API requests per host across all changesets, see
+# set_host_concurrency()
+HOST_CONCURRENCY = 8
+host_limits = {}
+host_semaphores = {}
+
+def set_host_concurrency(limits):
+    '''Set max concurrent API requests per host. Limits is either a number used
+       for all hosts or a dict of host to number, where key 'default' gives
+       the limit of other hosts'''
+    global HOST_CONCURRENCY
+    host_limits.clear()
+    if isinstance(limits, dict):
+        limits = dict(limits)
+        HOST_CONCURRENCY = limits.pop('default', HOST_CONCURRENCY)
+        host_limits.update(limits)
+    else:
+        HOST_CONCURRENCY = limits
+    host_semaphores.clear()
+
+def host_semaphore(host):
+    if host not in host_semaphores:
+        host_semaphores[host] = eventlet.semaphore.Semaphore(host_limits.get(host, HOST_CONCURRENCY))
+    return host_semaphores[host]
+
 class Timeout(Exception):
     pass
 
@@ -33,17 +69,34 @@ class Changeset(object):
             self.alt_source_data = None
         else:
             logger.debug('Using api={}'.format(api))
+        # Greenthread local API clients of concurrent fetches, see osmapi
+        self.api_local = eventlet.corolocal.local()
+        self.api_clients = []
         if api:
-            self.osmapi = OsmApi(api=api)
+            self._osmapi = OsmApi(api=api)
+            self.api_factory = lambda: OsmApi(api=api)
+            self.api_host = urlparse.urlparse(api).netloc
         else:
-            self.osmapi = None
+            self._osmapi = None
+            self.api_factory = None
+            self.api_host = None
+        # Max concurrent history downloads for this changeset
+        self.fetch_concurrency = self.FETCH_CONCURRENCY
 
         self.meta = None
         self.changes = None
 
         # History for modified/deleted elements, inner dicts indexed by object id
         self.history_one_version_back = True
-        self.hist = {'node': {}, 'way':{}, 'relation':{}}
+        self.hist = geomstore.new_history()
+        # Node id to referencing ways in changes, see wayNodeIndex()
+        self.way_node_index = None
+        # Versions valid at given timestamps, keyed by (type, id, timestamp)
+        self.hist_at = {}
+        # Version-sorted timestamps of history, keyed by (type, id). See timeline()
+        self.hist_index = {}
+        # Per element version results, keyed by (kind, type, id, version). See memoized()
+        self.elem_results = {}
 
         # Summary of elemets, created, modified, deleted. '_' versions are summarized across all object types
         self.summary = {'create' : { 'node': 0, 'way':0, 'relation':0, 'relation_tags':{}},
@@ -61,9 +114,11 @@ class Changeset(object):
 
         self.other_users = None
         self.mileage = None
+        self.mileage_ways = None
 
         self.apidebug = False
         self.datadebug = False
+        self.max_processing_time = None
 
     @staticmethod
     def get_timestamp(meta, typeof=None, include_discussion=False):
@@ -123,75 +178,85 @@ class Changeset(object):
         for modif in self.changes:
             logger.debug('Processing modif: {}'.format(modif))
             self.checkProcessingLimits()
-            etype = modif['type']
-            data = modif['data']
-            id = data['id']
-            version = data['version']
-            action = modif['action']
+            self.diffChange(modif)
+        return self.diffs
+
+    def diffChange(self, modif, diff=False, old=None):
+        '''Add textual diff entry for a single modification. Tag diff and previous
+           version are looked up unless given'''
+        etype = modif['type']
+        data = modif['data']
+        id = data['id']
+        version = data['version']
+        action = modif['action']
+        if diff is False:
             diff = self.getTagDiff(etype, id, version)
-            label = self.getLabel(etype, id, version)
-            #logger.debug('-- {} {} {} --'.format(action, etype, id))
-            notes = []
-            prev_authors = []
-            entry = (action, label, diff, notes, prev_authors)
-            self.diffs[etype][str(id)] = entry
-            if action == 'modify':
+        label = self.getLabel(etype, id, version)
+        #logger.debug('-- {} {} {} --'.format(action, etype, id))
+        notes = []
+        prev_authors = []
+        entry = (action, label, diff, notes, prev_authors)
+        self.diffs[etype][str(id)] = entry
+        if action == 'modify':
+            if old is None:
                 old = self.old(etype,id,version-1)
-                if etype=='way':
-                    nd_ops = self.diffStat(old['nd'], data['nd'])
-                    if nd_ops or diff:
-                        if nd_ops:
-                            nd_ops_add = len(nd_ops[0])
-                            nd_ops_del = len(nd_ops[1])
-                            if nd_ops_add:
-                                notes.append(u'added {} node{}'.format(nd_ops_add, self._pluS(nd_ops_add)))
-                            if nd_ops_del:
-                                in_new_ways = self.findNodesInOtherWays(nd_ops[1], edit_action='create')
-                                in_mod_ways = self.findNodesInOtherWays(nd_ops[1], edit_action='modify')
-                                if len(in_new_ways)>0:
-                                    notes.append(u'removed {} node{}, of which {} is present in newly created way(s) and {} in modified way(s)'.format(nd_ops_del, self._pluS(nd_ops_del), len(in_new_ways), len(in_mod_ways)))
-                                else:
-                                    notes.append(u'removed {} node{}'.format(nd_ops_del, self._pluS(nd_ops_del)))
-                        if old['uid'] != data['uid']:
-                            prev_authors.append(old['user'])
-                if etype=='relation':
-                    # member is list of dict's: {u'role': u'', u'ref': 1234, u'type': u'way'}
-                    ombr = [x['ref'] for x in old['member']]
-                    nmbr = [x['ref'] for x in data['member']]
-                    m_ops = self.diffStat(ombr, nmbr)
-                    if m_ops or diff:
-                        if m_ops:
-                            m_ops_add = len(m_ops[0])
-                            m_ops_del = len(m_ops[1])
-                            if m_ops_add:
-                                notes.append(u'added {} member{}'.format(m_ops_add, self._pluS(m_ops_add)))
-                            if m_ops_del:
-                                notes.append(u'deleted {} member{}'.format(m_ops_del, self._pluS(m_ops_del)))
-                        if old['uid'] != data['uid']:
-                            prev_authors.append(old['user'])
-                    if not m_ops and ombr!=nmbr:
-                        notes.append(u'Reordered members')
-                # TODO: Handle relation role changes (e.g. inner to outer)
-                # TODO: Show relation as modified if member changes (e.g. way has added a node)
-        return self.diffs
+            if etype=='way':
+                nd_ops = self.diffStat(old['nd'], data['nd'])
+                if nd_ops or diff:
+                    if nd_ops:
+                        nd_ops_add = len(nd_ops[0])
+                        nd_ops_del = len(nd_ops[1])
+                        if nd_ops_add:
+                            notes.append(u'added {} node{}'.format(nd_ops_add, self._pluS(nd_ops_add)))
+                        if nd_ops_del:
+                            in_new_ways = self.findNodesInOtherWays(nd_ops[1], edit_action='create')
+                            in_mod_ways = self.findNodesInOtherWays(nd_ops[1], edit_action='modify')
+                            if len(in_new_ways)>0:
+                                notes.append(u'removed {} node{}, of which {} is present in newly created way(s) and {} in modified way(s)'.format(nd_ops_del, self._pluS(nd_ops_del), len(in_new_ways), len(in_mod_ways)))
+                            else:
+                                notes.append(u'removed {} node{}'.format(nd_ops_del, self._pluS(nd_ops_del)))
+                    if old['uid'] != data['uid']:
+                        prev_authors.append(old['user'])
+            if etype=='relation':
+                # member is list of dict's: {u'role': u'', u'ref': 1234, u'type': u'way'}
+                ombr = [x['ref'] for x in old['member']]
+                nmbr = [x['ref'] for x in data['member']]
+                m_ops = self.diffStat(ombr, nmbr)
+                if m_ops or diff:
+                    if m_ops:
+                        m_ops_add = len(m_ops[0])
+                        m_ops_del = len(m_ops[1])
+                        if m_ops_add:
+                            notes.append(u'added {} member{}'.format(m_ops_add, self._pluS(m_ops_add)))
+                        if m_ops_del:
+                            notes.append(u'deleted {} member{}'.format(m_ops_del, self._pluS(m_ops_del)))
+                    if old['uid'] != data['uid']:
+                        prev_authors.append(old['user'])
+                if not m_ops and ombr!=nmbr:
+                    notes.append(u'Reordered members')
+            # TODO: Handle relation role changes (e.g. inner to outer)
+            # TODO: Show relation as modified if member changes (e.g. way has added a node)
+
+    def wayNodeIndex(self):
+        '''Index of ways in changes referencing nodes, i.e. dict of action to dict of
+           node id to list of way ids. Built once per list of changes'''
+        if self.way_node_index is None or self.way_node_index[0] is not self.changes:
+            index = {}
+            for modif in self.changes:
+                if modif['type']=='way':
+                    data = modif['data']
+                    byaction = index.setdefault(modif['action'], {})
+                    for nid in data.get('nd', []):
+                        byaction.setdefault(nid, []).append(data['id'])
+            self.way_node_index = (self.changes, index)
+        return self.way_node_index[1]
 
     def findNodesInOtherWays(self, nodes, edit_action='create'):
         '''Given a list of nodes removed from a way, build list of these nodes present
         in new ways (e.g. a typical way split operation)'''
-        nds = []
         logger.debug('Nodes to find in ways {} edit action {}'.format(nodes, edit_action))
-        for modif in self.changes:
-            logger.debug('Processing modif: {}'.format(modif))
-            etype = modif['type']
-            action = modif['action']
-            if action==edit_action and etype=='way':
-                data = modif['data']
-                nd = data['nd']
-                isect = list(set(nodes).intersection(nd))
-                nds += isect
-            #id = data['id']
-            #version = data['version']
-        return list(set(nds))
+        index = self.wayNodeIndex().get(edit_action, {})
+        return list(set([nid for nid in nodes if nid in index]))
 
     def diffStat(self, a, b):
         ''' Given two lists of ids, return tuple with lists of (added, removed) '''
@@ -322,18 +387,26 @@ class Changeset(object):
                 logger.debug('osmapi.ChangesetGet({}, include_discussion=True)'.format(self.id))
             self.meta = self.osmapi.ChangesetGet(self.id, include_discussion=True)
         if set_tz:
-            for ts in ['created_at', 'closed_at']:
-                if ts in self.meta:
-                    if type(self.meta[ts]) is datetime.datetime:
-                        self.meta[ts] = self.meta[ts].replace(tzinfo=pytz.utc)
-                    else:
-                        self.meta[ts] = diff.OsmDiffApi.timetxt2datetime(self.meta[ts])
-            if 'discussion' in self.meta:
-                for disc in self.meta['discussion']:
-                    disc['date'] = disc['date'].replace(tzinfo=pytz.utc)
+            self.meta_set_tz()
         if self.datadebug:
             logger.debug(u'meta({})={}'.format(self.id, self.meta))
 
+    def meta_set_tz(self):
+        for ts in ['created_at', 'closed_at']:
+            if ts in self.meta:
+                if type(self.meta[ts]) is datetime.datetime:
+                    self.meta[ts] = self.meta[ts].replace(tzinfo=pytz.utc)
+                else:
+                    self.meta[ts] = diff.OsmDiffApi.timetxt2datetime(self.meta[ts])
+        if 'discussion' in self.meta:
+            for disc in self.meta['discussion']:
+                disc['date'] = disc['date'].replace(tzinfo=pytz.utc)
+
+    def set_meta(self, meta):
+        '''Set meta fetched elsewhere, e.g. by download_metas()'''
+        self.meta = meta
+        self.meta_set_tz()
+
     def downloadData(self):
         if self.changes:
             return
@@ -366,6 +439,26 @@ class Changeset(object):
         if self.alt_source:
             return
         self.startProcessing(maxtime)
+        for mod in self.changes:
+            data = mod['data']
+            self.hist[mod['type']].setdefault(data['id'], {})[data['version']] = data
+        # Download needed history in bulk, old() will only need single
+        # lookups for elements not found by bulk requests
+        self.fetchHistory()
+        if self.osmapi:
+            # Remaining single lookups are made concurrently, one element per greenthread
+            versions, at = self.planHistory()
+            lookups = {}
+            for etype, eid, v in versions:
+                if v > 0:
+                    lookups.setdefault((etype, eid), []).append(v)
+            for nid, ts in at:
+                lookups.setdefault(('node', nid), []).append(ts)
+            def lookup(item):
+                (etype, eid), versions = item
+                for v in versions:
+                    self.old(etype, eid, v)
+            self.fetchConcurrently(lookup, sorted(lookups.items()))
         for mod in self.changes:
             self.checkProcessingLimits()
             etype = mod['type']
@@ -373,11 +466,12 @@ class Changeset(object):
             eid = data['id']
             version = data['version']
             action = mod['action']
-            if action == 'create':
-                self.hist[etype][eid] = {1: data}
-            else:
-                self.hist[etype][eid] = {version: data}
-                self.old(etype, eid, version-1)
+            if action != 'create':
+                prev = self.old(etype, eid, version-1)
+                if etype == 'way':
+                    # Nodes removed from the way are needed for mileage
+                    for nid in prev['nd']:
+                        self.old('node', nid, prev['timestamp'])
             if etype == 'way' and action != 'delete':
                 for nid in data['nd']:
                     self.old('node', nid, data['timestamp'])
@@ -401,6 +495,10 @@ class Changeset(object):
         hist = self.hist
         self.hist = None
         del hist
+        self.hist_at = {}
+        self.hist_index = {}
+        self.elem_results = {}
+        self.way_node_index = None
 
     def wayIsNavigable(self, tags):
         navigable = ['highway', 'cycleway', 'busway']
@@ -409,88 +507,147 @@ class Changeset(object):
     def buildSummary(self, mileage=True, maxtime=None):
         logger.debug('Start building change summary')
         self.startProcessing(maxtime)
+        self.startSummary()
+        try:
+            for modif in self.changes:
+                logger.debug('Processing modif: {}'.format(modif))
+                self.checkProcessingLimits()
+                self.summarizeChange(modif, mileage=mileage)
+        finally:
+            self.summarizeMileage()
+
+    def startSummary(self):
         self.other_users = {}
-        self.mileage = {'_navigable_create':0, '_navigable_delete':0, '_all_create':0, '_all_delete':0, 'by_type': {}}
-
-        for modif in self.changes:
-            logger.debug('Processing modif: {}'.format(modif))
-            self.checkProcessingLimits()
-            etype = modif['type']
-            data = modif['data']
-            eid = data['id']
-            version = data['version']
-            action = modif['action']
+        self.mileage = {'_navigable_create':0, '_navigable_modify':0, '_navigable_delete':0,
+                        '_all_create':0, '_all_modify':0, '_all_delete':0, 'by_type': {}}
+        # Concatenated node positions of ways, see addMileageWay()
+        self.mileage_ways = {'ways': [], 'starts': [], 'lons': [], 'lats': []}
+
+    def summarizeChange(self, modif, mileage=True, diff=False, old=None):
+        '''Add a single modification to summary. Tag diff and previous version are
+           looked up unless given'''
+        etype = modif['type']
+        data = modif['data']
+        eid = data['id']
+        version = data['version']
+        action = modif['action']
 
-            self.summary['_'+action] += 1
-            self.summary[action][etype] += 1
+        self.summary['_'+action] += 1
+        self.summary[action][etype] += 1
 
+        if diff is False:
             diff = self.getTagDiff(etype, eid, version)
-            if diff:
-                self.addDiffDicts(self.tagdiff, diff)
-
-            self.tags = self.getTags(etype, eid, version, self.tags)
-            if etype=='node':
-                if action == 'delete':
-                    old = self.old(etype,eid,version-1)
-                    if not diff and ('tag' not in old.keys() or not old['tag']):
-                        self.simple_nodes[action] += 1
-                else:
-                    if not diff and ('tag' not in data.keys() or not data['tag']):
-                        self.simple_nodes[action] += 1
+        if diff:
+            self.addDiffDicts(self.tagdiff, diff)
 
-            # For modify and delete we summarize affected users
+        self.tags = self.getTags(etype, eid, version, self.tags)
+        if action != 'create' and old is None:
+            old = self.old(etype,eid,version-1)
+        if etype=='node':
+            if action == 'delete':
+                if not diff and ('tag' not in old.keys() or not old['tag']):
+                    self.simple_nodes[action] += 1
+            else:
+                if not diff and ('tag' not in data.keys() or not data['tag']):
+                    self.simple_nodes[action] += 1
+
+        # For modify and delete we summarize affected users
+        if action != 'create':
+            old_uid = old['uid']
+            if old_uid != data['uid']:
+                old_uid = str(old_uid)
+                if not old_uid in self.other_users.keys():
+                    if old['user']:
+                        usr = old['user']
+                    else:
+                        usr = 'Anonymous'
+                    self.other_users[old_uid] = {'user':usr, 'edits':0}
+                self.other_users[old_uid]['edits'] = +1
+
+        # Way lengths are computed in one go by summarizeMileage(). Modified
+        # ways count the new length and subtract the old
+        if mileage and etype=='way':
+            if action != 'delete':
+                # If created, we take the latest node version - in special
+                # cases where a node is edited multiple times in the same
+                # diff, this might not be correct
+                self.addMileageWay(action, 1, data['nd'], -1, data['tag'])
             if action != 'create':
-                old = self.old(etype,eid,version-1)
-                old_uid = old['uid']
-                if old_uid != data['uid']:
-                    old_uid = str(old_uid)
-                    if not old_uid in self.other_users.keys():
-                        if old['user']:
-                            usr = old['user']
-                        else:
-                            usr = 'Anonymous'
-                        self.other_users[old_uid] = {'user':usr, 'edits':0}
-                    self.other_users[old_uid]['edits'] = +1
-
-            # FIXME: Since we are only summing created/deleted ways, we ignore edited mileage
-            if (action == 'create' or action == 'delete') and etype=='way':
-                if action == 'create':
-                    # If created, we take the latest node version - in special
-                    # cases where a node is edited multiple times in the same
-                    # diff, this might not be correct
-                    nv = -1
-                    nd = data['nd']
-                    tags = data['tag']
+                # For modified and deleted ways, we take the nodes at the time
+                # of the previous way version
+                self.addMileageWay(action, -1, old['nd'], old['timestamp'], old['tag'])
+
+    def addMileageWay(self, action, sign, nd, nv, tags):
+        '''Add way to mileage computed by summarizeMileage(). Node positions are
+           looked up with version or timestamp nv as for old()'''
+        ways = self.mileage_ways
+        ways['ways'].append((action, sign, tags))
+        ways['starts'].append(len(ways['lons']))
+        # Positions are read from the node store when possible, plain dict
+        # histories only support old()
+        position_at = getattr(self.hist['node'], 'position_at', None)
+        ts = None if isinstance(nv, int) else self._utc(nv)
+        for nid in nd:
+            pos = None
+            if position_at:
+                v = nv
+                if ts is not None:
+                    v = self.hist_at.get(('node', nid, ts), None)
+                    if v is None:
+                        v, _ = self.versionAt('node', nid, ts)
+                if v is not None:
+                    pos = position_at(nid, v)
+            if pos is None:
+                n = self.old('node', nid, nv)
+                pos = (n['lon'], n['lat'])
+            ways['lons'].append(pos[0])
+            ways['lats'].append(pos[1])
+
+    def summarizeMileage(self):
+        '''Add lengths of ways added by addMileageWay() to mileage'''
+        ways = self.mileage_ways
+        if not ways['ways']:
+            return
+        lengths = geotools.way_lengths(ways['lons'], ways['lats'], ways['starts'])
+        for (action, sign, tags), d in zip(ways['ways'], lengths):
+            d = sign*d
+            self.mileage['_all_'+action] += d
+            navigable = self.wayIsNavigable(tags)
+            if navigable:
+                self.mileage['_navigable_'+action] += d
+                nav_cat = navigable.pop()
+                nav_type = tags[nav_cat]
+                if not nav_cat in self.mileage['by_type'].keys():
+                    self.mileage['by_type'][nav_cat] = {}
+                if not nav_type in self.mileage['by_type'][nav_cat].keys():
+                    self.mileage['by_type'][nav_cat][nav_type] = 0
+                self.mileage['by_type'][nav_cat][nav_type] += d
+            #else:
+            #    # Buildings, natural objects etc
+            #    logger.debug('*** Not navigable way ({}) mileage: {} {} {}'.format(tags, d, self.mileage, navigable))
+        self.mileage_ways = None
+
+    def analyse(self, mileage=True, maxtime=None):
+        '''Build summary and diff list in a single pass over changes, i.e. same
+           result as buildSummary() followed by buildDiffList()'''
+        logger.debug('Start analysing changes')
+        self.startProcessing(maxtime)
+        self.startSummary()
+        self.diffs = self.getEmptyObjDict()
+        try:
+            for modif in self.changes:
+                logger.debug('Processing modif: {}'.format(modif))
+                self.checkProcessingLimits()
+                data = modif['data']
+                diff = self.getTagDiff(modif['type'], data['id'], data['version'])
+                if modif['action'] != 'create':
+                    old = self.old(modif['type'], data['id'], data['version']-1)
                 else:
-                    # For deleted ways, we take the previous version
-                    nv = -2 #old['timestamp']
-                    nd = old['nd']
-                    tags = old['tag']
-                d = 0
-                flon = flat = None
-                for nid in nd:
-                    n = self.old('node', nid, nv)
-                    #logger.debug('({}, {})'.format(n['lon'], n['lat']))
-                    if flon:
-                        d += geotools.haversine(flon, flat, n['lon'], n['lat'])
-                    flon, flat = (n['lon'], n['lat'])
-                if action == 'delete':
-                    d = -d
-                self.mileage['_all_'+action] += d
-                navigable = self.wayIsNavigable(tags)
-                if navigable:
-                    self.mileage['_navigable_'+action] += d
-                    nav_cat = navigable.pop()
-                    nav_type = tags[nav_cat]
-                    if not nav_cat in self.mileage['by_type'].keys():
-                        self.mileage['by_type'][nav_cat] = {}
-                    if not nav_type in self.mileage['by_type'][nav_cat].keys():
-                        self.mileage['by_type'][nav_cat][nav_type] = 0
-                    self.mileage['by_type'][nav_cat][nav_type] += d
-                #else:
-                #    # Buildings, natural objects etc
-                #    logger.debug('*** Not navigable way ({}) mileage: {} {} {}'.format(tags, d, self.mileage, navigable))
-
+                    old = None
+                self.summarizeChange(modif, mileage=mileage, diff=diff, old=old)
+                self.diffChange(modif, diff=diff, old=old)
+        finally:
+            self.summarizeMileage()
 
     def getEmptyDiffDict(self):
         return {'create':{}, 'delete':{}, 'modify':{}}
@@ -503,8 +660,22 @@ class Changeset(object):
             for k,v in src[ac].iteritems():
                 into[ac][k] = into[ac].get(k, 0)+v
 
+    def memoized(self, kind, etype, eid, version, func):
+        '''Result of func(etype, eid, version), computed once per element version.
+           Element versions are immutable, i.e. results only change if history
+           is replaced'''
+        key = (kind, etype, eid, version)
+        if key in self.elem_results:
+            return self.elem_results[key]
+        res = func(etype, eid, version)
+        self.elem_results[key] = res
+        return res
+
     def getTagDiff(self, etype, eid, version):
         ''' Compute tag diffence between 'version' and previous version '''
+        return self.memoized('tagdiff', etype, eid, version, self._getTagDiff)
+
+    def _getTagDiff(self, etype, eid, version):
         diff = self.getEmptyDiffDict()
         curr = self.old(etype,eid,version)
         ntags = curr['tag']
@@ -539,6 +710,12 @@ class Changeset(object):
             tags = {}
         else:
             tags = curr_tags
+        for k in self.memoized('tags', etype, eid, version, self._getUnchangedTags):
+            tags[k] = tags.get(k, 0)+1
+        return tags
+
+    def _getUnchangedTags(self, etype, eid, version):
+        unchanged = []
         curr = self.old(etype,eid,version)
         ntags = curr['tag']
         if version > 1:
@@ -552,11 +729,13 @@ class Changeset(object):
         for t in ntags.keys():
             if t in otags:
                 if ntags[t]==otags[t]:
-                    k = u'{}={}'.format(t, ntags[t])
-                    tags[k] = tags.get(k, 0)+1
-        return tags
+                    unchanged.append(u'{}={}'.format(t, ntags[t]))
+        return unchanged
 
     def getLabel(self, etype, eid, version):
+        return self.memoized('label', etype, eid, version, self._getLabel)
+
+    def _getLabel(self, etype, eid, version):
         e = self.old(etype,eid,version)
         if 'tag' in e.keys():
             tag = e['tag']
@@ -582,20 +761,185 @@ class Changeset(object):
         else:
             e = self.old(etype, eid, version-1)
 
+    # Max number of elements requested in one bulk download
+    BULK_SIZE = 100
+    FETCH_CONCURRENCY = 8
+    # Max bulk requests searching backwards for the version at a timestamp
+    BULK_HISTORY_ROUNDS = 3
+
+    def getElementsBulk(self, etype, refs):
+        '''Download elements given as list of (id, version) in bulk, with version
+           None for the current version. Returns dict of elements keyed by (id,
+           version), elements which could not be downloaded are left out'''
+        get = getattr(self.osmapi, '{}sGet'.format(etype.capitalize()))
+        def get_chunk(chunk):
+            ids = [str(eid) if v is None else '{}v{}'.format(eid, v) for eid, v in chunk]
+            if self.apidebug:
+                logger.debug('cset {} -> osmapi.{}sGet({})'.format(self.id, etype.capitalize(), ids))
+            try:
+                return get(ids)
+            except Exception as e:
+                # E.g. one of the versions have been redacted, caller falls back to single lookups
+                logger.warning('Bulk download of {} {}s failed: {}'.format(len(ids), etype, e))
+                return {}
+        elems = {}
+        if element_store is not None:
+            # Current versions are not immutable, i.e. never stored
+            elems = element_store.get_many(etype, [(eid, v) for eid, v in refs if v is not None])
+            refs = [ref for ref in refs if ref not in elems]
+        chunks = [refs[i:i+self.BULK_SIZE] for i in range(0, len(refs), self.BULK_SIZE)]
+        fetched = []
+        for chunk, res in zip(chunks, self.fetchConcurrently(get_chunk, chunks)):
+            for eid, v in chunk:
+                e = res.get(eid, None)
+                if e and (v is None or e['version']==v):
+                    elems[(eid, v)] = e
+                    fetched.append(e)
+        if element_store is not None:
+            element_store.put_many(etype, fetched)
+        return elems
+
+    @property
+    def osmapi(self):
+        '''API client, i.e. the client of the current greenthread while fetching
+           concurrently. Clients keep per-request state and are not shared
+           between greenthreads'''
+        return getattr(self.api_local, 'osmapi', None) or self._osmapi
+
+    @osmapi.setter
+    def osmapi(self, api):
+        # An explicitly set client is shared by all greenthreads
+        self._osmapi = api
+        self.api_factory = None
+
+    def fetchConcurrently(self, func, items):
+        '''Call func on each item with up to fetch_concurrency calls in parallel
+           and at most HOST_CONCURRENCY calls per API host. Processing limits
+           are checked before each call. On the first error remaining items
+           are skipped and the error is raised when running calls complete.
+           Returns results in order of items'''
+        if len(items) < 2 or self.fetch_concurrency < 2:
+            results = []
+            for item in items:
+                self.checkProcessingLimits()
+                results.append(func(item))
+            return results
+        errors = []
+        def run(item):
+            if errors:
+                return None
+            try:
+                self.checkProcessingLimits()
+                with host_semaphore(self.api_host):
+                    if errors:
+                        return None
+                    if self.api_factory:
+                        if not self.api_clients:
+                            self.api_clients.append(self.api_factory())
+                        self.api_local.osmapi = self.api_clients.pop()
+                    try:
+                        return func(item)
+                    finally:
+                        if self.api_factory:
+                            self.api_clients.append(self.api_local.osmapi)
+                            self.api_local.osmapi = None
+            except Exception as e:
+                errors.append(e)
+                return None
+        pool = eventlet.GreenPool(self.fetch_concurrency)
+        results = list(pool.imap(run, items))
+        if errors:
+            raise errors[0]
+        return results
+
+    def planHistory(self, way_nodes=True):
+        '''Find element versions needed for analysis which are not in history, i.e.
+           previous versions of changed elements and way nodes at the time of
+           the way change and of the known previous way version. Returns list
+           of (type, id, version) and list of (id, timestamp) way nodes'''
+        versions = set()
+        at = set()
+        for mod in self.changes:
+            etype = mod['type']
+            data = mod['data']
+            if mod['action'] != 'create' and data['version']-1 not in self.hist[etype].get(data['id'], {}):
+                versions.add((etype, data['id'], data['version']-1))
+            if way_nodes and etype == 'way':
+                ways = []
+                if mod['action'] != 'delete':
+                    ways.append(data)
+                if mod['action'] != 'create' and data['version']-1 in self.hist[etype].get(data['id'], {}):
+                    ways.append(self.hist[etype][data['id']][data['version']-1])
+                for w in ways:
+                    ts = self._utc(w['timestamp'])
+                    for nid in w['nd']:
+                        if (nid, ts) in at or ('node', nid, ts) in self.hist_at:
+                            continue
+                        if self.versionAt('node', nid, ts)[0] is None:
+                            at.add((nid, ts))
+        return sorted(versions), sorted(at)
+
+    def fetchHistory(self, way_nodes=True):
+        '''Download element versions found by planHistory() with bulk requests.
+           Versions of way nodes at the time of the way change are found by
+           downloading the current versions and stepping back one version per
+           request round until a version older than the way change is found.
+           Lookups not resolved are left to old()'''
+        if not self.osmapi:
+            return
+        versions, _ = self.planHistory(way_nodes)
+        for etype in ['node', 'way', 'relation']:
+            refs = [(eid, v) for t, eid, v in versions if t==etype and v>0]
+            if not refs:
+                continue
+            self.checkProcessingLimits()
+            elems = self.getElementsBulk(etype, refs)
+            for (eid, v), e in elems.items():
+                self.hist[etype].setdefault(eid, {})[v] = e
+            logger.debug('Bulk fetched {} of {} {} versions'.format(len(elems), len(refs), etype))
+
+        # Planned again, nodes of previous way versions are known now
+        _, at = self.planHistory(way_nodes)
+        pending = dict([((nid, ts), None) for nid, ts in at])
+        for rnd in range(self.BULK_HISTORY_ROUNDS):
+            if not pending:
+                break
+            self.checkProcessingLimits()
+            refs = sorted(set([(nid, v) for (nid, ts), v in pending.items()]))
+            elems = self.getElementsBulk('node', refs)
+            resolved = 0
+            for (nid, ts), v in pending.items():
+                e = elems.get((nid, v), None)
+                del pending[(nid, ts)]
+                if not e:
+                    continue
+                self.hist['node'].setdefault(nid, {})[e['version']] = e
+                if self._utc(e['timestamp']) <= ts:
+                    self.hist_at[('node', nid, ts)] = e['version']
+                    resolved += 1
+                elif e['version'] > 1:
+                    pending[(nid, ts)] = e['version']-1
+            logger.debug('Bulk history round {}: resolved {} way nodes, {} pending'.format(rnd, resolved, len(pending)))
+
     def getElementHistory(self, etype, eid, version):
         logger.debug('GetElementHistory({} idw {} version {})'.format(etype, eid, version));
         hv = None
         if self.history_one_version_back or version<4:
             if not eid in self.hist[etype].keys():
                 self.hist[etype][eid] = {}
-            if self.apidebug:
-                logger.debug('cset {} -> osmapi.{}Get({},ver={})'.format(self.id, etype.capitalize(), eid, version))
-            if etype == 'node':
-                hv = self.osmapi.NodeGet(eid, NodeVersion=version)
-            elif etype == 'way':
-                hv = self.osmapi.WayGet(eid, WayVersion=version)
-            elif etype == 'relation':
-                hv = self.osmapi.RelationGet(eid, RelationVersion=version)
+            if element_store is not None:
+                hv = element_store.get(etype, eid, version)
+            if not hv:
+                if self.apidebug:
+                    logger.debug('cset {} -> osmapi.{}Get({},ver={})'.format(self.id, etype.capitalize(), eid, version))
+                if etype == 'node':
+                    hv = self.osmapi.NodeGet(eid, NodeVersion=version)
+                elif etype == 'way':
+                    hv = self.osmapi.WayGet(eid, WayVersion=version)
+                elif etype == 'relation':
+                    hv = self.osmapi.RelationGet(eid, RelationVersion=version)
+                if hv and element_store is not None:
+                    element_store.put(etype, hv)
             if hv:
                 self.hist[etype][eid][version] = hv
             else:
@@ -611,11 +955,59 @@ class Changeset(object):
                 h = self.osmapi.WayHistory(eid)
             elif etype == 'relation':
                 h = self.osmapi.RelationHistory(eid)
-            self.hist[etype][eid] = h
+            self.setHistory(etype, eid, h)
             logger.debug('{} id {} history: {}'.format(etype, eid, h))
 
+    def setHistory(self, etype, eid, h):
+        '''Set full history of element'''
+        if element_store is not None:
+            element_store.put_history(etype, h)
+        self.hist[etype][eid] = h
+        self.timeline(etype, eid)['complete'] = True
+
+    def timeline(self, etype, eid):
+        '''Versions and epoch timestamps of known history of element, sorted by
+           version. Rebuilt when versions are added to history. The timeline is
+           complete if the full history was downloaded'''
+        h = self.hist[etype].get(eid, {})
+        tl = self.hist_index.get((etype, eid), None)
+        versions = sorted(h.keys())
+        if tl is None or tl['versions'] != versions:
+            tl = {'versions': versions,
+                  'epochs': [poll.epoch(h[v]['timestamp']) for v in versions],
+                  'complete': False}
+            self.hist_index[(etype, eid)] = tl
+        return tl
+
+    def versionAt(self, etype, eid, ts):
+        '''Find version of element valid at timestamp from known history. Returns
+           (version, close) where close is True if the version is within two
+           seconds of the timestamp, e.g. nodes created with a way. Version is
+           None if known history does not cover the timestamp'''
+        tl = self.timeline(etype, eid)
+        epochs = tl['epochs']
+        if not epochs:
+            return None, False
+        t = poll.epoch(diff.OsmDiffApi.timetxt2datetime(ts))
+        i = bisect.bisect_right(epochs, t)
+        for j in [i-1, i]:
+            if 0 <= j < len(epochs) and abs(epochs[j]-t) < 2:
+                return tl['versions'][j], True
+        if tl['complete']:
+            # Default to first version if timestamps does not work - should never be needed
+            return tl['versions'][max(i-1, 0)], False
+        if i > 0 and i < len(epochs) and tl['versions'][i] == tl['versions'][i-1]+1:
+            # Timestamp between two consecutive known versions
+            return tl['versions'][i-1], False
+        return None, False
+
     def old(self, etype, eid, version, only_visible=True):
         logger.debug('Get element {} id {} version {}'.format(etype, eid, version))
+        if not isinstance(version, int):
+            v = self.hist_at.get((etype, eid, self._utc(version)), None)
+            if v is not None and v in self.hist[etype].get(eid, {}):
+                # Resolved earlier, e.g. by fetchHistory()
+                version = v
         if not isinstance(version, int):
             '''Support timestamp versioning. Ways and relations refer un-versioned
                nodes/ways/relations, i.e. the only way to find the relevant node
@@ -624,41 +1016,32 @@ class Changeset(object):
                if the node was moved subsequently..
             '''
             ts = diff.OsmDiffApi.timetxt2datetime(version)
-            # First look if we have version very close in time
-            if eid in self.hist[etype]:
-                for v in self.hist[etype][eid].keys():
-                    e = self.hist[etype][eid][v]
-                    diffsec = abs((ts-e['timestamp']).total_seconds())
-                    # If timestamp difference is less than two seconds, return the element we have
-                    # This will cover e.g. newly created nodes+ways
-                    if diffsec<2:
-                        return e
-                if not self.osmapi:
-                    # If we have no api, return the newest version
-                    v = max(self.hist[etype][eid].keys())
-                    e = self.hist[etype][eid][v]
-                    if only_visible and not e['visible']:
-                        e = self.hist[etype][eid][v-1]
-                    return e
-
-            # Lookup the old node
-            if self.apidebug:
-                logger.debug('cset {} -> osmapi.{}History({})'.format(self.id, etype.capitalize(), eid))
-            if etype == 'node':
-                self.hist[etype][eid] = self.osmapi.NodeHistory(eid)
-            elif etype == 'way':
-                self.hist[etype][eid] = self.osmapi.WayHistory(eid)
-            elif etype == 'relation':
-                self.hist[etype][eid] = self.osmapi.RelationHistory(eid)
-            k = self.hist[etype][eid].keys()
-            k.sort(reverse=True)
-            version = 1 # Default, if timestamps does not work - should never be needed
-            for v in k:
+            v, close = self.versionAt(etype, eid, ts)
+            if close:
+                # If timestamp difference is less than two seconds, return the element we have
+                # This will cover e.g. newly created nodes+ways
+                return self.hist[etype][eid][v]
+            if v is not None:
+                version = v
+            elif eid in self.hist[etype] and not self.osmapi:
+                # If we have no api, return the newest version
+                v = max(self.hist[etype][eid].keys())
                 e = self.hist[etype][eid][v]
-                ets = diff.OsmDiffApi.timetxt2datetime(e['timestamp'])
-                if ets<=ts:
-                    version = e['version']
-                    break;
+                if only_visible and not e['visible']:
+                    e = self.hist[etype][eid][v-1]
+                return e
+            else:
+                # Lookup the old node
+                if self.apidebug:
+                    logger.debug('cset {} -> osmapi.{}History({})'.format(self.id, etype.capitalize(), eid))
+                if etype == 'node':
+                    h = self.osmapi.NodeHistory(eid)
+                elif etype == 'way':
+                    h = self.osmapi.WayHistory(eid)
+                elif etype == 'relation':
+                    h = self.osmapi.RelationHistory(eid)
+                self.setHistory(etype, eid, h)
+                version, _ = self.versionAt(etype, eid, ts)
 
         if version<0:
             # -1 is Latest version we already have
@@ -714,6 +1097,7 @@ class Changeset(object):
                 elem['uid'] = 0
             if not 'user' in elem.keys():
                 elem['user'] = user
+            self.hist[etype][eid][version] = elem
         return elem
 
     # def getReferencedElements(self):
@@ -772,26 +1156,64 @@ class Changeset(object):
     #             elif etype == 'relation':
     #                 self.getRelation(ref)
 
+    @staticmethod
+    def _utc(ts):
+        ts = diff.OsmDiffApi.timetxt2datetime(ts)
+        if ts.tzinfo:
+            ts = ts.astimezone(pytz.utc).replace(tzinfo=None)
+        return ts
+
     def isInside(self, area, load_way_nodes=True):
-        '''Return true if there are node edits in changeset and one or more nodes are within area'''
+        '''Return true if there are node edits in changeset and one or more nodes are within area.
+           Known node positions are tested in one vectorized operation before
+           missing node positions are downloaded in bulk'''
+        def inside(points):
+            if not points:
+                return False
+            lons, lats = zip(*points)
+            return bool(area.contains_points(lons, lats).any())
+
         hasnodes = False
+        points = []
+        deleted = []
+        ways = []
         for modif in self.changes:
             etype = modif['type']
             data = modif['data']
-            action = modif['action']
             if etype=='node':
                 hasnodes = True
-                if action!='delete':
-                    if area.contains(data['lon'], data['lat']):
-                        return True
+                if modif['action']!='delete':
+                    points.append((data['lon'], data['lat']))
                 else:
                     # Deleted node do not have lat/lon
-                    id = data['id']
-                    version = data['version']
-                    n = self.old(etype,id,version-1)
-                    if area.contains(n['lon'], n['lat']):
-                        return True
+                    deleted.append((data['id'], data['version']-1))
+            elif etype=='way':
+                ways.append(data)
+        if inside(points):
+            return True
+
         if hasnodes:
+            if deleted:
+                points = []
+                missing = []
+                for eid, version in deleted:
+                    n = self.hist['node'].get(eid, {}).get(version, None)
+                    if n and n['visible']:
+                        points.append((n['lon'], n['lat']))
+                    else:
+                        missing.append((eid, version))
+                nodes = {}
+                if self.osmapi and missing:
+                    nodes = self.getElementsBulk('node', missing)
+                for eid, version in missing:
+                    n = nodes.get((eid, version), None)
+                    if n and n['visible']:
+                        self.hist['node'].setdefault(eid, {})[version] = n
+                    else:
+                        n = self.old('node', eid, version)
+                    points.append((n['lon'], n['lat']))
+                if inside(points):
+                    return True
             # Changesset has node edits, but none inside area i.e. most likely
             # not within area. We could have way/relation changes inside area,
             # which we will miss (FIXME).
@@ -800,21 +1222,34 @@ class Changeset(object):
             # FIXME: We really do not know because only tags/members on/off
             # ways/relations where changes. Maybe download way/relation nodes
             # to detect where edit where
-            if load_way_nodes:
-                for modif in self.changes:
-                    etype = modif['type']
-                    data = modif['data']
-                    #action = modif['action']
-                    if etype=='way':
-                        nd = data['nd']
-                        for nid in nd:
-                            n = self.old('node', nid, data['timestamp'])
-                            if area.contains(n['lon'], n['lat']):
-                                return True
-                return False
-            else:
+            if not load_way_nodes:
                 # If we do not load nodes, we assume there are changed within area
                 return True
+            # Order way nodes such that the first chunks sample all ways, i.e. a
+            # way within area is found without downloading all its nodes
+            refs = []
+            seen = set()
+            for idx in range(max([len(w['nd']) for w in ways] or [0])):
+                for w in ways:
+                    if idx < len(w['nd']) and w['nd'][idx] not in seen:
+                        seen.add(w['nd'][idx])
+                        refs.append((w['nd'][idx], self._utc(w['timestamp'])))
+            for i in range(0, len(refs), self.BULK_SIZE):
+                chunk = refs[i:i+self.BULK_SIZE]
+                nodes = {}
+                if self.osmapi:
+                    nodes = self.getElementsBulk('node', [(nid, None) for nid, _ in chunk])
+                points = []
+                for nid, ts in chunk:
+                    n = nodes.get((nid, None), None)
+                    # Current version is the one referenced by the way unless
+                    # the node was changed after the way
+                    if not (n and n['visible'] and self._utc(n['timestamp'])<=ts):
+                        n = self.old('node', nid, ts)
+                    points.append((n['lon'], n['lat']))
+                if inside(points):
+                    return True
+            return False
 
     def getGeoJsonDiff(self, include_modified_ways=True):
         #self.getReferencedElements()
@@ -940,15 +1375,17 @@ class Changeset(object):
 
     def get_elem_elem(self, obj, elem):
         '''Find elements within elements'''
-        els = elem.split('.')[1:]
+        return self.get_elem_path(obj, elem.split('.')[1:])
+
+    @staticmethod
+    def get_elem_path(obj, path):
+        '''Find elements within elements given path as sequence of keys'''
         try:
-            for e in els:
-                logger.debug(u'get e={} obj={}'.format(e,obj))
+            for e in path:
                 if type(obj) is dict:
                     obj = obj[e]
                 else:
                     obj = getattr(obj, e)
-                logger.debug(u'new obj={}'.format(obj))
             return obj
         except (AttributeError, KeyError):
             return None
@@ -959,29 +1396,8 @@ class Changeset(object):
            full match is found, return True. I.e. match is OR between list of
            dicts and AND between elements in each dict.
         '''
-
         logger.debug('Cset check regex filter: {}'.format(regex_filter))
-        for rf in regex_filter:
-            matchcnt = 0
-            for k,v in rf.iteritems():
-                logger.debug(u"Evaluating: '{}'='{}'".format(k,v))
-                if k.startswith('.changes'):
-                    if self.regex_test_changes(k, v):
-                        logger.debug("Match found")
-                        matchcnt += 1
-                else:
-                    e = self.get_elem_elem(self, k)
-                    logger.debug(u"regex: field '{}'='{}', regex '{}'".format(k,e,v))
-                    if e:
-                        m = re.match(v, e)
-                        if m:
-                            logger.debug(u"Match found on '{}'".format(e))
-                            matchcnt += 1
-            if matchcnt == len(rf.keys()):
-                logger.debug(u"Found '{}' matches of: '{}'".format(matchcnt, rf))
-                return True
-            logger.debug(u"No match: '{}' (found {} of {})".format(rf, matchcnt, len(rf.keys())))
-        return False
+        return self.regex_test_compiled(compile_regex_filter(regex_filter))
 
     def regex_test_changes(self, k, v):
         '''Regex test on changeset changes.  Format is:
@@ -994,90 +1410,94 @@ class Changeset(object):
         Examples: '.changes.modify.node.tag.name'
                   '.changes.node.tag.name'
         '''
+        cond = regex_cond(k, v)
+        return cond in self.scan_changes([cond])
+
+    def scan_changes(self, conds):
+        '''Test regex conditions on changes (see regex_test_changes) in a single pass
+           over changes. Returns set of matching conditions'''
         # FIXME: This code only looks at the new values (e.g. tags on new
         # version). We need to investigate old version also to detect e.g. deleted tags
+        matched = set()
         if not self.changes:
-            return False
-        action = None
-        elemtype = None
-        rg = k.split('.')[2:]
-        if rg[0] in ['modify', 'create', 'delete']:
-            action = rg.pop(0)
-        if rg[0] in ['node', 'way', 'relation']:
-            elemtype = rg.pop(0)
-        logger.debug("Action: '{}', element type '{}'".format(action, elemtype))
-        logger.debug('Changes: {}'.format(self.changes))
+            return matched
         for modif in self.changes:
-            if action and action!=modif['action']:
-                continue
-            if elemtype and elemtype!=modif['type']:
+            mod_action = modif['action']
+            etype = modif['type']
+            pending = [c for c in conds if c not in matched and
+                       (not c.action or c.action==mod_action) and
+                       (not c.elemtype or c.elemtype==etype)]
+            if not pending:
                 continue
             data = modif['data']
-            etype = modif['type']
-            id = data['id']
-            version = data['version']
-            mod_action = modif['action']
-            #diff = self.getTagDiff(etype, id, version)
-            if mod_action=='create':
-                e_old = None
+            old_loaded = False
+            e_old = None
+            for c in pending:
+                ee = self.get_elem_path(data, c.path)
+                if ee and c.rx.match(ee):
+                    matched.add(c)
+                    continue
+                # Old version only needed if new version does not match
+                if not old_loaded:
+                    if mod_action!='create':
+                        e_old = self.old(etype, data['id'], data['version']-1, only_visible=False)
+                    old_loaded = True
+                ee_old = self.get_elem_path(e_old, c.path)
+                if ee_old and c.rx.match(ee_old):
+                    matched.add(c)
+            if len(matched)==len(conds):
+                break
+        return matched
+
+    def regex_test_compiled(self, regex, changes_matched=None):
+        '''Like regex_test() but on regex filter compiled by compile_regex_filter(). Results
+           of tests on changes can be given as set of matching conditions'''
+        for conds in regex:
+            for c in conds:
+                if c.on_changes:
+                    if changes_matched is None:
+                        ok = self.regex_test_changes(c.key, c.pattern)
+                    else:
+                        ok = c in changes_matched
+                else:
+                    e = self.get_elem_path(self, c.path)
+                    ok = e and c.rx.match(e)
+                if not ok:
+                    break
             else:
-                e_old = self.old(etype,id,version-1, only_visible=False)
-            e = data
-            logger.debug('Evaluate change, type:{} id:{} action:{} data:{}'.format(etype, id, mod_action, data))
-            logger.debug('e_old: {}'.format(e_old))
-            logger.debug('e: {}'.format(e))
-            field = '.'+'.'.join(rg)
-            ee_old = self.get_elem_elem(e_old, field)
-            ee = self.get_elem_elem(e, field)
-            logger.debug("regex: field '{}'='{}', regex '{}'".format(field,ee,v))
-            if ee and re.match(v, ee):
-                return True
-            logger.debug("regex(old): field '{}'='{}', regex '{}'".format(field,ee_old,v))
-            if ee_old and re.match(v, ee_old):
                 return True
         return False
 
-    def build_labels(self, label_rules, bbox=None):
+    def build_labels(self, label_rules, bbox=None, points_bbox=None, label_filters=None):
         '''Build list of labels based on regex and area check.  Note that both regex and
            area check can be defined with an AND rule between then, i.e. both
-           must match if both are defined.
+           must match if both are defined. The 'points-bbox' area check uses
+           the bounding box of changeset node coordinates if known and
+           otherwise falls back to the changeset bbox. Rules are evaluated
+           cheapest first, see LabelPlan. If label_filters are given,
+           evaluation stops when no filter can pass, i.e. the returned labels
+           are then incomplete.
         '''
-        labels = []
-        for dd in label_rules:
-            if dd['label'] in labels:
-                logger.debug('Label already set: {}'.format(dd['label']))
-                continue # duplicate label
-            match = True
-            if not ('regex' in dd or 'area_file' in dd):
-                continue
-            if 'regex' in dd:
-                self.downloadMeta()
-                logger.debug('regex test, rule={}'.format(dd))
-                if self.regex_test(dd['regex']):
-                    logger.debug('Regex test OK')
-                else:
-                    match = False
-            if 'area_file' in dd:
-                logger.debug('area test, rule={}'.format(dd))
-                area = poly.Poly()
-                if 'OSMTRACKER_REGION' in os.environ:
-                    area_file = os.environ['OSMTRACKER_REGION']
-                else:
-                    area_file = dd['area_file']
-                area.load(area_file)
-                logger.debug("Loaded area polygon from '{}' with {} points".format(area_file, len(area)))
-                if dd['area_check_type']=='cset-bbox' and bbox and area.contains_bbox(bbox):
-                    logger.debug('Area test OK, changeset bbox {}'.format(bbox))
-                elif dd['area_check_type']=='cset-center' and set(['min_lon', 'min_lat', 'max_lon', 'max_lat']).issubset(self.meta.keys()) and area.contains((float(self.meta['min_lon'])+float(self.meta['max_lon']))/2,
-                                                                            (float(self.meta['min_lat'])+float(self.meta['max_lat']))/2):
-                    logger.debug('Area test OK, changeset center')
-                else:
-                    logger.debug('Area test failed: {}'.format(dd))
-                    match = False
-            if match:
-                logger.debug("Adding label '{}'".format(dd['label']))
-                labels.append(dd['label'])
-        return labels
+        plan = get_label_plan(label_rules, label_filters)
+        return plan.evaluate(self, bbox, points_bbox)
+
+    @staticmethod
+    def area_file(rule):
+        return os.environ.get('OSMTRACKER_REGION', rule['area_file'])
+
+    def area_matches(self, check_type, index, bbox=None, points_bbox=None):
+        '''Find areas in region index matching changeset for given area check type'''
+        if check_type=='cset-bbox':
+            if bbox:
+                return index.query_bbox(bbox)
+        elif check_type=='points-bbox':
+            if points_bbox or bbox:
+                return index.query_bbox(points_bbox or bbox)
+        elif check_type=='cset-center':
+            if set(['min_lon', 'min_lat', 'max_lon', 'max_lat']).issubset(self.meta.keys()):
+                return index.query_point((float(self.meta['min_lon'])+float(self.meta['max_lon']))/2,
+                                         (float(self.meta['min_lat'])+float(self.meta['max_lat']))/2)
+        return set()
 
     def data_export(self):
         return {'state': {},
@@ -1088,9 +1508,14 @@ class Changeset(object):
                 'diffs': self.diffs,
                 'other_users': self.other_users,
                 'mileage_m': self.mileage,
-                'geometry': self.hist,
+                'geometry': self.exportGeometry(),
                 'changes': self.changes}
 
+    def exportGeometry(self):
+        '''History as dicts of element dicts'''
+        return dict((etype, dict((eid, dict(h.items())) for eid, h in hist.items()))
+                    for etype, hist in self.hist.items())
+
     def data_import(self, data):
         self.summary = data['summary']
         self.tags = data['tags']
@@ -1100,11 +1525,201 @@ class Changeset(object):
         self.other_users = data['other_users']
         self.mileage = data['mileage_m']
         self.changes = data['changes']
-        self.hist = {}
+        self.hist = geomstore.new_history()
         # Exporting to JSON causes int keys to be converted to strings
         for etype in data['geometry'].keys():
-            self.hist[etype] = {}
             for eid in data['geometry'][etype].keys():
                 self.hist[etype][long(eid)] = {}
                 for v in data['geometry'][etype][eid].keys():
                     self.hist[etype][long(eid)][long(v)] = data['geometry'][etype][eid][v]
+        self.elem_results = {}
+
+
+def download_metas(cids, api='https://api.openstreetmap.org'):
+    '''Download meta of multiple changesets in one request. The bulk API does not
+       include changeset discussions, so only changesets without comments are
+       returned, with an empty discussion. Returns dict of meta by changeset id'''
+    if not cids:
+        return {}
+    osmapi = OsmApi(api=api)
+    metas = {}
+    for cid, meta in osmapi.ChangesetsGetByIds(cids).iteritems():
+        if int(meta.get('comments_count', 0))==0:
+            meta['discussion'] = []
+            metas[int(cid)] = meta
+    return metas
+
+class RegexCond(object):
+    '''Regex condition of a regex filter, i.e. a field given by key and the regex
+       pattern. The field is resolved into a path of element keys and, for
+       changes, an optional action and element type'''
+    def __init__(self, key, pattern):
+        self.key = key
+        self.pattern = pattern
+        self.rx = re.compile(pattern)
+        self.on_changes = key.startswith('.changes')
+        self.action = None
+        self.elemtype = None
+        path = key.split('.')[1:]
+        if self.on_changes:
+            path = path[1:]
+            if path and path[0] in ['modify', 'create', 'delete']:
+                self.action = path.pop(0)
+            if path and path[0] in ['node', 'way', 'relation']:
+                self.elemtype = path.pop(0)
+        self.path = tuple(path)
+
+# Compiled regex conditions and filters
+regex_conds = {}
+regex_filters = {}
+
+def regex_cond(key, pattern):
+    cond = regex_conds.get((key, pattern), None)
+    if not cond:
+        cond = RegexCond(key, pattern)
+        regex_conds[(key, pattern)] = cond
+    return cond
+
+def compile_regex_filter(regex_filter):
+    '''Compile regex filter (see Changeset.regex_test) into list of lists of
+       conditions. Conditions on changes are last in each list'''
+    key = json.dumps(regex_filter, sort_keys=True)
+    compiled = regex_filters.get(key, None)
+    if compiled is None:
+        compiled = [[regex_cond(k, rf[k]) for k in sorted(rf.keys(), key=lambda k: k.startswith('.changes'))]
+                    for rf in regex_filter]
+        regex_filters[key] = compiled
+    return compiled
+
+class LabelRule(object):
+    '''Label rule compiled for evaluation'''
+    COST_AREA = 0       # Local geometry test
+    COST_META = 1       # Needs changeset meta
+    COST_CHANGES = 2    # Needs changes and element history
+
+    def __init__(self, idx, rule):
+        self.idx = idx      # Position in config
+        self.label = rule['label']
+        self.area = None
+        self.regex = None
+        self.cost = self.COST_AREA
+        if 'area_file' in rule:
+            self.area = (rule['area_check_type'], Changeset.area_file(rule))
+            if rule['area_check_type']=='cset-center':
+                self.cost = self.COST_META
+        if 'regex' in rule:
+            self.regex = compile_regex_filter(rule['regex'])
+            if self.changes_conds():
+                self.cost = self.COST_CHANGES
+            else:
+                self.cost = max(self.cost, self.COST_META)
+
+    def changes_conds(self):
+        if not self.regex:
+            return []
+        return [c for conds in self.regex for c in conds if c.on_changes]
+
+    def evaluate(self, ev):
+        '''Evaluate rule given LabelEvaluation'''
+        if self.area:
+            check_type, area_file = self.area
+            if area_file not in ev.area(check_type):
+                logger.debug('Area test failed: {}'.format(self.area))
+                return False
+            logger.debug('Area test OK: {}'.format(self.area))
+        if self.regex:
+            ev.cset.downloadMeta()
+            if self.cost==self.COST_CHANGES:
+                changes_matched = ev.changes()
+            else:
+                changes_matched = None
+            if not ev.cset.regex_test_compiled(self.regex, changes_matched):
+                logger.debug("Regex test failed for label '{}'".format(self.label))
+                return False
+            logger.debug("Regex test OK for label '{}'".format(self.label))
+        return True
+
+class LabelEvaluation(object):
+    '''Evaluation of label plan on a changeset. Area checks are made with one query
+       per area check type and all conditions on changes are tested in one
+       pass over the changes'''
+    def __init__(self, plan, cset, bbox=None, points_bbox=None):
+        self.plan = plan
+        self.cset = cset
+        self.bbox = bbox
+        self.points_bbox = points_bbox
+        self.area_matched = {}
+        self.changes_matched = None
+
+    def area(self, check_type):
+        if check_type not in self.area_matched:
+            if check_type=='cset-center' and self.cset.meta is None:
+                self.cset.downloadMeta()
+            index = poly.get_index(self.plan.area_files)
+            self.area_matched[check_type] = self.cset.area_matches(check_type, index, self.bbox, self.points_bbox)
+        return self.area_matched[check_type]
+
+    def changes(self):
+        if self.changes_matched is None:
+            self.changes_matched = self.cset.scan_changes(self.plan.changes_conds)
+        return self.changes_matched
+
+class LabelPlan(object):
+    '''Label rules compiled into an evaluation plan. Rules are evaluated in order of
+       cost, i.e. area checks before tests needing changeset meta and tests
+       on changes last. With label filters, evaluation stops when no filter
+       can be satisfied. When a filter can pass, all rules are evaluated such
+       that labels are complete'''
+    def __init__(self, label_rules, label_filters=None):
+        rules = [LabelRule(idx, dd) for idx, dd in enumerate(label_rules) if 'regex' in dd or 'area_file' in dd]
+        self.rules = sorted(rules, key=lambda r: (r.cost, r.idx))
+        self.area_files = [r.area[1] for r in self.rules if r.area]
+        self.changes_conds = list(set([c for r in self.rules for c in r.changes_conds()]))
+        if label_filters is None:
+            self.filters = None
+        else:
+            self.filters = [set(lf) for lf in label_filters]
+        self.timings = None     # Set to a dict to collect rule evaluation times
+
+    def rejected(self, labels, remaining):
+        '''Test if no filter can pass given labels found so far and number of
+           remaining rules per label'''
+        for lf in self.filters:
+            if all([l in labels or remaining.get(l, 0)>0 for l in lf]):
+                return False
+        return True
+
+    def evaluate(self, cset, bbox=None, points_bbox=None):
+        labels = {}     # Label to config position of first matching rule
+        remaining = {}
+        for rule in self.rules:
+            remaining[rule.label] = remaining.get(rule.label, 0)+1
+        if self.filters is not None and self.rejected(labels, remaining):
+            return []
+        ev = LabelEvaluation(self, cset, bbox, points_bbox)
+        for rule in self.rules:
+            remaining[rule.label] -= 1
+            if rule.label in labels and labels[rule.label] < rule.idx:
+                continue # Label already set
+            start = time.time()
+            matched = rule.evaluate(ev)
+            if self.timings is not None:
+                self.timings.setdefault((rule.idx, rule.label), []).append(time.time()-start)
+            if matched:
+                logger.debug("Adding label '{}'".format(rule.label))
+                labels[rule.label] = min(rule.idx, labels.get(rule.label, rule.idx))
+            elif self.filters is not None and self.rejected(labels, remaining):
+                logger.debug('No label filter can pass, labels so far: {}'.format(labels.keys()))
+                break
+        return [l for l, idx in sorted(labels.items(), key=lambda x: x[1])]
+
+# Compiled label plans, keyed by rules and filters
+label_plans = {}
+
+def get_label_plan(label_rules, label_filters=None):
+    key = json.dumps([label_rules, label_filters, os.environ.get('OSMTRACKER_REGION', None)], sort_keys=True)
+    plan = label_plans.get(key, None)
+    if not plan:
+        plan = LabelPlan(label_rules, label_filters)
+        label_plans[key] = plan
+    return plan
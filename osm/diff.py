@@ -1,31 +1,50 @@
-import sys
+import sys, os
 import datetime, pytz
+import tempfile
 import requests
-import gzip
-from StringIO import StringIO
-import xml.etree.ElementTree as etree
+import zlib
+try:
+    import xml.etree.cElementTree as etree
+except ImportError:
+    import xml.etree.ElementTree as etree
 import logging
 import eventlet
+import prometheus_client
 import poly
+import lru
 import yaml
 
 eventlet.monkey_patch()
 
 logger = logging.getLogger(__name__)
 
+m_state_requests = prometheus_client.Counter('osmtracker_replication_state_requests',
+                                             'Replication state lookups',
+                                             ['result'])
+
 class OsmDiffException(Exception):
     pass
 
 class OsmDiffApi(object):
     OSM_TIMESTAMP_FMT = '%Y-%m-%dT%H:%M:%SZ'
     OSM_TIMESTAMP_FMT_CSET = '%Y-%m-%d %H:%M:%S.%f'
+    REPLICATION_PERIOD_S = {'changesets': 60, 'minute': 60, 'hour': 3600, 'day': 86400}
 
-    def __init__(self, api='http://planet.osm.org'):
-        #self.state_cache = {}
-        #self.diff_cache = {}
+    def __init__(self, api='http://planet.osm.org', session=None, state_cache_size=1024,
+                 repl_url=None, mirror=None):
+        # States for a given seqno are immutable, the head state is
+        # re-validated using conditional requests
+        self.state_cache = lru.LRUCache(state_cache_size)
         self.head_state = {}
         self.api = api
         self.netstat = [0,0] # rx, tx bytes
+        # Persistent session, i.e. connections are kept alive between polls
+        if session:
+            self.session = session
+        else:
+            self.session = requests.Session()
+        # Where State and Diff objects get replication files from
+        self.source = {'session': self.session, 'repl_url': repl_url, 'mirror': mirror}
         
         # Non-simple below
         #self.update_head_state()
@@ -44,54 +63,98 @@ class OsmDiffApi(object):
 
     def get_state(self, stype, seqno=None):
         """ Get most recent state object of a given type (changeset, day, hour or minute) """
-        #if seqno==None and self.head_state.has_key(stype):
-        #    return self.head_state[stype]
-        #if seqno and self.state_cache.has_key(stype+str(seqno)):
-        #    logger.debug("Getting cached state '"+stype+"' sequenceNo "+str(seqno)+" from cache")
-        #    return self.state_cache[stype+str(seqno)]
-        state = State(stype=stype, autoload=False, seqno=seqno)
+        if seqno is not None:
+            state = self.state_cache.get((stype, seqno))
+            if state:
+                m_state_requests.labels('hit').inc()
+                return state.copy()
+            m_state_requests.labels('miss').inc()
+        state = State(stype=stype, autoload=False, seqno=seqno, **self.source)
         logger.debug("### Retrieving '"+stype+"' state, seqno "+str(state.sequenceno))
-        state.load_state()
-        #self.state_cache[stype+str(state.sequenceno)] = state
+        if seqno is None:
+            prev = self.head_state.get(stype, None)
+            if state.load_state(conditional=prev):
+                m_state_requests.labels('modified').inc()
+            else:
+                # Unmodified state is refreshed from prev, e.g. 'retrieved'
+                logger.debug('Head state not modified: {}'.format(prev))
+                m_state_requests.labels('not_modified').inc()
+            self.head_state[stype] = state
+        else:
+            state.load_state()
+            self.state_cache.put((stype, seqno), state)
         logger.debug("Loaded state: "+str(state))
-        return state
+        return state.copy()
 
     def get_diff_from_state(self, state):
         return self.get_diff(state.sequenceno, state.type)
 
     def get_diff(self, seqno, type):
-        diff = Diff(seqno, type)
+        diff = Diff(seqno, type, **self.source)
         csets = diff.get_csets()
         return csets
 
     def get_cset_diff(self, seqno):
-        diff = Diff(seqno, 'changesets')
+        diff = Diff(seqno, 'changesets', **self.source)
         csets = diff.get_cset_diff()
         return csets
 
+    def iter_cset_diff(self, seqno):
+        '''Generator version of get_cset_diff(), yielding changesets while the diff is
+           being downloaded'''
+        diff = Diff(seqno, 'changesets', **self.source)
+        return diff.iter_cset_diff()
+
     def get_seqno_le_timestamp(self, type, timestamp, start, max_iter=None):
         """Get state object that has timestamp less than or equal to supplied
-           timestamp. Searching back from supplied start object"""
-        ptr = start
-        seqno = ptr.sequenceno
-        if type=='minute':
-            now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
-            secs = (now-timestamp).total_seconds()
-            if secs > 10:
-                skip = int((now-timestamp).total_seconds()/60)
-                seqno -= skip
-                ptr = self.get_state(type, seqno)
-                logger.debug('Skipping {} sequence numbers, now={}, search timestamp={}, new ptr timestamp={}'.format(skip, now, timestamp, ptr.timestamp()))
+           timestamp. Searching back from supplied start object. States are
+           located by alternating interpolation and bisection steps, i.e. the
+           number of state files fetched is logarithmic in the distance to
+           start"""
+        states = {start.sequenceno: start}
+        def state(seqno):
+            if seqno not in states:
+                states[seqno] = self.get_state(type, seqno)
+            return states[seqno]
+
+        if start.timestamp() <= timestamp:
+            return start
         if max_iter:
-            iter = seqno-max_iter
+            floor = max(start.sequenceno-max_iter, 0)
         else:
-            iter = seqno+1 # Infinite
-        while ptr.timestamp() > timestamp and ptr.sequenceno != iter and seqno > 0:
-            seqno -= 1
-            ptr = self.get_state(type, seqno)
-        if ptr.timestamp() > timestamp:
-            return None
-        return ptr
+            floor = 0
+
+        # Step back until we have a lower bound, first step is the expected
+        # distance given the nominal replication period
+        hi = start.sequenceno
+        step = max(1, int((start.timestamp()-timestamp).total_seconds()/self.REPLICATION_PERIOD_S[type]))
+        while True:
+            lo = max(hi-step, floor)
+            if state(lo).timestamp() <= timestamp:
+                break
+            if lo == floor:
+                return None
+            logger.debug('Seqno {} newer than {}, stepping back {}'.format(lo, timestamp, step))
+            hi = lo
+            step *= 2
+
+        # Invariant: state(lo) <= timestamp < state(hi)
+        interpolate = True
+        while hi-lo > 1:
+            if interpolate:
+                lo_ts = state(lo).timestamp()
+                hi_ts = state(hi).timestamp()
+                frac = (timestamp-lo_ts).total_seconds()/(hi_ts-lo_ts).total_seconds()
+                mid = min(max(lo+int(frac*(hi-lo)), lo+1), hi-1)
+            else:
+                mid = (lo+hi)/2
+            interpolate = not interpolate
+            if state(mid).timestamp() <= timestamp:
+                lo = mid
+            else:
+                hi = mid
+        logger.debug('Found seqno {} for timestamp {} using {} state fetches'.format(lo, timestamp, len(states)-1))
+        return state(lo)
 
     @staticmethod
     def timetxt2datetime(ts):
@@ -99,11 +162,130 @@ class OsmDiffApi(object):
             return ts
         return datetime.datetime.strptime(ts, OsmDiffApi.OSM_TIMESTAMP_FMT).replace(tzinfo=pytz.utc)
 
+class PointsBBoxIndex(object):
+    '''Bounding boxes of node coordinates per changeset, joined from minutely
+       osmChange diffs. The most recently changed changesets are kept'''
+    def __init__(self, dapi, stype='minute', maxsize=100000):
+        self.dapi = dapi
+        self.stype = stype
+        self.bboxes = lru.LRUCache(maxsize)
+        self.seqno = None   # Most recently merged diff
+
+    def get(self, cid):
+        return self.bboxes.get(cid)
+
+    def merge(self, csets):
+        for cid, cset in csets.iteritems():
+            bbox = self.bboxes.get(cid)
+            if bbox is None:
+                bbox = poly.BBox()
+                self.bboxes.put(cid, bbox)
+            bbox.merge(cset['points_bbox'])
+
+    def seek(self, timestamp, max_iter=None):
+        '''Position index such that next merged diff is the first diff later than timestamp'''
+        head = self.dapi.get_state(self.stype)
+        state = self.dapi.get_seqno_le_timestamp(self.stype, timestamp, head, max_iter)
+        if state:
+            self.seqno = state.sequenceno
+        else:
+            self.seqno = None
+        logger.debug('Points bbox index at seqno {} for timestamp {}'.format(self.seqno, timestamp))
+
+    def update(self, until=None):
+        '''Merge diffs up to replication head, or only up to the last diff not later
+           than until. Returns number of diffs merged'''
+        head = self.dapi.get_state(self.stype)
+        if self.seqno is None:
+            self.seqno = head.sequenceno-1
+        merged = 0
+        while self.seqno < head.sequenceno:
+            seqno = self.seqno+1
+            if until and self.dapi.get_state(self.stype, seqno).timestamp() > until:
+                break
+            self.merge(self.dapi.get_diff(seqno, self.stype))
+            self.seqno = seqno
+            merged += 1
+        logger.debug('Merged {} diffs into points bbox index, now at seqno {}, {} changesets'.format(merged, self.seqno, len(self.bboxes)))
+        return merged
+
+class LocalResponse(object):
+    '''Response-like object for replication files on the local filesystem'''
+    def __init__(self, fname):
+        self.fname = fname
+        self.headers = {}
+        if os.path.isfile(fname):
+            self.status_code = 200
+            self.text = ''
+        else:
+            self.status_code = 404
+            self.text = 'File {} not found'.format(fname)
+
+    @property
+    def content(self):
+        with open(self.fname, 'rb') as f:
+            return f.read()
+
+    def iter_content(self, chunk_size=1):
+        with open(self.fname, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+class MirrorWriter(object):
+    '''Store replication file in local mirror. File is written to a temporary file
+       and renamed when complete, i.e. partial files never appear in the mirror'''
+    def __init__(self, fname):
+        self.fname = fname
+        dname = os.path.dirname(fname)
+        if not os.path.isdir(dname):
+            try:
+                os.makedirs(dname)
+            except OSError:
+                if not os.path.isdir(dname): # Created concurrently
+                    raise
+        fd, self.tmpname = tempfile.mkstemp(dir=dname, prefix='.tmp-')
+        self.f = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self.f.write(data)
+
+    def commit(self):
+        self.f.close()
+        os.rename(self.tmpname, self.fname)
+        logger.debug('Stored {} in mirror'.format(self.fname))
+
+    def abort(self):
+        self.f.close()
+        os.remove(self.tmpname)
+
+    def tee(self, chunks):
+        try:
+            for chunk in chunks:
+                self.write(chunk)
+                yield chunk
+        except BaseException:
+            self.abort()
+            raise
+        self.commit()
+
 class Base(object):
     repl_url = 'http://planet.osm.org/replication/'
 
-    def __init__(self, type=None):
+    def __init__(self, type=None, session=None, repl_url=None, mirror=None):
         self.state = {}
+        if session:
+            self.http = session
+        else:
+            self.http = requests
+        if repl_url:
+            if not repl_url.endswith('/'):
+                repl_url += '/'
+            self.repl_url = repl_url
+        # Local directory with same layout as 'replication/'
+        self.mirror = mirror
         if type == None:
             self.type = 'minute'
         else:
@@ -119,6 +301,28 @@ class Base(object):
             self.state_txt_kv_split = '='
             self.state_txt_ts_fmt = OsmDiffApi.OSM_TIMESTAMP_FMT
 
+    def _get(self, path, immutable=True, **kwargs):
+        '''Get replication file given path relative to replication root. Immutable
+           files are read from the local mirror if present there'''
+        if self.mirror:
+            fname = os.path.join(self.mirror, path)
+            if immutable and os.path.isfile(fname):
+                logger.debug('Reading {} from mirror'.format(fname))
+                return LocalResponse(fname)
+        url = self.repl_url+path
+        if url.startswith('file://'):
+            resp = LocalResponse(url[len('file://'):])
+        else:
+            resp = self.http.get(url, **kwargs)
+        if self.mirror and resp.status_code==200:
+            writer = MirrorWriter(fname)
+            if kwargs.get('stream', False):
+                resp.iter_content = lambda chunk_size=1, chunks=resp.iter_content: writer.tee(chunks(chunk_size))
+            else:
+                writer.write(resp.content)
+                writer.commit()
+        return resp
+
     def _path_frag(self):
         seqno = self.sequenceno
         a = seqno/1000000
@@ -154,84 +358,137 @@ class Base(object):
         if self.autoload:
             self.load_state()
 
+class GzipStream(object):
+    '''File-like object which decompresses a gzip'ed HTTP body as it is being
+       received, i.e. without holding the full (compressed or uncompressed)
+       body in memory'''
+    def __init__(self, chunks, timeout=None):
+        self.chunks = iter(chunks)
+        self.timeout = timeout
+        self.decomp = zlib.decompressobj(16+zlib.MAX_WBITS)
+        self.buf = b''
+        self.eof = False
+        self.rx_bytes = 0
+
+    def _fill(self):
+        try:
+            # Timeout applies per chunk, i.e. a stalled transfer
+            with eventlet.Timeout(self.timeout):
+                chunk = next(self.chunks)
+        except StopIteration:
+            self.buf += self.decomp.flush()
+            self.eof = True
+            return
+        self.rx_bytes += len(chunk)
+        self.buf += self.decomp.decompress(chunk)
+
+    def read(self, size=-1):
+        while not self.eof and (size<0 or len(self.buf)<size):
+            self._fill()
+        if size<0:
+            size = len(self.buf)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
 class Diff(Base):
     """OSM diff class"""
-    def __init__(self, seqno, type=None):
-        Base.__init__(self, type)
+    CHUNK_SIZE = 64*1024
+
+    def __init__(self, seqno, type=None, session=None, repl_url=None, mirror=None):
+        Base.__init__(self, type, session, repl_url, mirror)
         self.state['sequenceNumber'] = seqno
         self.data = ''
 
+    def _data_path(self):
+        return self.type+'/'+self._path_frag()+self.filetype
+
     def _data_url(self):
-        return self.repl_url+'/'+self.type+'/'+self._path_frag()+self.filetype
+        return self.repl_url+self._data_path()
 
-    def get_csets(self, timeout=50):
-        '''Fetch and parse diff to fetch changeset. More memory efficient than get()'''
-        csets = {}
+    def _open(self, timeout):
+        '''Open diff for streaming, returns decompressing file-like object'''
         url = self._data_url()
         logger.debug('Fetching url {}'.format(url))
         with eventlet.Timeout(timeout):
-            req = requests.get(url)
+            req = self._get(self._data_path(), stream=True)
             if req.status_code!=200:
-                raise OsmDiffException('Error fetching URL {}: {}:{}'.format(url,r.status_code,r.text))
-            resp = req.content
-            dfile = gzip.GzipFile(fileobj=StringIO(resp))
-        logging.debug('Parsing diff {}, url {} (logger {})'.format(self.sequenceno, url, logger))
+                raise OsmDiffException('Error fetching URL {}: {}:{}'.format(url,req.status_code,req.text))
+        return GzipStream(req.iter_content(self.CHUNK_SIZE), timeout)
+
+    def _iterparse(self, dfile, tags):
+        '''Incrementally parse XML, yielding elements with a tag in 'tags'. Elements
+           are dropped from the tree once processed, i.e. memory use is bounded
+           by the size of a single element'''
+        stack = []
+        for event, element in etree.iterparse(dfile, events=('start', 'end')):
+            if event == 'start':
+                stack.append(element)
+                continue
+            stack.pop()
+            if element.tag in tags:
+                yield element
+                if stack:
+                    # Element is always the most recently added child of its parent
+                    del stack[-1][-1]
+
+    def get_csets(self, timeout=50):
+        '''Fetch and parse diff to fetch changeset. More memory efficient than get()'''
+        csets = {}
+        dfile = self._open(timeout)
+        logger.debug('Parsing diff {}'.format(self.sequenceno))
         now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
-        for event, element in etree.iterparse(dfile):
-            if element.tag == 'node':
+        for element in self._iterparse(dfile, ['node', 'way', 'relation']):
+            if element.tag == 'node' and 'lat' in element.attrib:
                 lat = float(element.attrib['lat'])
                 lon = float(element.attrib['lon'])
             else:
                 lat, lon = None, None
-            if element.tag in ['node', 'way', 'relation']:
-                cid = int(element.attrib['changesets'])
-                if cid in csets:
-                    if lat and lon:
-                        csets[cid]['points_bbox'].add_point(lon, lat)
-                else:
-                    if lat and lon:
-                        bbox = poly.BBox(lon, lat)
-                    else:
-                        bbox = poly.BBox()
-                    csets[cid] = {'cid': cid,
-                                  'source': {'type': self.type,
-                                             'sequenceno': self.sequenceno,
-                                             'observed': now},
-                                  'points_bbox': bbox}
-        return csets
-
-    def get_cset_diff(self, timeout=50):
-        '''Fetch and parse changeset diff'''
-        csets = {}
-        url = self._data_url()
-        logger.debug('Fetching url {}'.format(url))
-        with eventlet.Timeout(timeout):
-            req = requests.get(url)
-            if req.status_code!=200:
-                raise OsmDiffException('Error fetching URL: {}:{}'.format(req.status_code,req.text,url))
-            resp = req.content
-            dfile = gzip.GzipFile(fileobj=StringIO(resp))
-        logging.debug('Parsing diff {}, url {} (logger {})'.format(self.sequenceno, url, logger))
-        now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
-        for event, element in etree.iterparse(dfile):
-            if element.tag == 'changeset':
-                cid = int(element.attrib['id'])
-                if 'min_lon' in element.attrib:
-                    bbox = poly.BBox(float(element.attrib['min_lon']),
-                                     float(element.attrib['min_lat']),
-                                     float(element.attrib['max_lon']),
-                                     float(element.attrib['max_lat']))
+            cid = int(element.attrib['changeset'])
+            if cid in csets:
+                if lat and lon:
+                    csets[cid]['points_bbox'].add_point(lon, lat)
+            else:
+                if lat and lon:
+                    bbox = poly.BBox(lon, lat)
                 else:
                     bbox = poly.BBox()
                 csets[cid] = {'cid': cid,
-                              'uid': int(element.attrib['uid']),
-                              'user': element.attrib['user'],
-                              'open': element.attrib['open'],
-                              'comments_count': int(element.attrib['comments_count']),
                               'source': {'type': self.type,
                                          'sequenceno': self.sequenceno,
                                          'observed': now},
-                              'bbox': bbox}
+                              'points_bbox': bbox}
+        return csets
+
+    def iter_cset_diff(self, timeout=50):
+        '''Fetch and parse changeset diff, yielding changesets as they are parsed.
+           Timeout applies to connecting and to each received chunk'''
+        dfile = self._open(timeout)
+        logger.debug('Parsing diff {}'.format(self.sequenceno))
+        now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        for element in self._iterparse(dfile, ['changeset']):
+            cid = int(element.attrib['id'])
+            if 'min_lon' in element.attrib:
+                bbox = poly.BBox(float(element.attrib['min_lon']),
+                                 float(element.attrib['min_lat']),
+                                 float(element.attrib['max_lon']),
+                                 float(element.attrib['max_lat']))
+            else:
+                bbox = poly.BBox()
+            yield {'cid': cid,
+                   'uid': int(element.attrib['uid']),
+                   'user': element.attrib['user'],
+                   'open': element.attrib['open'],
+                   'comments_count': int(element.attrib['comments_count']),
+                   'source': {'type': self.type,
+                              'sequenceno': self.sequenceno,
+                              'observed': now},
+                   'bbox': bbox}
+
+    def get_cset_diff(self, timeout=50):
+        '''Fetch and parse changeset diff'''
+        csets = {}
+        for cset in self.iter_cset_diff(timeout):
+            csets[cset['cid']] = cset
         return csets
 
     def get_data(self):
@@ -239,10 +496,13 @@ class Diff(Base):
 
 class State(Base):
     """OSM replication state"""
-    def __init__(self, stype=None, autoload=True, seqno=None):
-        Base.__init__(self, stype)
+    def __init__(self, stype=None, autoload=True, seqno=None, session=None, repl_url=None, mirror=None):
+        Base.__init__(self, stype, session, repl_url, mirror)
         self.sequenceno = seqno
         self.autoload = autoload
+        # HTTP cache validators from the response the state was loaded from
+        self.etag = None
+        self.last_modified = None
         if autoload:
             self.load_state()
 
@@ -254,33 +514,70 @@ class State(Base):
         else:
             return self.type+'ly, sequenceNo:'+str(self.sequenceno)+', timestamp:'+self.timestamp_str()
 
-    def _state_url(self):
+    def copy(self):
+        st = State(self.type, autoload=False, session=self.http, repl_url=self.repl_url, mirror=self.mirror)
+        st.state = dict(self.state)
+        st.etag = self.etag
+        st.last_modified = self.last_modified
+        return st
+
+    def _state_path(self):
         postfix = 'txt'
         if self.sequenceno==None:
             if self.type == 'changesets':
                 postfix = 'yaml'
-            return self.repl_url+self.type+'/state.'+postfix
+            return self.type+'/state.'+postfix
         else:
-            return self.repl_url+self.type+'/'+self._path_frag()+'.state.'+postfix
+            return self.type+'/'+self._path_frag()+'.state.'+postfix
 
-    def load_state(self, timeout=10):
+    def _state_url(self):
+        return self.repl_url+self._state_path()
+
+    def _fetch(self, url, timeout, conditional=None):
+        '''Fetch state file. If a previously loaded state is given as 'conditional',
+           a conditional request is made and None returned if the state file has
+           not been modified'''
+        headers = {}
+        if conditional:
+            if conditional.etag:
+                headers['If-None-Match'] = conditional.etag
+            if conditional.last_modified:
+                headers['If-Modified-Since'] = conditional.last_modified
+        with eventlet.Timeout(timeout):
+            # Head state changes, i.e. never read from mirror
+            req = self._get(self._state_path(), immutable=self.sequenceno is not None, headers=headers)
+            if req.status_code==304 and conditional:
+                return None
+            if req.status_code!=200:
+                raise OsmDiffException('Error fetching URL {}: {}:{}'.format(url,req.status_code,req.text))
+            resp = req.content
+        self.etag = req.headers.get('ETag', None)
+        self.last_modified = req.headers.get('Last-Modified', None)
+        return resp
+
+    def _not_modified(self, conditional):
+        self.state = dict(conditional.state)
+        self.state['retrieved'] = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        self.etag = conditional.etag
+        self.last_modified = conditional.last_modified
+        return False
+
+    def load_state(self, timeout=10, conditional=None):
+        '''Load state, returns False if conditional request found state unmodified'''
         if self.type == 'changesets' and self.sequenceno==None:
-            return self.load_state_yaml(timeout)
+            return self.load_state_yaml(timeout, conditional)
         else:
-            return self.load_state_txt(timeout)
+            return self.load_state_txt(timeout, conditional)
 
-    def load_state_yaml(self, timeout=10):
+    def load_state_yaml(self, timeout=10, conditional=None):
         url = self._state_url()
-        state = {}
-        state['state url'] = url
         now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
-        state['retrieved'] = now
-        with eventlet.Timeout(timeout):
-            req = requests.get(url)
-            if req.status_code!=200:
-                raise OsmDiffException('Error fetching URL {}: {}:{}'.format(url,req.status_code,req.text))
-            resp = req.content
+        resp = self._fetch(url, timeout, conditional)
+        if resp is None:
+            return self._not_modified(conditional)
         state = yaml.load(resp)
+        state['state url'] = url
+        state['retrieved'] = now
         if 'last_run' in state:
             state['timestamp'] = state['last_run'].isoformat()
             state['timestamp_dt'] = self.timetxt2datetime(state['last_run'])
@@ -290,18 +587,17 @@ class State(Base):
         state['sequenceNumber'] = state['sequence']
         del state['sequence']
         self.state = state
+        return True
 
-    def load_state_txt(self, timeout=10):
+    def load_state_txt(self, timeout=10, conditional=None):
         url = self._state_url()
         state = {}
         state['state url'] = url
         now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
         state['retrieved'] = now
-        with eventlet.Timeout(timeout):
-            req = requests.get(url)
-            if req.status_code!=200:
-                raise OsmDiffException('Error fetching URL {}: {}:{}'.format(url,req.status_code,req.text))
-            resp = req.content
+        resp = self._fetch(url, timeout, conditional)
+        if resp is None:
+            return self._not_modified(conditional)
         for line in resp.splitlines():
             if len(line.split(self.state_txt_kv_split)) >= 2:
                 k, v = line.split(self.state_txt_kv_split, 1)
@@ -319,4 +615,9 @@ class State(Base):
         needed_keys = self.state_keys['txt']
         if not set(needed_keys).issubset(state):
             raise OsmDiffException('Missing keys in state file, have {}, expected {}'.format(state.keys(), needed_keys))
+        if 'sequence' in state:
+            # Changeset replication state
+            state['sequenceNumber'] = state['sequence']
+            del state['sequence']
         self.state = state
+        return True
@@ -0,0 +1,81 @@
+import copy
+import logging
+import prometheus_client
+import lru
+
+logger = logging.getLogger(__name__)
+
+m_element_lookups = prometheus_client.Counter('osmtracker_element_store_lookups',
+                                              'Element version store lookups',
+                                              ['result'])
+
+class ElementStore(object):
+    '''Store of element versions shared between changesets. Element versions are
+       immutable, i.e. a version downloaded for one changeset can be used for
+       all later changesets. Versions are kept in an in-process LRU cache,
+       optionally backed by a persistent store with methods
+       elements_get(etype, refs) and elements_put(etype, elems), e.g. the
+       database'''
+
+    def __init__(self, maxsize=20000, backend=None):
+        self.cache = lru.LRUCache(maxsize)
+        self.backend = backend
+
+    def get(self, etype, eid, version):
+        '''Get copy of element version or None if not in store'''
+        return self.get_many(etype, [(eid, version)]).get((eid, version), None)
+
+    def get_many(self, etype, refs):
+        '''Get copies of element versions given as list of (id, version). Returns
+           dict keyed by (id, version) of the versions in store. Versions not
+           cached are looked up in the backend in one request'''
+        elems = {}
+        missing = []
+        for eid, version in refs:
+            elem = self.cache.get((etype, eid, version))
+            if elem is None:
+                missing.append((eid, version))
+            else:
+                m_element_lookups.labels('hit').inc()
+                elems[(eid, version)] = copy.deepcopy(elem)
+        if missing and self.backend:
+            try:
+                found = self.backend.elements_get(etype, missing)
+            except Exception as e:
+                logger.warning('Element store backend lookup failed: {}'.format(e))
+                found = {}
+            for (eid, version), elem in found.items():
+                m_element_lookups.labels('backend_hit').inc()
+                self.cache.put((etype, eid, version), elem)
+                elems[(eid, version)] = copy.deepcopy(elem)
+            missing = [ref for ref in missing if ref not in found]
+        if missing:
+            m_element_lookups.labels('miss').inc(len(missing))
+        return elems
+
+    def put(self, etype, elem):
+        '''Add downloaded element version to store'''
+        self.put_many(etype, [elem])
+
+    def put_many(self, etype, elems):
+        '''Add downloaded element versions to store, new versions are written to
+           the backend in one request'''
+        new = []
+        for elem in elems:
+            key = (etype, elem['id'], elem['version'])
+            if key in self.cache:
+                continue
+            self.cache.put(key, copy.deepcopy(elem))
+            new.append(elem)
+        if new and self.backend:
+            try:
+                self.backend.elements_put(etype, new)
+            except Exception as e:
+                logger.warning('Element store backend update failed: {}'.format(e))
+
+    def put_history(self, etype, hist):
+        '''Add versions from element history, i.e. dict keyed by version'''
+        self.put_many(etype, hist.values())
+
+    def __len__(self):
+        return len(self.cache)
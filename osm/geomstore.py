@@ -0,0 +1,305 @@
+import array
+import calendar
+import collections
+import datetime
+
+# Python 2 arrays have no 'q' type, 'l' is 64 bit on LP64 platforms
+INT_TYPECODE = 'l'
+INT_MAX = 2**(8*array.array(INT_TYPECODE).itemsize-1)
+
+# Marks element fields not present on an element version
+ABSENT = object()
+
+class IntColumn(object):
+    '''Column of integer field values in an array. Values which do not fit the
+       column are kept by the store as extras'''
+    typecode = INT_TYPECODE
+    placeholder = 0
+
+    def __init__(self):
+        self.values = array.array(self.typecode)
+
+    def fits(self, v):
+        return type(v) in (int, long) and -INT_MAX <= v < INT_MAX
+
+    def encode(self, v):
+        return v
+
+    def decode(self, x):
+        return x
+
+    def append(self, v):
+        if self.fits(v):
+            self.values.append(self.encode(v))
+            return True
+        self.values.append(self.placeholder)
+        return False
+
+    def get(self, slot):
+        return self.decode(self.values[slot])
+
+class FloatColumn(IntColumn):
+    typecode = 'd'
+    placeholder = 0.0
+
+    def fits(self, v):
+        return type(v) is float
+
+class BoolColumn(IntColumn):
+    typecode = 'b'
+
+    def fits(self, v):
+        return type(v) is bool
+
+    def decode(self, x):
+        return bool(x)
+
+class TimeColumn(IntColumn):
+    '''Naive UTC datetimes as microseconds since epoch'''
+    EPOCH = datetime.datetime(1970, 1, 1)
+
+    def fits(self, v):
+        return type(v) is datetime.datetime and v.tzinfo is None
+
+    def encode(self, v):
+        return calendar.timegm(v.utctimetuple())*1000000+v.microsecond
+
+    def decode(self, x):
+        return self.EPOCH+datetime.timedelta(microseconds=x)
+
+class StringColumn(IntColumn):
+    '''Strings shared between element versions, e.g. user names, stored as index
+       into list of unique strings'''
+    def __init__(self):
+        super(StringColumn, self).__init__()
+        self.strings = []
+        self.index = {}
+
+    def fits(self, v):
+        return isinstance(v, basestring)
+
+    def encode(self, v):
+        # Keyed by type too, str and unicode compare equal
+        key = (type(v), v)
+        idx = self.index.get(key, None)
+        if idx is None:
+            idx = len(self.strings)
+            self.strings.append(v)
+            self.index[key] = idx
+        return idx
+
+    def decode(self, x):
+        return self.strings[x]
+
+class TagColumn(object):
+    '''Tags, only stored for element versions with tags'''
+
+    def __init__(self):
+        self.values = {}
+        self.size = 0
+
+    def append(self, v):
+        slot = self.size
+        self.size += 1
+        if type(v) is not dict:
+            return False
+        if v:
+            self.values[slot] = dict(v)
+        return True
+
+    def get(self, slot):
+        return dict(self.values.get(slot, {}))
+
+class RefsColumn(object):
+    '''Way node references as one array per element version'''
+
+    def __init__(self):
+        self.values = []
+
+    def append(self, v):
+        if type(v) is list and all(type(r) in (int, long) and -INT_MAX <= r < INT_MAX for r in v):
+            self.values.append(array.array(INT_TYPECODE, v))
+            return True
+        self.values.append(None)
+        return False
+
+    def get(self, slot):
+        return self.values[slot].tolist()
+
+class MembersColumn(object):
+    '''Relation members as tuples of (type, ref, role)'''
+    KEYS = set(['type', 'ref', 'role'])
+
+    def __init__(self):
+        self.values = []
+
+    def append(self, v):
+        if type(v) is list and all(type(m) is dict and set(m.keys())==self.KEYS for m in v):
+            self.values.append(tuple((m['type'], m['ref'], m['role']) for m in v))
+            return True
+        self.values.append(None)
+        return False
+
+    def get(self, slot):
+        return [{'type': t, 'ref': r, 'role': role} for t, r, role in self.values[slot]]
+
+class Versions(collections.MutableMapping):
+    '''Versions of one element in a store, i.e. mapping of version to element.
+       Elements are built from the store on access, changing a returned element
+       does not change the store'''
+    __slots__ = ('store', 'eid')
+
+    def __init__(self, store, eid):
+        self.store = store
+        self.eid = eid
+
+    def __getitem__(self, version):
+        return self.store.element(self.store.slots(self.eid)[version])
+
+    def __setitem__(self, version, elem):
+        self.store.put(self.eid, version, elem)
+
+    def __delitem__(self, version):
+        slots = self.store.slots(self.eid)
+        del slots[version]
+        self.store.index[self.eid] = slots
+
+    def __contains__(self, version):
+        return version in self.store.slots(self.eid)
+
+    def __iter__(self):
+        return iter(self.store.slots(self.eid))
+
+    def __len__(self):
+        return len(self.store.slots(self.eid))
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+class GeometryStore(collections.MutableMapping):
+    '''Compact history of elements of one type, i.e. mapping of element id to
+       mapping of version to element like the dicts returned by osmapi.
+       Element fields are stored in columns, one slot per element version.
+       Fields not fitting a column, e.g. string timestamps of imported data,
+       are kept as extras. Replaced versions are not reclaimed'''
+    FIELDS = [('id', IntColumn), ('version', IntColumn), ('changeset', IntColumn),
+              ('uid', IntColumn), ('user', StringColumn), ('timestamp', TimeColumn),
+              ('visible', BoolColumn), ('tag', TagColumn)]
+
+    def __init__(self):
+        self.columns = [(name, cls()) for name, cls in self.FIELDS]
+        self.names = set(name for name, _ in self.FIELDS)
+        self.column = dict(self.columns)
+        self.version_column = self.column['version']
+        # Slot to dict of fields not stored in columns
+        self.extras = {}
+        # Element id to slot if element has a single version stored in the
+        # version column, otherwise dict of version to slot
+        self.index = {}
+        self.size = 0
+
+    def put(self, eid, version, elem):
+        slot = self.size
+        self.size += 1
+        extras = {}
+        for name, col in self.columns:
+            v = elem.get(name, ABSENT)
+            if not col.append(v):
+                extras[name] = v
+        for k, v in elem.iteritems():
+            if k not in self.names:
+                extras[k] = v
+        if extras:
+            self.extras[slot] = extras
+        slots = self.index.get(eid, None)
+        if (slots is None or slots == {}) and 'version' not in extras and self.version_column.get(slot)==version:
+            self.index[eid] = slot
+        else:
+            slots = self.slots(eid) if eid in self.index else {}
+            slots[version] = slot
+            self.index[eid] = slots
+
+    def slots(self, eid):
+        '''Dict of version to slot of element'''
+        slots = self.index[eid]
+        if isinstance(slots, dict):
+            return slots
+        return {self.version_column.get(slots): slots}
+
+    def element(self, slot):
+        extras = self.extras.get(slot, {})
+        elem = {}
+        for name, col in self.columns:
+            if name not in extras:
+                elem[name] = col.get(slot)
+        for k, v in extras.iteritems():
+            if v is not ABSENT:
+                elem[k] = v
+        return elem
+
+    def setdefault(self, eid, default=None):
+        if eid not in self.index:
+            self[eid] = default or {}
+        return self[eid]
+
+    def __getitem__(self, eid):
+        if eid not in self.index:
+            raise KeyError(eid)
+        return Versions(self, eid)
+
+    def __setitem__(self, eid, hist):
+        items = list(hist.items())
+        self.index[eid] = {}
+        for version, elem in items:
+            self.put(eid, version, elem)
+
+    def __delitem__(self, eid):
+        del self.index[eid]
+
+    def __contains__(self, eid):
+        return eid in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+class NodeStore(GeometryStore):
+    FIELDS = GeometryStore.FIELDS+[('lat', FloatColumn), ('lon', FloatColumn)]
+
+    def position(self, slot):
+        '''(lon, lat) of visible node version read directly from columns, None if
+           the node version is not visible or not stored in columns'''
+        extras = self.extras.get(slot, None)
+        if extras and ('lat' in extras or 'lon' in extras or 'visible' in extras):
+            return None
+        if not self.column['visible'].values[slot]:
+            return None
+        return (self.column['lon'].values[slot], self.column['lat'].values[slot])
+
+    def position_at(self, nid, version):
+        '''(lon, lat) of node version, negative versions count from the newest
+           stored version as for Changeset.old(). None if the node is not stored
+           or the position is not available from columns, see position()'''
+        slots = self.index.get(nid, None)
+        if slots is None or slots == {}:
+            return None
+        slots = self.slots(nid)
+        if version < 0:
+            ks = sorted(slots.keys())
+            version = ks[0] if abs(version)>len(ks) else ks[version]
+        slot = slots.get(version, None)
+        if slot is None:
+            return None
+        return self.position(slot)
+
+class WayStore(GeometryStore):
+    FIELDS = GeometryStore.FIELDS+[('nd', RefsColumn)]
+
+class RelationStore(GeometryStore):
+    FIELDS = GeometryStore.FIELDS+[('member', MembersColumn)]
+
+def new_history():
+    '''Empty element history for a changeset, keyed by element type'''
+    return {'node': NodeStore(), 'way': WayStore(), 'relation': RelationStore()}
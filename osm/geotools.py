@@ -1,4 +1,5 @@
 import math
+import numpy
 
 # https://en.wikipedia.org/wiki/Earth_radius
 EARTH_RADIUS_M=(6384+6353)/2*1000
@@ -12,3 +13,25 @@ def haversine(lon1, lat1, lon2, lat2):
     dlat = lat2 - lat1 
     a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
     return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+def way_lengths(lons, lats, starts):
+    '''Lengths in meters of multiple ways in one vectorized computation. Node
+       coordinates of all ways are concatenated, with way i consisting of the
+       nodes from starts[i] up to starts[i+1]. Returns list of floats'''
+    lons = numpy.radians(numpy.asarray(lons, dtype=float))
+    lats = numpy.radians(numpy.asarray(lats, dtype=float))
+    starts = numpy.asarray(starts, dtype=int)
+    ends = numpy.append(starts[1:], len(lons)).astype(int)
+    lengths = numpy.zeros(len(starts))
+    if len(lons) < 2:
+        return lengths.tolist()
+    dlon = numpy.diff(lons)
+    dlat = numpy.diff(lats)
+    a = numpy.sin(dlat/2)**2 + numpy.cos(lats[:-1]) * numpy.cos(lats[1:]) * numpy.sin(dlon/2)**2
+    # Segment i joins node i and i+1, no segment from the last node of a way
+    seg = numpy.append(2 * EARTH_RADIUS_M * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0))), 0.0)
+    nonempty = ends > starts
+    seg[ends[nonempty]-1] = 0.0
+    if nonempty.any():
+        lengths[nonempty] = numpy.add.reduceat(seg, starts[nonempty])
+    return lengths.tolist()
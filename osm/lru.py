@@ -0,0 +1,30 @@
+import collections
+
+class LRUCache(object):
+    '''Bounded dict-like cache, evicting the least recently used entry'''
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        if key not in self.data:
+            return default
+        val = self.data.pop(key)
+        self.data[key] = val
+        return val
+
+    def put(self, key, val):
+        if key in self.data:
+            del self.data[key]
+        elif len(self.data) >= self.maxsize:
+            self.data.popitem(last=False)
+        self.data[key] = val
+
+    def clear(self):
+        self.data.clear()
@@ -102,6 +102,23 @@ class OsmApi(osmapi.OsmApi):
     def ChangesetsGet(self, *args, **kwargs):
         return self._doop('ChangesetsGet', *args, **kwargs)
 
+    def ChangesetsGetByIds(self, ChangesetIds):
+        """
+        Returns a dict with the id of the changeset as key for the
+        changesets given by list `ChangesetIds`, fetched in one request.
+        Changeset discussions are not included.
+        """
+        m_events.labels('ChangesetsGetByIds').inc()
+        self.operation = 'ChangesetsGetByIds'
+        uri = '/api/0.6/changesets?changesets='+','.join([str(cid) for cid in ChangesetIds])
+        data = self._get(uri)
+        self.operation = 'undef'
+        result = {}
+        for curChangeset in self._OsmResponseToDom(data, tag='changeset'):
+            tmpCS = self._DomParseChangeset(curChangeset)
+            result[tmpCS['id']] = tmpCS
+        return result
+
     # ##################################################
     # # Notes                                          #
     # ##################################################
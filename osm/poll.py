@@ -0,0 +1,68 @@
+import collections
+import calendar
+import logging
+
+logger = logging.getLogger(__name__)
+
+def epoch(dt):
+    '''Seconds since epoch of timezone-aware datetime'''
+    return calendar.timegm(dt.utctimetuple())+dt.microsecond/1E6
+
+class PublicationScheduler(object):
+    '''Decide when to poll for a replication state published periodically. The
+       publication period is learned from the timestamps of recent head states
+       and polling is scheduled just after the next expected publication. If the
+       state is not yet published when polled, retries are made with a short
+       exponential backoff'''
+
+    def __init__(self, period=60, margin=1.0, retry=1.0, max_retry=None, history=16):
+        self.default_period = float(period)
+        self.margin = margin
+        self.retry = retry
+        self.max_retry = max_retry if max_retry else self.default_period/4
+        self.timestamps = collections.deque(maxlen=history)
+        self.misses = 0
+
+    def observe(self, ts):
+        '''Register timestamp (seconds since epoch) of current head state. Returns
+           True if this is a new publication'''
+        if self.timestamps and ts <= self.timestamps[-1]:
+            return False
+        self.timestamps.append(ts)
+        self.misses = 0
+        return True
+
+    def period(self):
+        '''Median interval between recent publications'''
+        if len(self.timestamps) < 2:
+            return self.default_period
+        ts = list(self.timestamps)
+        intervals = sorted([b-a for a, b in zip(ts, ts[1:])])
+        n = len(intervals)
+        if n % 2:
+            period = intervals[n/2]
+        else:
+            period = (intervals[n/2-1]+intervals[n/2])/2.0
+        # Gaps from downtime or missed polls are multiples of the period and
+        # should not make us poll less often than the nominal period
+        return min(period, self.default_period)
+
+    def expected(self):
+        '''Expected time of next publication'''
+        if not self.timestamps:
+            return None
+        return self.timestamps[-1]+self.period()
+
+    def delay(self, now):
+        '''Seconds to sleep before polling head state again'''
+        expected = self.expected()
+        if expected is None:
+            return 0
+        wakeup = expected+self.margin
+        if wakeup > now:
+            return wakeup-now
+        # Publication is overdue, retry soon
+        delay = min(self.retry*(2**self.misses), self.max_retry)
+        self.misses += 1
+        logger.debug('Publication overdue by {:.2f}s, retry {} in {:.2f}s'.format(now-expected, self.misses, delay))
+        return delay
@@ -1,5 +1,50 @@
+import os
 import re
-from shapely import geometry
+import logging
+from shapely import geometry, prepared
+from shapely.strtree import STRtree
+import numpy
+try:
+    from shapely import vectorized
+except ImportError:
+    vectorized = None
+
+logger = logging.getLogger(__name__)
+
+# Polygons loaded by get_poly(), keyed by filename
+registry = {}
+# Region indexes built by get_index(), keyed by filenames
+indexes = {}
+
+def get_poly(fname):
+    '''Get polygon loaded from file. Polygons are loaded once and reloaded if the
+       file modification time changes'''
+    try:
+        mtime = os.path.getmtime(fname)
+    except OSError:
+        mtime = None
+    entry = registry.get(fname, None)
+    if entry and mtime is not None and entry[0]==mtime:
+        return entry[1]
+    area = Poly()
+    area.load(fname)
+    logger.debug("Loaded area polygon from '{}' with {} points".format(fname, len(area)))
+    if mtime is not None:
+        registry[fname] = (mtime, area)
+    return area
+
+def get_index(fnames):
+    '''Get region index of polygons loaded from files. Indexes are rebuilt if any
+       of the polygons are reloaded'''
+    key = tuple(sorted(set(fnames)))
+    areas = [(fname, get_poly(fname)) for fname in key]
+    index = indexes.get(key, None)
+    if index and all([a is b for (_, a), (_, b) in zip(index.areas, areas)]):
+        return index
+    index = RegionIndex(areas)
+    if all([registry.get(fname, (None, None))[1] is area for fname, area in areas]):
+        indexes[key] = index
+    return index
 
 class BBox(object):
     def __init__(self, x1=None, y1=None, x2=None, y2=None):
@@ -31,9 +76,14 @@ class BBox(object):
             self.y1 = min(self.y1, y)
             self.y2 = max(self.y2, y)
 
+    def merge(self, other):
+        self.add_point(other.x1, other.y1)
+        self.add_point(other.x2, other.y2)
+
 class Poly(object):
     def __init__(self):
         self.poly = geometry.Polygon
+        self.prepared = None
 
     def load(self, fname):
         flt = r'[+-]?(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?'
@@ -45,10 +95,12 @@ class Poly(object):
                 if m:
                     poly.append((float(m.group(1)), float(m.group(5))))
         self.poly = geometry.Polygon(poly)
+        self.prepared = prepared.prep(self.poly)
 
-    def contains(self, x, y):
-        pt = geometry.Point(x, y)
-        return self.poly.contains(pt)
+    def _geom(self):
+        if self.prepared:
+            return self.prepared
+        return self.poly
 
     def contains_chgset(self, chg):
         if set(['min_lon', 'min_lat', 'max_lon', 'max_lat']).issubset(chg.keys()):
@@ -62,17 +114,33 @@ class Poly(object):
     def contains_bbox(self, bbox):
         return self.contains(bbox['lon_min'], bbox['lat_min'], bbox['lon_max'], bbox['lat_max'])
 
-    def contains(self, x1, y1, x2, y2):
-        '''Test against bbox from points (x1,y1) and (x2,y2)'''
+    def contains(self, x1, y1, x2=None, y2=None):
+        '''Test if point (x1,y1) is inside polygon or, if (x2,y2) is given, test against
+           bbox from points (x1,y1) and (x2,y2)'''
+        geom = self._geom()
+        if x2 is None or y2 is None:
+            return geom.contains(geometry.Point(x1, y1))
         box = geometry.box(x1, y1, x2, y2)
-        if self.poly.intersects(box):
+        if geom.intersects(box):
             return True
         small = 0.000001
         if abs(x1-x2)<small or abs(y1-y2)<small:
             # Point-sized box does not intersect with anything
-            return self.poly.intersects(geometry.Point(x1, y1))
+            return geom.intersects(geometry.Point(x1, y1))
         return False
 
+    def contains_points(self, xs, ys):
+        '''Test points given as sequences of x and y coordinates against polygon in
+           one vectorized operation. Returns array of booleans'''
+        xs = numpy.asarray(xs, dtype=float)
+        ys = numpy.asarray(ys, dtype=float)
+        if not len(xs):
+            return numpy.zeros(0, dtype=bool)
+        if vectorized:
+            return vectorized.contains(self.poly, xs, ys)
+        geom = self._geom()
+        return numpy.array([geom.contains(geometry.Point(x, y)) for x, y in zip(xs, ys)], dtype=bool)
+
     def bbox(self):
         return self.poly.bounds
 
@@ -82,3 +150,38 @@ class Poly(object):
 
     def __len__(self):
         return len(self.poly.exterior.xy[0])
+
+class RegionIndex(object):
+    '''Index of named areas for finding all areas matching a bbox or point in a
+       single query. With many areas, candidates are found using an STRtree over
+       the area envelopes before the exact test'''
+    STRTREE_MIN_AREAS = 8
+
+    def __init__(self, areas):
+        self.areas = list(areas)    # List of (key, Poly)
+        self.tree = None
+        if len(self.areas) >= self.STRTREE_MIN_AREAS:
+            geoms = [area.poly for _, area in self.areas]
+            self.tree = STRtree(geoms)
+            self.by_geom = dict([(id(area.poly), (key, area)) for key, area in self.areas])
+
+    def __len__(self):
+        return len(self.areas)
+
+    def _candidates(self, geom):
+        return [self.by_geom[id(g)] for g in self.tree.query(geom)]
+
+    def query_point(self, x, y):
+        '''Keys of areas containing point'''
+        candidates = self.areas
+        if self.tree:
+            candidates = self._candidates(geometry.Point(x, y))
+        return set([key for key, area in candidates if area.contains(x, y)])
+
+    def query_bbox(self, bbox):
+        '''Keys of areas intersecting bbox, given as dict like BBox.to_dict()'''
+        candidates = self.areas
+        if self.tree:
+            candidates = self._candidates(geometry.box(bbox['lon_min'], bbox['lat_min'],
+                                                       bbox['lon_max'], bbox['lat_max']))
+        return set([key for key, area in candidates if area.contains_bbox(bbox)])
@@ -0,0 +1,158 @@
+import os
+import json
+import glob
+import collections
+import datetime
+import logging
+import osmapi
+import changeset
+
+logger = logging.getLogger(__name__)
+
+class RecordedOsmApi(object):
+    '''Stand-in for OsmApi serving recorded API responses from a directory. Files
+       use the layout of the test data, i.e. 'cset<id>.meta.json' with changeset
+       meta, 'cset<id>.data.json' with changeset changes and
+       '<node|way|relation><id>.data.json' with element history keyed by
+       version. Number of calls are counted per API method'''
+
+    TIMESTAMP_FMT = '%Y-%m-%dT%H:%M:%SZ'
+
+    def __init__(self, datapath):
+        self.datapath = datapath
+        self.calls = collections.Counter()
+
+    def __call__(self, api=None):
+        # Used in place of the OsmApi class
+        return self
+
+    def _load(self, fname):
+        fname = os.path.join(self.datapath, fname)
+        if not os.path.isfile(fname):
+            raise osmapi.ApiError(404, 'Not recorded', fname)
+        with open(fname) as f:
+            return json.load(f)
+
+    def _dateconv(self, txt):
+        return datetime.datetime.strptime(txt, self.TIMESTAMP_FMT)
+
+    def _history(self, etype, eid):
+        data = self._load('{}{}.data.json'.format(etype, eid))
+        hist = {}
+        for v, e in data.items():
+            e['timestamp'] = self._dateconv(e['timestamp'])
+            hist[int(v)] = e
+        return hist
+
+    def _meta(self, cid):
+        data = self._load('cset{}.meta.json'.format(cid))
+        for ts in ['created_at', 'closed_at']:
+            if ts in data:
+                data[ts] = self._dateconv(data[ts])
+        return data
+
+    def ChangesetGet(self, ChangesetId, include_discussion=False):
+        self.calls['ChangesetGet'] += 1
+        data = self._meta(ChangesetId)
+        if not include_discussion:
+            data.pop('discussion', None)
+        return data
+
+    def ChangesetsGetByIds(self, ChangesetIds):
+        self.calls['ChangesetsGetByIds'] += 1
+        result = {}
+        for cid in ChangesetIds:
+            try:
+                data = self._meta(cid)
+            except osmapi.ApiError:
+                continue
+            data.pop('discussion', None)
+            result[cid] = data
+        return result
+
+    def ChangesetDownload(self, ChangesetId):
+        self.calls['ChangesetDownload'] += 1
+        data = self._load('cset{}.data.json'.format(ChangesetId))
+        for elem in data:
+            if 'timestamp' in elem['data']:
+                elem['data']['timestamp'] = self._dateconv(elem['data']['timestamp'])
+        return data
+
+    def NodeHistory(self, NodeId):
+        self.calls['NodeHistory'] += 1
+        return self._history('node', NodeId)
+
+    def WayHistory(self, WayId):
+        self.calls['WayHistory'] += 1
+        return self._history('way', WayId)
+
+    def RelationHistory(self, RelationId):
+        self.calls['RelationHistory'] += 1
+        return self._history('relation', RelationId)
+
+    def _get(self, method, etype, eid, version):
+        self.calls[method] += 1
+        try:
+            hist = self._history(etype, eid)
+        except osmapi.ApiError:
+            return None
+        if version is None:
+            return hist[max(hist.keys())]
+        return hist.get(version, None)
+
+    def NodeGet(self, NodeId, NodeVersion=-1):
+        return self._get('NodeGet', 'node', NodeId, None if NodeVersion==-1 else NodeVersion)
+
+    def WayGet(self, WayId, WayVersion=-1):
+        return self._get('WayGet', 'way', WayId, None if WayVersion==-1 else WayVersion)
+
+    def RelationGet(self, RelationId, RelationVersion=-1):
+        return self._get('RelationGet', 'relation', RelationId, None if RelationVersion==-1 else RelationVersion)
+
+    def _elements_get(self, method, etype, ids):
+        self.calls[method] += 1
+        result = {}
+        for ref in ids:
+            eid, _, version = str(ref).partition('v')
+            try:
+                hist = self._history(etype, int(eid))
+            except osmapi.ApiError:
+                continue
+            e = hist.get(int(version), None) if version else hist[max(hist.keys())]
+            if e:
+                result[int(eid)] = e
+        return result
+
+    def NodesGet(self, NodeIdList):
+        return self._elements_get('NodesGet', 'node', NodeIdList)
+
+    def WaysGet(self, WayIdList):
+        return self._elements_get('WaysGet', 'way', WayIdList)
+
+    def RelationsGet(self, RelationIdList):
+        return self._elements_get('RelationsGet', 'relation', RelationIdList)
+
+def load_payloads(datapath):
+    '''Load recorded new_cset payloads from 'new_csets.json' with one payload per
+       line. Without recorded payloads, payloads are made from the recorded
+       changeset meta'''
+    fname = os.path.join(datapath, 'new_csets.json')
+    if os.path.isfile(fname):
+        with open(fname) as f:
+            return [json.loads(ln) for ln in f if ln.strip()]
+    payloads = []
+    for meta_fname in sorted(glob.glob(os.path.join(datapath, 'cset*.meta.json'))):
+        with open(meta_fname) as f:
+            meta = json.load(f)
+        cid = int(os.path.basename(meta_fname)[len('cset'):-len('.meta.json')])
+        p = {'cid': cid,
+             'source': {'type': 'minute', 'sequenceno': 0, 'observed': meta['created_at']}}
+        if 'min_lat' in meta:
+            p['bbox'] = {'lon_min': float(meta['min_lon']), 'lat_min': float(meta['min_lat']),
+                         'lon_max': float(meta['max_lon']), 'lat_max': float(meta['max_lat'])}
+        payloads.append(p)
+    return payloads
+
+def install(api):
+    '''Make changesets use api in place of the OSM API'''
+    changeset.OsmApi = api
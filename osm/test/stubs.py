@@ -28,6 +28,9 @@ class testOsmApi(object):
     def ChangesetGet(self, id, include_discussion=True):
         if 'ChangesetGet' in self.sigint_on:
             os.kill(os.getpid(), signal.SIGINT)
+        return self._changeset_meta(id)
+
+    def _changeset_meta(self, id):
         with open(self.datapath+'/cset{}.meta.json'.format(id)) as f:
             data =json.load(f)
         for ts in ['created_at', 'closed_at']:
@@ -36,6 +39,16 @@ class testOsmApi(object):
         logger.debug(' Loaded changeset meta {}'.format(data))
         return data
 
+    def ChangesetsGetByIds(self, ids):
+        result = {}
+        for id in ids:
+            fname = self.datapath+'/cset{}.meta.json'.format(id)
+            if os.path.isfile(fname):
+                data = self._changeset_meta(id)
+                data.pop('discussion', None)
+                result[id] = data
+        return result
+
     def ChangesetDownload(self, id):
         # Note that osmapi returns empty node list ('nd') and tag list ('tag')
         # for deleted ways. The OSM change file do not contain such an empty
@@ -72,20 +85,49 @@ class testOsmApi(object):
             return w
         return None
 
+    def _elements_get(self, etype, ids):
+        result = {}
+        for ref in ids:
+            eid, _, version = str(ref).partition('v')
+            fname = self.datapath+'/{}{}.data.json'.format(etype, eid)
+            if not os.path.isfile(fname):
+                continue
+            with open(fname) as f:
+                data = self.keys2int(json.load(f))
+            v = int(version) if version else max(data.keys())
+            if v in data:
+                data[v]['timestamp'] = self._dateconv(data[v]['timestamp'])
+                result[int(eid)] = data[v]
+        return result
+
+    def NodesGet(self, NodeIdList):
+        return self._elements_get('node', NodeIdList)
+
+    def WaysGet(self, WayIdList):
+        return self._elements_get('way', WayIdList)
+
+    def RelationsGet(self, RelationIdList):
+        return self._elements_get('relation', RelationIdList)
+
 class testUrlToBeRead(object):
     def __init__(self, parent, url):
         self.parent = parent
         self.url = url.replace('http://', 'urls/')
         self.status_code = 200
+        self.headers = {}
         with open(self.parent.datapath+'/{}'.format(self.url)) as f:
             self.content = f.read()
 
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i+chunk_size]
+
 class testRequests(object):
     def __init__(self, datapath='test/data', sigint_on=[]):
         self.datapath = datapath
         self.sigint_on = sigint_on
 
-    def get(self, url):
+    def get(self, url, **kwargs):
         if 'get' in self.sigint_on:
             os.kill(os.getpid(), signal.SIGINT)
         return testUrlToBeRead(self, url)
@@ -127,6 +127,64 @@ class TestLabelFilter(unittest.TestCase):
         labels = self.cset.build_labels(labels)
         self.assertFalse('inside-area' in labels)
 
+    @patch('poly.Poly')
+    def test_1_points_bbox(self, Poly):
+        rules = [
+	    {'area_check_type': 'points-bbox', "area_file": "region.poly", "label": "inside-area"},
+	]
+        Poly.return_value.contains_bbox.return_value = True
+        labels = self.cset.build_labels(rules, bbox='bboxstub', points_bbox='pointsbboxstub')
+        self.assertTrue('inside-area' in labels)
+        Poly.return_value.contains_bbox.assert_called_once_with('pointsbboxstub')
+
+    @patch('poly.Poly')
+    def test_1_points_bbox_fallback(self, Poly):
+        rules = [
+	    {'area_check_type': 'points-bbox', "area_file": "region.poly", "label": "inside-area"},
+	]
+        Poly.return_value.contains_bbox.return_value = True
+        labels = self.cset.build_labels(rules, bbox='bboxstub')
+        self.assertTrue('inside-area' in labels)
+        Poly.return_value.contains_bbox.assert_called_once_with('bboxstub')
+        labels = self.cset.build_labels(rules)
+        self.assertFalse('inside-area' in labels)
+
+    @patch('poly.Poly')
+    def test_plan_short_circuit(self, Poly):
+        rules = [
+	    {"regex": [{".meta.tag.comment": "^Adjustments"}], "label": "adjustment"},
+	    {'area_check_type': 'cset-bbox', "area_file": "region.poly", "label": "inside-area"},
+	]
+        filters = [['inside-area', 'adjustment']]
+        self.cset.downloadMeta = mock.Mock()
+        Poly.return_value.contains_bbox.return_value = False
+        labels = self.cset.build_labels(rules, bbox=self.bbox, label_filters=filters)
+        self.assertEqual(labels, [])
+        # Area rule evaluated first, no need for meta
+        self.assertFalse(self.cset.downloadMeta.called)
+
+    @patch('poly.Poly')
+    def test_plan_complete_on_pass(self, Poly):
+        self.cset.meta = {'user': 'useruser', 'tag': {'comment': 'Adjustments at somewhere'}}
+        rules = [
+	    {"regex": [{".meta.tag.comment": "^Adjustments"}], "label": "adjustment"},
+	    {"regex": [{".meta.user": "^nobody"}], "label": "nobody"},
+	    {'area_check_type': 'cset-bbox', "area_file": "region.poly", "label": "inside-area"},
+	    {"regex": [{".meta.user": "^user"}], "label": "user"},
+	]
+        Poly.return_value.contains_bbox.return_value = True
+        labels = self.cset.build_labels(rules, bbox=self.bbox, label_filters=[['inside-area']])
+        # Labels in config order
+        self.assertEqual(labels, ['adjustment', 'inside-area', 'user'])
+        self.assertEqual(self.cset.build_labels(rules, bbox=self.bbox), labels)
+
+    def test_plan_cached(self):
+        rules = [{"regex": [{".meta.user": "^user"}], "label": "user"}]
+        plan = changeset.get_label_plan(rules, [['user']])
+        self.assertTrue(changeset.get_label_plan([dict(rules[0])], [['user']]) is plan)
+        self.assertFalse(changeset.get_label_plan(rules) is plan)
+        self.assertEqual(plan.rules[0].cost, changeset.LabelRule.COST_META)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -7,6 +7,7 @@ import logging
 import changeset
 import stubs
 import pprint
+import json
 
 logger = logging.getLogger('')
 
@@ -39,5 +40,33 @@ class TestImportExportAndGeojson(unittest.TestCase):
         self.assertTrue(len(geoj['features'])>0)
         #print 'GEOJ:{}'.format(pprint.pformat(geoj))
 
+    @patch('poly.Poly')
+    @patch('changeset.OsmApi')
+    def test_2_analyse_single_pass(self, OsmApi, Poly):
+        OsmApi.return_value = self.osmapi
+        Poly.return_value.contains_chgset.return_value = True
+        for cid in [10, 11, 12]:
+            cset = changeset.Changeset(id=cid)
+            cset.downloadMeta()
+            cset.downloadData()
+            cset.downloadGeometry()
+            cset.analyse()
+            self.assertTrue(cset.diffs['node'] or cset.diffs['way'])
+            # Expected data recorded with separate buildSummary() and
+            # buildDiffList() passes before analyse() was introduced
+            with open('test/data/cset{}.analysed.json'.format(cid)) as f:
+                expected = json.load(f)
+            data = json.loads(json.dumps(cset.data_export(), default=str))
+            mileage = data.pop('mileage_m')
+            expected_mileage = expected.pop('mileage_m')
+            self.assertEqual(data, expected)
+            # Mileage of modified ways was added later and is not recorded
+            by_type = mileage.pop('by_type')
+            for k, v in expected_mileage.pop('by_type').items():
+                for nav_type, d in v.items():
+                    self.assertAlmostEqual(by_type[k][nav_type], d)
+            for k, d in expected_mileage.items():
+                self.assertAlmostEqual(mileage[k], d)
+
 if __name__ == '__main__':
     unittest.main()
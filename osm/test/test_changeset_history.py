@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+import unittest
+import mock
+import datetime
+import time
+import eventlet
+import changeset
+
+T0 = datetime.datetime(2018, 11, 1)
+T1 = datetime.datetime(2018, 11, 10)
+T2 = datetime.datetime(2018, 11, 20)
+
+def elem(eid, version, timestamp, **kwargs):
+    e = {'id': eid, 'version': version, 'timestamp': timestamp, 'visible': True,
+         'uid': 1, 'user': 'user', 'tag': {}}
+    e.update(kwargs)
+    return e
+
+NODES = {1: {1: elem(1, 1, T0, lat=55.0, lon=11.0)},
+         2: {1: elem(2, 1, T0, lat=55.0, lon=11.0),
+             2: elem(2, 2, T0, lat=55.1, lon=11.1),
+             3: elem(2, 3, T2, lat=55.2, lon=11.2)},
+         3: {1: elem(3, 1, T0, lat=55.0, lon=11.0)}}
+WAYS = {10: {1: elem(10, 1, T0, nd=[1])}}
+
+def bulk_get(hist):
+    def get(ids):
+        res = {}
+        for ref in ids:
+            eid, _, v = ref.partition('v')
+            h = hist[int(eid)]
+            res[int(eid)] = h[int(v) if v else max(h.keys())]
+        return res
+    return get
+
+class TestHistoryPlanner(unittest.TestCase):
+
+    def setUp(self):
+        self.cset = changeset.Changeset(id=1)
+        self.cset.osmapi = mock.Mock()
+        self.cset.osmapi.NodesGet.side_effect = bulk_get(NODES)
+        self.cset.osmapi.WaysGet.side_effect = bulk_get(WAYS)
+        self.cset.changes = [{'type': 'way', 'action': 'modify', 'data': elem(10, 2, T1, nd=[1, 2])},
+                             {'type': 'node', 'action': 'delete', 'data': elem(3, 2, T1, visible=False)}]
+
+    def test_plan(self):
+        for mod in self.cset.changes:
+            self.cset.hist[mod['type']][mod['data']['id']] = {mod['data']['version']: mod['data']}
+        versions, at = self.cset.planHistory()
+        self.assertEqual(versions, [('node', 3, 1), ('way', 10, 1)])
+        self.assertEqual(at, [(1, T1), (2, T1)])
+
+    def test_download_geometry(self):
+        self.cset.downloadGeometry()
+        self.assertEqual(self.cset.osmapi.NodesGet.call_args_list,
+                         [mock.call(['3v1']), mock.call(['1', '2']), mock.call(['2v2'])])
+        self.cset.osmapi.WaysGet.assert_called_once_with(['10v1'])
+        self.assertEqual(self.cset.old('node', 2, T1)['version'], 2)
+        self.assertEqual(self.cset.old('node', 1, T1)['version'], 1)
+        self.assertEqual(self.cset.old('way', 10, 1)['nd'], [1])
+        self.assertFalse(self.cset.osmapi.NodeHistory.called)
+        self.assertFalse(self.cset.osmapi.NodeGet.called)
+        self.assertFalse(self.cset.osmapi.WayGet.called)
+
+    def test_bulk_failure_falls_back(self):
+        self.cset.osmapi.NodesGet.side_effect = Exception('Redacted')
+        self.cset.osmapi.NodeGet.side_effect = lambda eid, NodeVersion: NODES[eid][NodeVersion]
+        self.cset.osmapi.NodeHistory.side_effect = lambda eid: dict(NODES[eid])
+        self.cset.downloadGeometry()
+        self.assertEqual(self.cset.old('node', 2, T1)['version'], 2)
+        self.assertTrue(self.cset.osmapi.NodeHistory.called)
+
+class TestTimeline(unittest.TestCase):
+
+    def setUp(self):
+        self.cset = changeset.Changeset(id=1)
+        self.cset.osmapi = mock.Mock()
+        self.cset.osmapi.NodeHistory.side_effect = lambda eid: dict(NODES[eid])
+
+    def test_version_at(self):
+        self.cset.hist['node'][2] = {1: NODES[2][1], 3: NODES[2][3]}
+        self.assertEqual(self.cset.versionAt('node', 2, T2), (3, True))
+        # Version 2 is unknown, i.e. T1 is not covered
+        self.assertEqual(self.cset.versionAt('node', 2, T1), (None, False))
+        self.cset.hist['node'][2][2] = elem(2, 2, T1-datetime.timedelta(days=1))
+        self.assertEqual(self.cset.versionAt('node', 2, T1), (2, False))
+        self.assertEqual(self.cset.versionAt('node', 2, T2+datetime.timedelta(days=1)), (None, False))
+        self.assertEqual(self.cset.versionAt('node', 4, T1), (None, False))
+
+    def test_history_fetched_once(self):
+        self.assertEqual(self.cset.old('node', 2, T1)['version'], 2)
+        self.assertEqual(self.cset.old('node', 2, T2+datetime.timedelta(days=1))['version'], 3)
+        self.assertEqual(self.cset.old('node', 2, '2018-11-05T00:00:00Z')['version'], 2)
+        self.cset.osmapi.NodeHistory.assert_called_once_with(2)
+        self.assertTrue(self.cset.timeline('node', 2)['complete'])
+
+class TestConcurrentFetch(unittest.TestCase):
+
+    def setUp(self):
+        self.cset = changeset.Changeset(id=1)
+        self.cset.osmapi = mock.Mock()
+        self.cset.osmapi.NodesGet.side_effect = Exception('Redacted')
+        def node_history(eid):
+            eventlet.sleep(0.05)
+            return {1: elem(eid, 1, T0, lat=55.0, lon=11.0)}
+        self.cset.osmapi.NodeHistory.side_effect = node_history
+        self.cset.changes = [{'type': 'way', 'action': 'create', 'data': elem(10, 1, T1, nd=range(1, 17))}]
+
+    def test_concurrent(self):
+        self.cset.fetch_concurrency = 8
+        start = time.time()
+        self.cset.downloadGeometry()
+        self.assertTrue(time.time()-start < 0.05*16/2)
+        self.assertEqual(self.cset.osmapi.NodeHistory.call_count, 16)
+        self.assertEqual(self.cset.old('node', 16, T1)['version'], 1)
+
+    def test_timeout_cancels(self):
+        self.cset.fetch_concurrency = 4
+        self.assertRaises(changeset.Timeout, self.cset.downloadGeometry, maxtime=0.01)
+        self.assertTrue(self.cset.osmapi.NodeHistory.call_count <= 8)
+
+    @mock.patch('changeset.OsmApi')
+    def test_client_per_greenthread(self, OsmApi):
+        clients = []
+        def new_client(api):
+            client = mock.Mock()
+            def node_history(eid):
+                # Client is not used by another greenthread during a request
+                self.assertFalse(client.busy)
+                client.busy = True
+                eventlet.sleep(0.01)
+                client.busy = False
+                return {1: elem(eid, 1, T0, lat=55.0, lon=11.0)}
+            client.busy = False
+            client.NodesGet.side_effect = Exception('Redacted')
+            client.NodeHistory.side_effect = node_history
+            clients.append(client)
+            return client
+        OsmApi.side_effect = new_client
+        cset = changeset.Changeset(id=1)
+        cset.changes = self.cset.changes
+        cset.fetch_concurrency = 4
+        cset.downloadGeometry()
+        # Main client and one per concurrent greenthread, reused between lookups
+        self.assertEqual(len(clients), 1+4)
+        self.assertEqual(sum([c.NodeHistory.call_count for c in clients[1:]]), 16)
+        self.assertTrue(cset.osmapi is clients[0])
+
+class TestHostConcurrency(unittest.TestCase):
+
+    def tearDown(self):
+        changeset.set_host_concurrency(8)
+
+    def test_limits(self):
+        changeset.set_host_concurrency({'api.example.org': 2, 'default': 4})
+        self.assertEqual(changeset.host_semaphore('api.example.org').balance, 2)
+        self.assertEqual(changeset.host_semaphore('other.example.org').balance, 4)
+        changeset.set_host_concurrency(3)
+        self.assertEqual(changeset.host_semaphore('api.example.org').balance, 3)
+
+if __name__ == '__main__':
+    unittest.main()
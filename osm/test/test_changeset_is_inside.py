@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+import unittest
+import mock
+import os
+import shutil
+import tempfile
+import datetime
+import changeset
+import poly
+
+SQUARE = '''square
+1
+   10.0   54.0
+   12.0   54.0
+   12.0   56.0
+   10.0   56.0
+   10.0   54.0
+END
+END
+'''
+
+def node(nid, lon, lat, version=1, timestamp=datetime.datetime(2018, 11, 1)):
+    return {'id': nid, 'lon': lon, 'lat': lat, 'version': version,
+            'visible': True, 'timestamp': timestamp}
+
+class TestIsInside(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        fname = os.path.join(self.tmpdir, 'region.poly')
+        with open(fname, 'w') as f:
+            f.write(SQUARE)
+        self.area = poly.get_poly(fname)
+        self.cset = changeset.Changeset(id=1)
+        self.cset.osmapi = mock.Mock()
+
+    def tearDown(self):
+        poly.registry.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def test_nodes(self):
+        self.cset.changes = [{'type': 'node', 'action': 'modify', 'data': node(1, 13.0, 55.0)},
+                             {'type': 'node', 'action': 'create', 'data': node(2, 11.0, 55.0)}]
+        self.assertTrue(self.cset.isInside(self.area))
+        self.cset.changes = self.cset.changes[:1]
+        self.assertFalse(self.cset.isInside(self.area))
+        self.assertFalse(self.cset.osmapi.method_calls)
+
+    def test_deleted_nodes_bulk(self):
+        self.cset.changes = [{'type': 'node', 'action': 'delete', 'data': {'id': 1, 'version': 2}},
+                             {'type': 'node', 'action': 'delete', 'data': {'id': 2, 'version': 3}}]
+        self.cset.osmapi.NodesGet.return_value = {1: node(1, 13.0, 55.0, 1), 2: node(2, 11.0, 55.0, 2)}
+        self.assertTrue(self.cset.isInside(self.area))
+        self.cset.osmapi.NodesGet.assert_called_once_with(['1v1', '2v2'])
+
+    def test_way_nodes_bulk(self):
+        way_ts = datetime.datetime(2018, 11, 10)
+        self.cset.changes = [{'type': 'way', 'action': 'modify',
+                              'data': {'id': 10, 'nd': [1, 2, 3], 'timestamp': way_ts}},
+                             {'type': 'way', 'action': 'modify',
+                              'data': {'id': 11, 'nd': [4, 5], 'timestamp': way_ts}}]
+        nodes = {1: node(1, 13.0, 55.0), 2: node(2, 13.0, 55.0), 3: node(3, 13.0, 55.0),
+                 4: node(4, 13.0, 55.0), 5: node(5, 11.0, 55.0)}
+        self.cset.osmapi.NodesGet.return_value = nodes
+        self.assertTrue(self.cset.isInside(self.area))
+        # First nodes of all ways are requested first
+        self.cset.osmapi.NodesGet.assert_called_once_with(['1', '4', '2', '5', '3'])
+        self.assertFalse(self.cset.osmapi.NodeHistory.called)
+        self.assertTrue(self.cset.isInside(self.area, load_way_nodes=False))
+
+    def test_way_node_moved_after_way(self):
+        way_ts = datetime.datetime(2018, 11, 10)
+        self.cset.changes = [{'type': 'way', 'action': 'modify',
+                              'data': {'id': 10, 'nd': [1], 'timestamp': way_ts}}]
+        # Node was moved into area after the way edit
+        self.cset.osmapi.NodesGet.return_value = {1: node(1, 11.0, 55.0, 2, datetime.datetime(2018, 11, 20))}
+        self.cset.osmapi.NodeHistory.return_value = {1: node(1, 13.0, 55.0, 1),
+                                                     2: node(1, 11.0, 55.0, 2, datetime.datetime(2018, 11, 20))}
+        self.assertFalse(self.cset.isInside(self.area))
+        self.cset.osmapi.NodeHistory.assert_called_once_with(1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+import unittest
+import mock
+import datetime
+import geotools
+import changeset
+
+T0 = datetime.datetime(2018, 11, 1)
+T1 = datetime.datetime(2018, 11, 10)
+
+def node(nid, version, lon, lat, timestamp=T0):
+    return {'id': nid, 'version': version, 'timestamp': timestamp, 'visible': True,
+            'uid': 1, 'user': 'user', 'tag': {}, 'lat': lat, 'lon': lon}
+
+def way(wid, version, nd, tag, timestamp=T1):
+    return {'id': wid, 'version': version, 'timestamp': timestamp, 'visible': True,
+            'uid': 1, 'user': 'user', 'tag': tag, 'nd': nd}
+
+def scalar_length(points):
+    return sum(geotools.haversine(lon1, lat1, lon2, lat2)
+               for (lon1, lat1), (lon2, lat2) in zip(points[:-1], points[1:]))
+
+class TestWayLengths(unittest.TestCase):
+
+    def test_matches_scalar(self):
+        ways = [[(11.0, 55.0), (11.1, 55.0), (11.1, 55.2)],
+                [],
+                [(12.0, 56.0)],
+                [(-70.0, -33.4), (-70.1, -33.5)]]
+        lons, lats, starts = [], [], []
+        for points in ways:
+            starts.append(len(lons))
+            lons += [p[0] for p in points]
+            lats += [p[1] for p in points]
+        lengths = geotools.way_lengths(lons, lats, starts)
+        self.assertEqual(len(lengths), len(ways))
+        for d, points in zip(lengths, ways):
+            self.assertAlmostEqual(d, scalar_length(points), places=6)
+            self.assertEqual(type(d), float)
+
+    def test_no_nodes(self):
+        self.assertEqual(geotools.way_lengths([], [], [0, 0]), [0.0, 0.0])
+
+class TestMileage(unittest.TestCase):
+
+    def setUp(self):
+        self.cset = changeset.Changeset(id=1, api=None)
+        for nid, lon in [(1, 11.0), (2, 11.01), (3, 11.02)]:
+            self.cset.hist['node'][nid] = {1: node(nid, 1, lon, 55.0)}
+        # Node 3 moved by the changeset
+        self.cset.hist['node'][3][2] = node(3, 2, 11.03, 55.0, T1)
+        self.cset.hist['way'][10] = {1: way(10, 1, [1, 2], {'highway': 'track'}, T0)}
+        self.cset.hist['way'][11] = {1: way(11, 1, [2, 3], {'building': 'yes'}, T0)}
+        self.cset.changes = [{'type': 'way', 'action': 'modify',
+                              'data': way(10, 2, [1, 2, 3], {'highway': 'track'})},
+                             {'type': 'way', 'action': 'delete',
+                              'data': way(11, 2, [], {})},
+                             {'type': 'way', 'action': 'create',
+                              'data': way(12, 1, [3, 1], {'highway': 'path'})},
+                             {'type': 'node', 'action': 'modify', 'data': node(3, 2, 11.03, 55.0, T1)}]
+        for mod in self.cset.changes:
+            data = mod['data']
+            self.cset.hist[mod['type']].setdefault(data['id'], {})[data['version']] = data
+
+    def test_mileage(self):
+        self.cset.buildSummary()
+        m = self.cset.mileage
+        p1, p2, p3, p3_old = (11.0, 55.0), (11.01, 55.0), (11.03, 55.0), (11.02, 55.0)
+        created = scalar_length([p3, p1])
+        modified = scalar_length([p1, p2, p3])-scalar_length([p1, p2])
+        self.assertAlmostEqual(m['_all_create'], created)
+        self.assertAlmostEqual(m['_all_modify'], modified)
+        self.assertAlmostEqual(m['_all_delete'], -scalar_length([p2, p3_old]))
+        self.assertAlmostEqual(m['_navigable_modify'], modified)
+        self.assertEqual(m['_navigable_delete'], 0)
+        self.assertAlmostEqual(m['by_type']['highway']['path'], created)
+        self.assertAlmostEqual(m['by_type']['highway']['track'], modified)
+
+    def test_removed_way_node(self):
+        # Node 3 is only referenced by the previous way version
+        nodes = {nid: {1: node(nid, 1, lon, 55.0)} for nid, lon in [(1, 11.0), (2, 11.01), (3, 11.02)]}
+        ways = {20: {1: way(20, 1, [1, 2, 3], {'highway': 'track'}, T0)}}
+        def bulk_get(hist):
+            def get(ids):
+                res = {}
+                for ref in ids:
+                    eid, _, v = ref.partition('v')
+                    h = hist[int(eid)]
+                    res[int(eid)] = h[int(v) if v else max(h.keys())]
+                return res
+            return get
+        cset = changeset.Changeset(id=2)
+        cset.osmapi = mock.Mock()
+        cset.osmapi.NodesGet.side_effect = bulk_get(nodes)
+        cset.osmapi.WaysGet.side_effect = bulk_get(ways)
+        cset.osmapi.NodeGet.side_effect = Exception('Not found')
+        cset.changes = [{'type': 'way', 'action': 'modify',
+                         'data': way(20, 2, [1, 2], {'highway': 'track'})}]
+        cset.downloadGeometry()
+        cset.buildSummary()
+        removed = scalar_length([(11.01, 55.0), (11.02, 55.0)])
+        self.assertAlmostEqual(cset.mileage['_all_modify'], -removed)
+        self.assertFalse(cset.osmapi.NodeGet.called)
+        self.assertFalse(cset.osmapi.NodeHistory.called)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,7 @@
 
 import unittest
 import logging
+import mock
 import changeset
 
 logger = logging.getLogger('')
@@ -100,6 +101,30 @@ class TestFiltering(unittest.TestCase):
         regexfilter = [{".changes.tag.osak:identifier": ""}]
         self.assertTrue(self.cset.regex_test(regexfilter))
 
+    def test_compiled_cond(self):
+        c = changeset.regex_cond('.changes.modify.way.tag.name', '^Main')
+        self.assertEqual((c.action, c.elemtype, c.path), ('modify', 'way', ('tag', 'name')))
+        self.assertTrue(changeset.regex_cond('.changes.modify.way.tag.name', '^Main') is c)
+        c = changeset.regex_cond('.meta.tag.comment', '^Adjustments')
+        self.assertEqual((c.action, c.elemtype, c.path, c.on_changes), (None, None, ('meta', 'tag', 'comment'), False))
+
+    def test_scan_changes_single_pass(self):
+        self.cset.changes = [{"action": "modify", "type": "node",
+                              "data": {"id": 1, "version": 2, "tag": {"name": "Foo"}}},
+                             {"action": "create", "type": "way",
+                              "data": {"id": 2, "version": 1, "tag": {"highway": "residential"}}},
+                             {"action": "modify", "type": "way",
+                              "data": {"id": 3, "version": 3, "tag": {}}}]
+        self.cset.old = mock.Mock(return_value={'tag': {'name': 'Bar'}})
+        conds = [changeset.regex_cond('.changes.tag.name', '^Foo'),
+                 changeset.regex_cond('.changes.way.tag.highway', ''),
+                 changeset.regex_cond('.changes.modify.way.tag.name', '^Bar'),
+                 changeset.regex_cond('.changes.delete.tag.name', '')]
+        matched = self.cset.scan_changes(conds)
+        self.assertEqual(matched, set(conds[:3]))
+        # Old version only fetched for modified way where new version did not match
+        self.cset.old.assert_called_once_with('way', 3, 2, only_visible=False)
+
 
 if __name__ == '__main__':
     unittest.main()
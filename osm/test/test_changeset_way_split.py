@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+import unittest
+import changeset
+
+def way(wid, nd):
+    return {'id': wid, 'version': 1, 'nd': nd}
+
+class TestWayNodeIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.cset = changeset.Changeset(id=1)
+        self.cset.changes = [{'type': 'way', 'action': 'modify', 'data': way(1, [1, 2, 3])},
+                             {'type': 'way', 'action': 'create', 'data': way(2, [3, 4, 5])},
+                             {'type': 'way', 'action': 'create', 'data': way(3, [5, 6])},
+                             {'type': 'way', 'action': 'delete', 'data': way(4, [])},
+                             {'type': 'node', 'action': 'create', 'data': {'id': 6, 'version': 1}}]
+
+    def test_index(self):
+        index = self.cset.wayNodeIndex()
+        self.assertEqual(index['create'][5], [2, 3])
+        self.assertEqual(index['modify'][3], [1])
+        self.assertFalse(6 in index['modify'])
+        self.assertTrue(self.cset.wayNodeIndex() is index)
+
+    def test_find_nodes_in_other_ways(self):
+        self.assertEqual(sorted(self.cset.findNodesInOtherWays([3, 4, 7], edit_action='create')), [3, 4])
+        self.assertEqual(self.cset.findNodesInOtherWays([3, 4, 7], edit_action='modify'), [3])
+        self.assertEqual(self.cset.findNodesInOtherWays([3], edit_action='delete'), [])
+        # Index follows new changes
+        self.cset.changes = self.cset.changes[1:]
+        self.assertEqual(self.cset.findNodesInOtherWays([3, 4, 7], edit_action='modify'), [])
+
+if __name__ == '__main__':
+    unittest.main()
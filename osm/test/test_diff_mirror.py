@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+import unittest
+import mock
+from mock import patch
+import os
+import shutil
+import tempfile
+import gzip
+from StringIO import StringIO
+import diff
+
+STATE_TXT = '''#Sat Nov 24 13:37:02 UTC 2018
+sequenceNumber={seqno}
+timestamp=2018-11-24T13\\:36\\:02Z
+'''
+
+CSET_XML = '<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n<changeset id="1000" created_at="2018-11-25T10:13:00Z" open="true" user="User" uid="10" min_lat="54.0" max_lat="54.1" min_lon="10.0" max_lon="10.1" comments_count="0"></changeset>\n</osm>\n'
+
+class testResponse(object):
+    def __init__(self, content):
+        self.status_code = 200
+        self.content = content
+        self.text = ''
+        self.headers = {}
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i+chunk_size]
+
+def gzipped(txt):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='w') as f:
+        f.write(txt)
+    return buf.getvalue()
+
+class TestDiffMirror(unittest.TestCase):
+
+    def setUp(self):
+        self.mirror = tempfile.mkdtemp()
+        self.session = mock.Mock()
+
+    def tearDown(self):
+        shutil.rmtree(self.mirror)
+
+    def test_state_mirrored(self):
+        self.session.get.return_value = testResponse(STATE_TXT.format(seqno=3000123))
+        api = diff.OsmDiffApi(session=self.session, mirror=self.mirror)
+        st = api.get_state('minute', seqno=3000123)
+        self.assertEqual(st.sequenceno, 3000123)
+        fname = os.path.join(self.mirror, 'minute/003/000/123.state.txt')
+        self.assertTrue(os.path.isfile(fname))
+        # New API instance reads state from mirror, not network
+        api = diff.OsmDiffApi(session=self.session, mirror=self.mirror)
+        st = api.get_state('minute', seqno=3000123)
+        self.assertEqual(st.sequenceno, 3000123)
+        self.assertEqual(self.session.get.call_count, 1)
+
+    def test_head_state_not_read_from_mirror(self):
+        self.session.get.return_value = testResponse(STATE_TXT.format(seqno=3000123))
+        api = diff.OsmDiffApi(session=self.session, mirror=self.mirror)
+        api.get_state('minute')
+        self.assertTrue(os.path.isfile(os.path.join(self.mirror, 'minute/state.txt')))
+        self.session.get.return_value = testResponse(STATE_TXT.format(seqno=3000124))
+        st = diff.OsmDiffApi(session=self.session, mirror=self.mirror).get_state('minute')
+        self.assertEqual(st.sequenceno, 3000124)
+        self.assertEqual(self.session.get.call_count, 2)
+
+    def test_diff_mirrored(self):
+        self.session.get.return_value = testResponse(gzipped(CSET_XML))
+        api = diff.OsmDiffApi(session=self.session, mirror=self.mirror)
+        csets = api.get_cset_diff(1234)
+        self.assertEqual(csets.keys(), [1000])
+        fname = os.path.join(self.mirror, 'changesets/000/001/234.osm.gz')
+        self.assertTrue(os.path.isfile(fname))
+        self.assertEqual([f for f in os.listdir(os.path.dirname(fname)) if f.startswith('.tmp')], [])
+        csets = api.get_cset_diff(1234)
+        self.assertEqual(csets.keys(), [1000])
+        self.assertEqual(self.session.get.call_count, 1)
+
+    def test_file_url(self):
+        # Replay from a local replication tree without network access
+        os.makedirs(os.path.join(self.mirror, 'minute/003/000'))
+        with open(os.path.join(self.mirror, 'minute/003/000/123.state.txt'), 'w') as f:
+            f.write(STATE_TXT.format(seqno=3000123))
+        api = diff.OsmDiffApi(session=self.session, repl_url='file://'+self.mirror)
+        st = api.get_state('minute', seqno=3000123)
+        self.assertEqual(st.sequenceno, 3000123)
+        self.assertRaises(diff.OsmDiffException, api.get_state, 'minute', 3000124)
+        self.assertEqual(self.session.get.call_count, 0)
+
+if __name__ == '__main__':
+    unittest.main()
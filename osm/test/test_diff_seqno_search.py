@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import unittest
+import mock
+from mock import patch
+import logging
+import datetime, pytz
+import diff
+
+logger = logging.getLogger('')
+
+class TestSeqnoSearch(unittest.TestCase):
+
+    def setUp(self):
+        #logging.basicConfig(level=logging.DEBUG)
+        self.dapi = diff.OsmDiffApi()
+        self.epoch = datetime.datetime(2018, 1, 1).replace(tzinfo=pytz.utc)
+        self.head_seqno = 3000000
+        self.fetched = []
+
+    def get_state(self, stype, seqno=None):
+        '''One state per minute, with a 30 minute outage at seqno 2990000'''
+        if seqno is None:
+            seqno = self.head_seqno
+        self.fetched.append(seqno)
+        st = diff.State(stype, autoload=False, seqno=seqno)
+        minutes = seqno
+        if seqno > 2990000:
+            minutes += 30
+        st.state['timestamp_dt'] = self.epoch+datetime.timedelta(minutes=minutes, seconds=7)
+        return st
+
+    def search(self, timestamp, max_iter=None):
+        with patch.object(self.dapi, 'get_state', side_effect=self.get_state):
+            head = self.dapi.get_state('changesets')
+            self.fetched = []
+            return self.dapi.get_seqno_le_timestamp('changesets', timestamp, head, max_iter)
+
+    def test_search_day_ago(self):
+        ts = self.epoch+datetime.timedelta(minutes=self.head_seqno+30-1440, seconds=30)
+        st = self.search(ts)
+        self.assertEqual(st.sequenceno, self.head_seqno-1440)
+        self.assertTrue(len(self.fetched) < 10)
+
+    def test_search_across_gap(self):
+        for minutes, expected in [(2990000+10, 2990000), (2990000+31, 2990001), (2000000, 2000000), (12345, 12345)]:
+            ts = self.epoch+datetime.timedelta(minutes=minutes, seconds=10)
+            st = self.search(ts)
+            self.assertEqual(st.sequenceno, expected)
+            self.assertTrue(st.timestamp() <= ts)
+            self.assertTrue(len(self.fetched) < 60)
+
+    def test_search_newer_than_head(self):
+        ts = self.epoch+datetime.timedelta(minutes=self.head_seqno+100)
+        st = self.search(ts)
+        self.assertEqual(st.sequenceno, self.head_seqno)
+        self.assertEqual(self.fetched, [])
+
+    def test_search_max_iter(self):
+        ts = self.epoch+datetime.timedelta(minutes=self.head_seqno+30-100)
+        self.assertEqual(self.search(ts, max_iter=50), None)
+        st = self.search(ts, max_iter=200)
+        self.assertEqual(st.sequenceno, self.head_seqno-101)
+
+if __name__ == '__main__':
+    unittest.main()
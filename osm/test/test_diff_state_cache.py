@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import unittest
+import mock
+import logging
+import diff
+
+logger = logging.getLogger('')
+
+HEAD_YAML = '''---
+last_run: 2018-11-25 10:13:01.000000000 +00:00
+sequence: {seqno}
+'''
+
+STATE_TXT = '''---
+last_run: 2018-11-25 10:{minute:02d}:01.069617000 +00:00
+sequence: {seqno}
+'''
+
+class testResponse(object):
+    def __init__(self, status_code, content='', headers={}):
+        self.status_code = status_code
+        self.content = content
+        self.text = content
+        self.headers = headers
+
+class testSession(object):
+    '''HTTP session serving replication state files, honouring conditional requests'''
+    def __init__(self):
+        self.head_seqno = 1234
+        self.requests = []
+
+    def get(self, url, headers={}, **kwargs):
+        self.requests.append((url, headers))
+        if url.endswith('/state.yaml'):
+            etag = '"head-{}"'.format(self.head_seqno)
+            if headers.get('If-None-Match', None) == etag:
+                return testResponse(304)
+            return testResponse(200, HEAD_YAML.format(seqno=self.head_seqno), {'ETag': etag})
+        frag = url.split('/')[-3:]
+        seqno = int(frag[0])*1000000+int(frag[1])*1000+int(frag[2].split('.')[0])
+        return testResponse(200, STATE_TXT.format(seqno=seqno, minute=seqno%60))
+
+class TestStateCache(unittest.TestCase):
+
+    def setUp(self):
+        #logging.basicConfig(level=logging.DEBUG)
+        self.session = testSession()
+        self.dapi = diff.OsmDiffApi(session=self.session, state_cache_size=2)
+
+    def test_head_conditional(self):
+        head = self.dapi.get_state('changesets')
+        self.assertEqual(head.sequenceno, 1234)
+        self.assertEqual(self.session.requests[-1][1], {})
+        # Caller modifying returned state does not affect the cached head
+        head.sequenceno_advance(offset=-1)
+
+        retrieved = head.state['retrieved']
+        cached = self.dapi.head_state['changesets']
+        head = self.dapi.get_state('changesets')
+        self.assertEqual(head.sequenceno, 1234)
+        self.assertEqual(self.session.requests[-1][1], {'If-None-Match': '"head-1234"'})
+        # Unmodified head is refreshed
+        self.assertTrue(head.state['retrieved'] >= retrieved)
+        self.assertFalse(self.dapi.head_state['changesets'] is cached)
+        self.assertEqual(self.dapi.head_state['changesets'].state['retrieved'], head.state['retrieved'])
+
+        self.session.head_seqno = 1235
+        head = self.dapi.get_state('changesets')
+        self.assertEqual(head.sequenceno, 1235)
+        self.assertEqual(len(self.session.requests), 3)
+
+    def test_seqno_lru(self):
+        st = self.dapi.get_state('changesets', 1000)
+        self.assertEqual(st.sequenceno, 1000)
+        self.assertEqual(st.timestamp().minute, 1000%60)
+        self.dapi.get_state('changesets', 1000)
+        self.assertEqual(len(self.session.requests), 1)
+        self.dapi.get_state('changesets', 1001)
+        self.dapi.get_state('changesets', 1002)
+        self.assertEqual(len(self.session.requests), 3)
+        # Cache size 2, i.e. seqno 1000 evicted
+        self.dapi.get_state('changesets', 1000)
+        self.assertEqual(len(self.session.requests), 4)
+        self.dapi.get_state('changesets', 1002)
+        self.assertEqual(len(self.session.requests), 4)
+
+if __name__ == '__main__':
+    unittest.main()
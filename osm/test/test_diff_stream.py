@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+import unittest
+import mock
+from mock import patch
+import logging
+import gzip
+from StringIO import StringIO
+import diff
+
+logger = logging.getLogger('')
+
+CSET_XML = '<changeset id="{cid}" created_at="2018-11-25T10:13:00Z" open="true" user="User{cid}" uid="{cid}" min_lat="54.0" max_lat="54.1" min_lon="10.0" max_lon="10.1" comments_count="0"><tag k="comment" v="Changeset {cid}"/></changeset>\n'
+
+class testChunkedResponse(object):
+    def __init__(self, content, chunk_size):
+        self.status_code = 200
+        self.content = content
+        self.chunk_size = chunk_size
+        self.chunks_read = 0
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), self.chunk_size):
+            self.chunks_read += 1
+            yield self.content[i:i+self.chunk_size]
+
+def gzipped(txt):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='w') as f:
+        f.write(txt)
+    return buf.getvalue()
+
+class TestDiffStream(unittest.TestCase):
+
+    def setUp(self):
+        #logging.basicConfig(level=logging.DEBUG)
+        xml = '<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n'
+        for cid in range(1000, 1100):
+            xml += CSET_XML.format(cid=cid)
+        xml += '</osm>\n'
+        self.resp = testChunkedResponse(gzipped(xml), chunk_size=97)
+
+    @patch('diff.requests.get')
+    def test_iter_cset_diff(self, UrlGet):
+        UrlGet.return_value = self.resp
+        d = diff.Diff(1234, 'changesets')
+        csets = d.iter_cset_diff()
+        first = next(csets)
+        self.assertEqual(first['cid'], 1000)
+        self.assertEqual(first['user'], 'User1000')
+        self.assertEqual(first['bbox'].to_dict(), {'lat_min': 54.0, 'lat_max': 54.1, 'lon_min': 10.0, 'lon_max': 10.1})
+        # First changeset available before the full body has been received
+        self.assertTrue(self.resp.chunks_read < len(self.resp.content)/self.resp.chunk_size)
+        rest = list(csets)
+        self.assertEqual(len(rest), 99)
+        self.assertEqual(rest[-1]['cid'], 1099)
+        UrlGet.assert_called_once_with(d._data_url(), stream=True)
+
+    @patch('diff.requests.get')
+    def test_get_cset_diff(self, UrlGet):
+        UrlGet.return_value = self.resp
+        csets = diff.Diff(1234, 'changesets').get_cset_diff()
+        self.assertEqual(len(csets), 100)
+        self.assertTrue(1042 in csets)
+
+    @patch('diff.requests.get')
+    def test_get_csets_osc(self, UrlGet):
+        osc = '''<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+<create><node id="1" version="1" changeset="10" lat="55.0" lon="11.0"/><node id="2" version="1" changeset="10" lat="55.5" lon="11.5"/></create>
+<modify><way id="3" version="2" changeset="11"><nd ref="1"/><nd ref="2"/></way><node id="4" version="3" changeset="11" lat="56.0" lon="12.0"/></modify>
+<delete><node id="5" version="2" changeset="12"/></delete>
+</osmChange>
+'''
+        UrlGet.return_value = testChunkedResponse(gzipped(osc), chunk_size=13)
+        csets = diff.Diff(2345, 'minute').get_csets()
+        self.assertEqual(sorted(csets.keys()), [10, 11, 12])
+        self.assertEqual(csets[10]['points_bbox'].to_dict(), {'lat_min': 55.0, 'lat_max': 55.5, 'lon_min': 11.0, 'lon_max': 11.5})
+        self.assertEqual(csets[11]['points_bbox'].to_dict(), {'lat_min': 56.0, 'lat_max': 56.0, 'lon_min': 12.0, 'lon_max': 12.0})
+        self.assertEqual(csets[12]['points_bbox'].to_dict(), None)
+
+if __name__ == '__main__':
+    unittest.main()
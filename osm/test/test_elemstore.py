@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import unittest
+import mock
+import datetime
+import elemstore
+import changeset
+
+T0 = datetime.datetime(2018, 11, 1)
+
+def node(nid, version):
+    return {'id': nid, 'version': version, 'timestamp': T0, 'visible': True,
+            'uid': 1, 'user': 'user', 'tag': {}, 'lat': 55.0, 'lon': 11.0}
+
+class TestElementStore(unittest.TestCase):
+
+    def test_lru(self):
+        store = elemstore.ElementStore(maxsize=2)
+        store.put('node', node(1, 1))
+        store.put('node', node(2, 1))
+        store.put('node', node(3, 1))
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.get('node', 1, 1), None)
+        e = store.get('node', 3, 1)
+        self.assertEqual(e['id'], 3)
+        e['tag']['foo'] = 'bar' # Copies are returned
+        self.assertEqual(store.get('node', 3, 1)['tag'], {})
+
+    def test_backend(self):
+        backend = mock.Mock()
+        backend.elements_get.return_value = {(1, 2): node(1, 2)}
+        store = elemstore.ElementStore(backend=backend)
+        self.assertEqual(store.get('node', 1, 2)['version'], 2)
+        self.assertEqual(store.get('node', 1, 2)['version'], 2)
+        backend.elements_get.assert_called_once_with('node', [(1, 2)])
+        store.put('node', node(5, 1))
+        backend.elements_put.assert_called_once_with('node', [node(5, 1)])
+        backend.elements_get.side_effect = Exception('Connection lost')
+        self.assertEqual(store.get('node', 6, 1), None)
+
+    def test_backend_batches(self):
+        backend = mock.Mock()
+        backend.elements_get.side_effect = lambda etype, refs: {(2, 1): node(2, 1)}
+        store = elemstore.ElementStore(backend=backend)
+        store.put_many('node', [node(1, 1), node(3, 1)])
+        backend.elements_put.assert_called_once_with('node', [node(1, 1), node(3, 1)])
+        elems = store.get_many('node', [(1, 1), (2, 1), (4, 1)])
+        self.assertEqual(sorted(elems.keys()), [(1, 1), (2, 1)])
+        # Only versions not cached are looked up, in one request
+        backend.elements_get.assert_called_once_with('node', [(2, 1), (4, 1)])
+        store.put_many('node', [node(1, 1), node(2, 1)])
+        self.assertEqual(backend.elements_put.call_count, 1)
+
+class TestChangesetElementStore(unittest.TestCase):
+
+    def setUp(self):
+        changeset.element_store = elemstore.ElementStore()
+
+    def tearDown(self):
+        changeset.element_store = None
+
+    def test_shared_between_changesets(self):
+        changes = [{'type': 'node', 'action': 'modify', 'data': node(1, 2)}]
+        for cid in [1, 2]:
+            c = changeset.Changeset(id=cid)
+            c.osmapi = mock.Mock()
+            c.osmapi.NodesGet.side_effect = lambda ids: {1: node(1, 1)}
+            c.changes = changes
+            c.downloadGeometry()
+            self.assertEqual(c.old('node', 1, 1)['version'], 1)
+            self.assertEqual(c.osmapi.NodesGet.called, cid==1)
+        c.osmapi.NodeGet.return_value = None
+        self.assertEqual(c.old('node', 1, 1)['version'], 1)
+        self.assertFalse(c.osmapi.NodeGet.called)
+
+if __name__ == '__main__':
+    unittest.main()
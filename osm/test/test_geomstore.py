@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import unittest
+import datetime, pytz
+from mock import patch
+import geomstore
+import changeset
+import stubs
+
+T0 = datetime.datetime(2018, 11, 1, 12, 30, 5)
+
+NODE = {'id': 10, 'version': 2, 'changeset': 1234, 'uid': 42, 'user': u'user',
+        'timestamp': T0, 'visible': True, 'tag': {u'amenity': u'bench'},
+        'lat': 55.123456789, 'lon': 11.987654321}
+WAY = {'id': 20, 'version': 1, 'changeset': 1234, 'uid': 42, 'user': u'user',
+       'timestamp': T0, 'visible': True, 'tag': {}, 'nd': [10, 11, 12]}
+RELATION = {'id': 30, 'version': 3, 'changeset': 1234, 'uid': 42, 'user': u'user',
+            'timestamp': T0, 'visible': True, 'tag': {u'type': u'route'},
+            'member': [{'type': u'way', 'ref': 20, 'role': u''}]}
+
+class TestGeometryStore(unittest.TestCase):
+
+    def test_round_trip(self):
+        hist = geomstore.new_history()
+        hist['node'].setdefault(10, {})[2] = NODE
+        hist['way'][20] = {1: WAY}
+        hist['relation'].setdefault(30, {})[3] = RELATION
+        self.assertEqual(hist['node'][10][2], NODE)
+        self.assertEqual(hist['way'][20][1], WAY)
+        self.assertEqual(hist['relation'][30][3], RELATION)
+        self.assertEqual(type(hist['node'][10][2]['timestamp']), datetime.datetime)
+
+    def test_extras(self):
+        store = geomstore.NodeStore()
+        ts = datetime.datetime(1971, 1, 1, tzinfo=pytz.utc)
+        # Partial node, e.g. from alternative source
+        partial = {'id': 1, 'lat': 55.0, 'lon': 11.0, 'visible': True, 'tag': {},
+                   'timestamp': ts, '_source': 'nodes_found'}
+        store[1] = {1: partial}
+        imported = dict(NODE, timestamp='2018-11-01T12:30:05Z', uid=None)
+        store.setdefault(10, {})[2] = imported
+        self.assertEqual(store[1][1], partial)
+        self.assertEqual(store[10][2], imported)
+        self.assertFalse('version' in store[1][1])
+
+    def test_versions(self):
+        store = geomstore.NodeStore()
+        store.setdefault(10, {})[2] = NODE
+        self.assertEqual(store.index[10], 0)
+        store[10][1] = dict(NODE, version=1, lat=55.0)
+        self.assertEqual(sorted(store[10].keys()), [1, 2])
+        self.assertTrue(1 in store[10])
+        self.assertFalse(3 in store[10])
+        self.assertEqual(store[10][1]['lat'], 55.0)
+        self.assertEqual(store.position_at(10, 1), (NODE['lon'], 55.0))
+        self.assertEqual(store.position_at(10, -1), (NODE['lon'], NODE['lat']))
+        self.assertEqual(store.position_at(10, -5), (NODE['lon'], 55.0))
+        self.assertEqual(store.position_at(10, 3), None)
+        self.assertEqual(store.position_at(11, -1), None)
+        self.assertEqual(store.get(11, {}), {})
+        self.assertFalse(11 in store)
+        self.assertRaises(KeyError, lambda: store[10][3])
+        # Changing returned elements does not change store
+        store[10][2]['tag']['name'] = 'x'
+        self.assertEqual(store[10][2], NODE)
+        del store[10][1]
+        self.assertEqual(store[10].keys(), [2])
+        store[10] = {5: dict(NODE, version=5)}
+        self.assertEqual(store[10].keys(), [5])
+        self.assertEqual(len(store), 1)
+
+    @patch('poly.Poly')
+    @patch('changeset.OsmApi')
+    def test_export_unchanged(self, OsmApi, Poly):
+        OsmApi.return_value = stubs.testOsmApi()
+        Poly.return_value.contains_chgset.return_value = True
+        for cid in [10, 11, 12]:
+            exports = []
+            for compact in [True, False]:
+                cset = changeset.Changeset(id=cid)
+                if not compact:
+                    cset.hist = {'node': {}, 'way': {}, 'relation': {}}
+                cset.downloadMeta()
+                cset.downloadData()
+                cset.downloadGeometry()
+                cset.analyse()
+                exports.append(cset.data_export())
+            self.assertEqual(exports[0], exports[1])
+            self.assertTrue(exports[0]['geometry']['node'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+import unittest
+import mock
+import datetime, pytz
+import diff
+import poly
+
+T0 = datetime.datetime(2018, 11, 25, 10, 0, 0).replace(tzinfo=pytz.utc)
+
+class TestPointsBBoxIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.head = 105
+        self.diffs = {
+            102: {10: {'points_bbox': poly.BBox(10.0, 55.0)}},
+            103: {10: {'points_bbox': poly.BBox(11.0, 56.0)},
+                  11: {'points_bbox': poly.BBox()}},
+            104: {11: {'points_bbox': poly.BBox(12.0, 54.0, 12.5, 54.5)}},
+            105: {12: {'points_bbox': poly.BBox(9.0, 57.0)}},
+        }
+        self.dapi = mock.Mock()
+        self.dapi.get_state.side_effect = self.get_state
+        self.dapi.get_diff.side_effect = lambda seqno, stype: self.diffs[seqno]
+
+    def get_state(self, stype, seqno=None):
+        if seqno is None:
+            seqno = self.head
+        st = diff.State(stype, autoload=False, seqno=seqno)
+        st.state['timestamp_dt'] = T0+datetime.timedelta(minutes=seqno-100)
+        return st
+
+    def test_update_to_head(self):
+        idx = diff.PointsBBoxIndex(self.dapi)
+        idx.seqno = 101
+        self.assertEqual(idx.update(), 4)
+        self.assertEqual(idx.seqno, 105)
+        self.assertEqual(idx.get(10).to_dict(), {'lat_min': 55.0, 'lat_max': 56.0, 'lon_min': 10.0, 'lon_max': 11.0})
+        self.assertEqual(idx.get(11).to_dict(), {'lat_min': 54.0, 'lat_max': 54.5, 'lon_min': 12.0, 'lon_max': 12.5})
+        self.assertEqual(idx.get(13), None)
+        self.assertEqual(idx.update(), 0)
+
+    def test_update_until(self):
+        idx = diff.PointsBBoxIndex(self.dapi)
+        idx.seqno = 101
+        self.assertEqual(idx.update(until=T0+datetime.timedelta(minutes=3)), 2)
+        self.assertEqual(idx.seqno, 103)
+        self.assertEqual(idx.get(11).to_dict(), None)
+        self.assertEqual(idx.get(12), None)
+
+    def test_initial_update_at_head(self):
+        idx = diff.PointsBBoxIndex(self.dapi)
+        self.assertEqual(idx.update(), 1)
+        self.assertEqual(idx.get(12).to_dict(), {'lat_min': 57.0, 'lat_max': 57.0, 'lon_min': 9.0, 'lon_max': 9.0})
+
+    def test_bounded(self):
+        idx = diff.PointsBBoxIndex(self.dapi, maxsize=2)
+        idx.seqno = 101
+        idx.update()
+        self.assertEqual(idx.get(10), None)
+        self.assertTrue(idx.get(12))
+
+if __name__ == '__main__':
+    unittest.main()
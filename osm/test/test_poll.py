@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+import unittest
+import datetime, pytz
+import poll
+
+class TestPublicationScheduler(unittest.TestCase):
+
+    def test_epoch(self):
+        dt = datetime.datetime(2018, 11, 24, 13, 36, 2, 500000, tzinfo=pytz.utc)
+        self.assertEqual(poll.epoch(dt), 1543066562.5)
+
+    def test_default_period(self):
+        s = poll.PublicationScheduler(period=60, margin=1.0)
+        self.assertEqual(s.delay(1000.0), 0)
+        self.assertTrue(s.observe(1000.0))
+        self.assertFalse(s.observe(1000.0))
+        self.assertEqual(s.period(), 60)
+        self.assertEqual(s.delay(1010.0), 51.0)
+
+    def test_learned_period(self):
+        s = poll.PublicationScheduler(period=60, margin=1.0)
+        for ts in [1000.0, 1058.0, 1116.0, 1174.0, 1292.0]: # One missed publication
+            s.observe(ts)
+        self.assertEqual(s.period(), 58.0)
+        self.assertEqual(s.expected(), 1350.0)
+        self.assertEqual(s.delay(1300.0), 51.0)
+
+    def test_period_capped(self):
+        s = poll.PublicationScheduler(period=60)
+        for ts in [1000.0, 1300.0, 1600.0]:
+            s.observe(ts)
+        self.assertEqual(s.period(), 60)
+
+    def test_overdue_backoff(self):
+        s = poll.PublicationScheduler(period=60, margin=1.0, retry=1.0, max_retry=5.0)
+        s.observe(1000.0)
+        self.assertEqual([s.delay(1070.0) for i in range(5)], [1.0, 2.0, 4.0, 5.0, 5.0])
+        s.observe(1062.0)
+        self.assertEqual(s.delay(1070.0), 53.0)
+        self.assertEqual(s.delay(1130.0), 1.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import shutil
+import tempfile
+import mock
+import poly
+
+SQUARE = '''square
+1
+   10.0   54.0
+   12.0   54.0
+   12.0   56.0
+   10.0   56.0
+   10.0   54.0
+END
+END
+'''
+
+class TestPolyRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, 'region.poly')
+        with open(self.fname, 'w') as f:
+            f.write(SQUARE)
+
+    def tearDown(self):
+        poly.registry.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def test_contains(self):
+        area = poly.get_poly(self.fname)
+        self.assertTrue(area.contains(11.0, 55.0))
+        self.assertFalse(area.contains(13.0, 55.0))
+        self.assertTrue(area.contains(11.5, 55.5, 13.0, 57.0))
+        self.assertFalse(area.contains(13.0, 55.0, 14.0, 56.0))
+        self.assertTrue(area.contains_bbox({'lon_min': 9.0, 'lat_min': 53.0, 'lon_max': 10.5, 'lat_max': 54.5}))
+        self.assertEqual(area.center(), (11.0, 55.0))
+
+    def test_contains_points(self):
+        area = poly.get_poly(self.fname)
+        inside = area.contains_points([11.0, 13.0, 10.5], [55.0, 55.0, 54.5])
+        self.assertEqual(list(inside), [True, False, True])
+        self.assertEqual(len(area.contains_points([], [])), 0)
+
+    def test_contains_points_fallback(self):
+        area = poly.get_poly(self.fname)
+        with mock.patch.object(poly, 'vectorized', None):
+            inside = area.contains_points([11.0, 13.0], [55.0, 55.0])
+        self.assertEqual(list(inside), [True, False])
+
+    def test_cached(self):
+        area = poly.get_poly(self.fname)
+        self.assertTrue(poly.get_poly(self.fname) is area)
+
+    def test_reload_on_modification(self):
+        area = poly.get_poly(self.fname)
+        with open(self.fname, 'w') as f:
+            f.write(SQUARE.replace('12.0', '14.0'))
+        mtime = os.path.getmtime(self.fname)
+        os.utime(self.fname, (mtime+10, mtime+10))
+        area2 = poly.get_poly(self.fname)
+        self.assertFalse(area2 is area)
+        self.assertTrue(area2.contains(13.0, 55.0))
+
+    def test_missing_file(self):
+        self.assertRaises(IOError, poly.get_poly, os.path.join(self.tmpdir, 'missing.poly'))
+        self.assertEqual(len(poly.registry), 0)
+
+class TestRegionIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fnames = []
+        # Row of 1x1 degree squares
+        for i in range(20):
+            fname = os.path.join(self.tmpdir, 'sq{}.poly'.format(i))
+            with open(fname, 'w') as f:
+                f.write(SQUARE.replace('10.0', str(i)).replace('12.0', str(i+1)).replace('56.0', '55.0'))
+            self.fnames.append(fname)
+
+    def tearDown(self):
+        poly.registry.clear()
+        poly.indexes.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def test_query(self):
+        index = poly.get_index(self.fnames)
+        self.assertEqual(len(index), 20)
+        self.assertTrue(index.tree)
+        self.assertEqual(index.query_point(3.5, 54.5), set([self.fnames[3]]))
+        self.assertEqual(index.query_point(3.5, 56.5), set())
+        bbox = {'lon_min': 2.5, 'lat_min': 54.2, 'lon_max': 4.5, 'lat_max': 54.3}
+        self.assertEqual(index.query_bbox(bbox), set(self.fnames[2:5]))
+        bbox = {'lon_min': 7.5, 'lat_min': 54.2, 'lon_max': 7.5, 'lat_max': 54.2}
+        self.assertEqual(index.query_bbox(bbox), set([self.fnames[7]]))
+
+    def test_linear_query(self):
+        index = poly.get_index(self.fnames[:3])
+        self.assertEqual(index.tree, None)
+        bbox = {'lon_min': 0.5, 'lat_min': 54.2, 'lon_max': 4.5, 'lat_max': 54.3}
+        self.assertEqual(index.query_bbox(bbox), set(self.fnames[:3]))
+
+    def test_cached(self):
+        index = poly.get_index(self.fnames)
+        self.assertTrue(poly.get_index(list(reversed(self.fnames))) is index)
+        mtime = os.path.getmtime(self.fnames[0])
+        os.utime(self.fnames[0], (mtime+10, mtime+10))
+        self.assertFalse(poly.get_index(self.fnames) is index)
+
+if __name__ == '__main__':
+    unittest.main()
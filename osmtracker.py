@@ -1,11 +1,14 @@
 #!/usr/bin/env python
 
-import sys, time
+import sys, os, time
 import argparse
 import osmapi
 import osm.changeset
 import osm.diff as osmdiff
+import osm.elemstore
 import osm.poly
+import osm.poll
+import osm.replay
 import json, pickle
 import datetime, pytz, dateutil.parser
 import pprint
@@ -22,6 +25,7 @@ import BackendHtml, BackendHtmlSummary, BackendGeoJson
 import prometheus_client
 import messagebus
 import eventlet
+import numpy
 
 eventlet.monkey_patch()
 
@@ -36,9 +40,16 @@ AMQP_NEW_GENERATION_KEY = 'new_generation.osmtracker'
 AMQP_NEW_POINTER_KEY = 'new_replication_pointer.osmtracker'
 AMQP_REPLICATION_POINTER_QUEUE = ('replication_pointer', AMQP_NEW_POINTER_KEY, True)
 AMQP_QUEUES = [AMQP_FILTER_QUEUE, AMQP_ANALYSIS_QUEUE, AMQP_REFRESH_QUEUE]
+PUBLISH_BATCH_SIZE = 100    # Max changesets per published batch while parsing diff
+FILTER_LINGER_S = 0.5       # Max wait for filter batch to fill, checked every FILTER_LINGER_S
+POINTS_BBOX_SLACK = datetime.timedelta(minutes=2) # Minutely diffs lag changeset diffs
+POINTS_BBOX_MAX_BACKLOG = 24*60 # Max minutely diffs to join when catching up
 
 EVENT_LABELS = ['event', 'action']
 
+# Filter result of already admitted changeset, see cset_filter()
+FILTER_REFRESHED = 'refreshed'
+
 def fetch_and_process_diff(config, dapi, seqno, ctype):
     return dapi.get_diff(seqno, ctype)
 
@@ -132,12 +143,12 @@ def cset_process(config, db, cset, debug=0):
         c.downloadMeta() # FIXME: Use data from db
         c.downloadData()
         #c.downloadGeometry()
+        c.fetch_concurrency = config.get('history_fetch_concurrency', 'tracker',
+                                         default=osm.changeset.Changeset.FETCH_CONCURRENCY)
         maxtime = config.get('cset_processing_time_max_s', 'tracker')
         c.downloadGeometry(maxtime=maxtime)
-        c.getGeoJsonDiff()
         #c.getReferencedElements()
-        c.buildSummary(maxtime=maxtime)
-        c.buildDiffList(maxtime=maxtime)
+        c.analyse(maxtime=maxtime)
     except osm.changeset.Timeout as e:
         truncated = 'Timeout'
 
@@ -165,22 +176,132 @@ def cset_reprocess(config, db, cset):
     cset_process_local1(config, db, cset, info)
     return info
 
-def diff_fetch_single(args, config, dapi, db, amqp, ptr):
-    start = time.time()
-    chgsets = fetch_and_process_cset_diff(config, dapi, ptr, 'changesets')
+def diff_fetch_message(cset, pindex=None):
+    msg = dict(cset)
+    msg['source'] = dict(cset['source'])
+    msg['source']['observed'] = cset['source']['observed'].isoformat()
+    msg['bbox'] = cset['bbox'].to_dict()
+    if not msg['bbox']:
+        del msg['bbox']
+    if pindex:
+        points_bbox = pindex.get(cset['cid'])
+        if points_bbox and points_bbox.to_dict():
+            msg['points_bbox'] = points_bbox.to_dict()
+    return msg
+
+def diff_fetch_publish(amqp, csets, pindex=None, prefilter=None):
+    if prefilter:
+        csets = [cset for cset in csets if region_prefilter_pass(prefilter, cset)]
+    msgs = [diff_fetch_message(cset, pindex) for cset in csets]
+    logger.debug('Sending {} changesets to messagebus: {}'.format(len(msgs), [m['cid'] for m in msgs]))
+    amqp.send_batch(msgs, schema_name='cset', schema_version=2,
+                    routing_key='new_cset.osmtracker')
+
+def region_prefilter_build(config):
+    '''Build region pre-filter from label rules and filters. The pre-filter is a list
+       with an entry per 'prefilter_labels' clause. Each entry lists, for the
+       labels of the clause that can only be set by an area check, the
+       polygons of those area checks. Returns None if some clause may pass
+       without an area check, i.e. if the pre-filter cannot drop anything'''
+    rules = config.get('pre_labels','tracker', default=[])
+    label_areas = {}
+    for dd in rules:
+        if 'regex' not in dd and 'area_file' not in dd:
+            continue    # Ignored by label rules too
+        label = dd['label']
+        if 'area_file' not in dd:
+            label_areas[label] = None  # Label can be set without area check
+        elif label_areas.get(label, []) is not None:
+            area_file = os.environ.get('OSMTRACKER_REGION', dd['area_file'])
+            label_areas[label] = label_areas.get(label, [])+[area_file]
+    areas = {}
+    prefilter = []
+    for lf in config.get('prefilter_labels','tracker', default=[]):
+        clause = []
+        for label in lf:
+            files = label_areas.get(label, None)
+            if not files:
+                continue
+            polys = []
+            for area_file in files:
+                if area_file not in areas:
+                    areas[area_file] = osm.poly.get_poly(area_file)
+                polys.append(areas[area_file])
+            clause.append(polys)
+        if not clause:
+            logger.info('Filter clause {} does not require area labels, region pre-filter disabled'.format(lf))
+            return None
+        prefilter.append(clause)
+    if not prefilter:
+        return None
+    logger.info('Region pre-filter using areas {}'.format(areas.keys()))
+    return prefilter
+
+def region_prefilter_pass(prefilter, cset):
+    '''Test if changeset might pass label filters given its bbox, i.e. if some
+       filter clause has all its area labels intersecting the bbox. Changesets
+       without a bbox always pass'''
+    bbox = cset['bbox'].to_dict()
+    if not bbox:
+        return True
+    for clause in prefilter:
+        if all([any([area.contains_bbox(bbox) for area in polys]) for polys in clause]):
+            return True
+    cset['prefiltered'] = True
+    logger.debug('Cset {} outside region, dropped by pre-filter'.format(cset['cid']))
+    return False
+
+def uses_points_bbox(config):
+    rules = config.get('pre_labels','tracker', default=[])
+    return any([r.get('area_check_type', None)=='points-bbox' for r in rules])
+
+def points_bbox_update(pindex, until=None):
+    '''Join minutely diffs into points bbox index. Failures are not fatal, area
+       checks fall back to changeset bbox'''
+    if not pindex:
+        return
+    try:
+        pindex.update(until)
+    except (osmdiff.OsmDiffException, requests.exceptions.RequestException, eventlet.timeout.Timeout) as e:
+        logger.warning('Failed updating points bbox index: {}'.format(e))
+
+def diff_fetch_single(args, config, dapi, db, amqp, ptr, pindex=None, prefilter=None):
+    # Changesets are published in batches while the diff is still being
+    # downloaded and parsed
+    chgsets = {}
+    batch = []
+    points_bbox_update(pindex)
+    for cset in dapi.iter_cset_diff(ptr):
+        batch.append(cset)
+        chgsets[cset['cid']] = cset
+        if len(batch) >= PUBLISH_BATCH_SIZE:
+            diff_fetch_publish(amqp, batch, pindex, prefilter)
+            batch = []
+    diff_fetch_publish(amqp, batch, pindex, prefilter)
     logger.debug('Found {} changesets: {}'.format(len(chgsets), chgsets.keys()))
-    for cid,cset in chgsets.iteritems():
-        msg = cset              # 
-        msg['source']['observed'] = cset['source']['observed'].isoformat()
-        msg['bbox'] = cset['bbox'].to_dict()
-        if not msg['bbox']:
-            del msg['bbox']
-        logger.debug('Sending to messagebus: {}'.format(msg))
-        r = amqp.send(msg, schema_name='cset', schema_version=1,
-                  routing_key='new_cset.osmtracker')
-        logger.debug('Send result: {}'.format(r))
     return chgsets
 
+def diff_fetch_prefetch(config, dapi, seqno):
+    '''Fetch and parse changeset diff and state for a single sequence number. Does
+       not use database or messagebus, i.e. can be run concurrently'''
+    chgsets = fetch_and_process_cset_diff(config, dapi, seqno, 'changesets')
+    state = dapi.get_state('changesets', seqno=seqno)
+    return (seqno, chgsets, state)
+
+def diff_fetch_catchup(args, config, dapi, db, amqp, ptr, head, window, commit, pindex=None, prefilter=None):
+    '''Fetch a window of sequence numbers concurrently. Results are published and
+       the pointer advanced in sequence number order, i.e. the pointer only
+       moves over a contiguous range of completed sequence numbers'''
+    last = min(head.sequenceno, ptr+window-1)
+    logger.info('Catching up, fetching seqno {} to {} (head {})'.format(ptr, last, head.sequenceno))
+    pool = eventlet.GreenPool(window)
+    for seqno, chgsets, state in pool.imap(lambda s: diff_fetch_prefetch(config, dapi, s),
+                                           range(ptr, last+1)):
+        points_bbox_update(pindex, state.timestamp()+POINTS_BBOX_SLACK)
+        diff_fetch_publish(amqp, chgsets.values(), pindex, prefilter)
+        commit(seqno, state, chgsets)
+    return last
+
 def diff_fetch(args, config, db):
     logger.debug('Fetching minutely diff')
 
@@ -206,8 +327,14 @@ def diff_fetch(args, config, db):
                                           'Number of changesets observed in recently processed minutely diff')
         m_events = prometheus_client.Counter('osmtracker_events',
                                              'Number of events', EVENT_LABELS)
+        m_detect = prometheus_client.Histogram('osmtracker_changeset_state_detect_latency_seconds',
+                                               'Time from publication of changeset replication state until detected (seconds)',
+                                               buckets=(0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 45, 60, 90, 120))
 
-    dapi = osmdiff.OsmDiffApi()
+    if args:
+        dapi = osmdiff.OsmDiffApi(repl_url=args.replication_url, mirror=args.replication_mirror)
+    else:
+        dapi = osmdiff.OsmDiffApi()
     ptr = db.pointer
 
     if args:
@@ -228,31 +355,60 @@ def diff_fetch(args, config, db):
             db.pointer = head
             logger.debug('Initialized pointer to:{}'.format(db.pointer))
 
+    def pointer_commit(seqno, nptr, chgsets):
+        prefiltered = len([c for c in chgsets.values() if c.get('prefiltered', False)])
+        m_events.labels('filter', 'in').inc(len(chgsets)-prefiltered)
+        m_events.labels('prefilter', 'drop').inc(prefiltered)
+        # Set timestamp from old seqno as new seqno might not yet exist
+        db.pointer_meta_update({'timestamp': nptr.timestamp()})
+        db.pointer_advance()
+
+        m_diff_ts.set(time.mktime(nptr.timestamp().timetuple())+nptr.timestamp().microsecond/1E6)
+        m_diff_proc_ts.set_to_current_time()
+        m_seqno.set(seqno)
+        m_head_seqno.set(head.sequenceno)
+        m_csets.set(len(chgsets))
+        msg = {'pointer': seqno}
+        r = amqp_gen.send(msg, schema_name='replication_pointer', schema_version=1,
+                          routing_key=AMQP_NEW_POINTER_KEY)
+        logger.debug('New pointer send result: {}'.format(r))
+        m_events.labels('new_pointer', 'in').inc()
+
+    if uses_points_bbox(config):
+        pindex = osmdiff.PointsBBoxIndex(dapi)
+        try:
+            pindex.seek(db.pointer['timestamp']-POINTS_BBOX_SLACK, max_iter=POINTS_BBOX_MAX_BACKLOG)
+        except (osmdiff.OsmDiffException, requests.exceptions.RequestException, KeyError) as e:
+            logger.warning('Unable to position points bbox index at pointer: {}'.format(e))
+    else:
+        pindex = None
+
+    if args and args.region_prefilter:
+        prefilter = region_prefilter_build(config)
+    else:
+        prefilter = None
+
+    window = args.catchup_window if args else 1
+    sched = osm.poll.PublicationScheduler(period=dapi.REPLICATION_PERIOD_S['changesets'])
     while True:
         try:
             ptr = db.pointer['seqno']
             head = dapi.get_state('changesets', seqno=None)
+            published = osm.poll.epoch(head.timestamp())
+            first = not sched.timestamps
+            if sched.observe(published) and not first and args and args.metrics:
+                m_detect.observe(max(0, time.time()-published))
             start = None
-            if ptr <= head.sequenceno:
+            if ptr < head.sequenceno and window > 1:
+                start = time.time()
+                ptr = diff_fetch_catchup(args, config, dapi, db, amqp, ptr, head, window, pointer_commit, pindex, prefilter)
+            elif ptr <= head.sequenceno:
+                start = time.time()
                 logger.debug('Fetching diff, ptr={}, head={}'.format(ptr, head))
-                chgsets = diff_fetch_single(args, config, dapi, db, amqp, ptr)
-                m_events.labels('filter', 'in').inc(len(chgsets))
-                # Set timestamp from old seqno as new seqno might not yet exist
+                chgsets = diff_fetch_single(args, config, dapi, db, amqp, ptr, pindex, prefilter)
                 seqno = db.pointer['seqno']
                 nptr = dapi.get_state('changesets', seqno=seqno)
-                db.pointer_meta_update({'timestamp': nptr.timestamp()})
-                db.pointer_advance()
-
-                m_diff_ts.set(time.mktime(nptr.timestamp().timetuple())+nptr.timestamp().microsecond/1E6)
-                m_diff_proc_ts.set_to_current_time()
-                m_seqno.set(seqno)
-                m_head_seqno.set(head.sequenceno)
-                m_csets.set(len(chgsets))
-                msg = {'pointer': seqno}
-                r = amqp_gen.send(msg, schema_name='replication_pointer', schema_version=1,
-                                  routing_key=AMQP_NEW_POINTER_KEY)
-                logger.debug('New pointer send result: {}'.format(r))
-                m_events.labels('new_pointer', 'in').inc()
+                pointer_commit(seqno, nptr, chgsets)
         except KeyboardInterrupt as e:
             logger.warn('Processing interrupted, exiting...')
             raise e
@@ -270,8 +426,8 @@ def diff_fetch(args, config, db):
             if args.metrics:
                 m_pt.observe(elapsed)
             if ptr >= head.sequenceno: # No more diffs to fetch
-                delay = min(60, max(0, 60-elapsed))
-                logger.info('Processing seqno {} took {:.2f}s. Sleeping {:.2f}s'.format(ptr, elapsed, delay))
+                delay = sched.delay(time.time())
+                logger.info('Processing seqno {} took {:.2f}s. Sleeping {:.2f}s (publication period {:.1f}s)'.format(ptr, elapsed, delay, sched.period()))
                 time.sleep(delay)
             else:
                 logger.info('Processing seqno {} took {:.2f}s. Head ptr is {}'.format(ptr, elapsed, head.sequenceno))
@@ -279,9 +435,38 @@ def diff_fetch(args, config, db):
             break
     return 0
 
-def cset_filter(config, db, new_cset):
+def bbox_within(inner, outer):
+    '''Test if bbox inner is contained in bbox outer. Missing bboxes only match each other'''
+    if not inner or not outer:
+        return not inner and not outer
+    return (outer['lon_min'] <= inner['lon_min'] and outer['lat_min'] <= inner['lat_min'] and
+            outer['lon_max'] >= inner['lon_max'] and outer['lat_max'] >= inner['lat_max'])
+
+def cset_source(new_cset):
+    return { 'type': new_cset['source']['type'],
+             'sequenceno': new_cset['source']['sequenceno'],
+             'observed': dateutil.parser.parse(new_cset['source']['observed'])}
+
+def cset_filter(config, db, new_cset, meta=None, decision_ttl=None):
+        '''Filter changeset and admit it to database if it matches the label
+           filters. With decision_ttl, decisions are stored such that changesets
+           observed repeatedly while open are not filtered again, an admitted
+           changeset only has its source refreshed and a rejected changeset is
+           dropped unless its bbox has grown. Returns True if admitted, False if
+           rejected and FILTER_REFRESHED if already admitted'''
         cid = new_cset['cid']
 
+        if decision_ttl:
+            decision = db.filter_decision_get(cid)
+            if decision:
+                if decision['passed']:
+                    if db.chgset_refresh(cid, cset_source(new_cset)):
+                        logger.debug('Cset {} already admitted, refreshed'.format(cid))
+                        return FILTER_REFRESHED
+                elif bbox_within(new_cset.get('bbox', None), decision['bbox']):
+                    logger.debug('Cset {} already rejected'.format(cid))
+                    return False
+
         # Apply labels
         labelrules = config.get('pre_labels','tracker')
         try:
@@ -289,7 +474,11 @@ def cset_filter(config, db, new_cset):
                 start = time.time()
                 logger.debug('Begin filtering cset {}'.format(cid))
                 c = osm.changeset.Changeset(cid, api=config.get('osm_api_url','tracker'))
-                clabels = c.build_labels(labelrules, bbox=new_cset.get('bbox', None))
+                if meta:
+                    c.set_meta(meta)
+                clabels = c.build_labels(labelrules, bbox=new_cset.get('bbox', None),
+                                         points_bbox=new_cset.get('points_bbox', None),
+                                         label_filters=config.get('prefilter_labels','tracker'))
                 logger.debug('Added labels to cid {}: {}'.format(cid, clabels))
         except (osmapi.ApiError, eventlet.timeout.Timeout) as e:
             logger.error('Failed reading changeset {}: {}'.format(cid, e))
@@ -307,12 +496,11 @@ def cset_filter(config, db, new_cset):
 
         if not passed_filters:
             logger.debug('Cset {} does not match filters'.format(cid))
+            if decision_ttl:
+                db.filter_decision_set(cid, False, bbox=new_cset.get('bbox', None), ttl=decision_ttl)
         else:
             logger.debug('Cset {} matches filters'.format(cid))
-            source = { 'type': new_cset['source']['type'],
-                       'sequenceno': new_cset['source']['sequenceno'],
-                       'observed': dateutil.parser.parse(new_cset['source']['observed'])}
-            cset = db.chgset_append(cid, source)
+            cset = db.chgset_append(cid, cset_source(new_cset))
             cset['labels'] = clabels
             try:
                 with eventlet.Timeout(10):
@@ -323,28 +511,106 @@ def cset_filter(config, db, new_cset):
                 return False
             db.chgset_set_meta(cid, c.meta)
             db.chgset_processed(cset, state=db.STATE_BOUNDS_CHECKED)
+            if decision_ttl:
+                db.filter_decision_set(cid, True, bbox=new_cset.get('bbox', None), ttl=decision_ttl)
             return True
         return False
 
+def csets_filter_batch(config, db, payloads, pool, decision_ttl=None):
+    '''Filter changesets concurrently. Meta of the changesets is downloaded in one
+       request first. Returns filter results in order of payloads'''
+    try:
+        with eventlet.Timeout(10):
+            metas = osm.changeset.download_metas([p['cid'] for p in payloads],
+                                                 api=config.get('osm_api_url','tracker'))
+    except (osmapi.ApiError, eventlet.timeout.Timeout) as e:
+        logger.warning('Failed reading meta of changesets {}: {}'.format([p['cid'] for p in payloads], e))
+        metas = {}
+    logger.debug('Got meta of {} of {} changesets in bulk'.format(len(metas), len(payloads)))
+    return list(pool.imap(lambda p: cset_filter(config, db, p, meta=metas.get(p['cid'], None),
+                                                decision_ttl=decision_ttl), payloads))
+
+def csets_filter_replay(args, config, db):
+    '''Filter recorded changesets against recorded OSM API responses and report
+       throughput, evaluation time per label rule and API calls per changeset'''
+    api = osm.replay.RecordedOsmApi(args.replay)
+    osm.replay.install(api)
+    payloads = osm.replay.load_payloads(args.replay)
+    plan = osm.changeset.get_label_plan(config.get('pre_labels','tracker'),
+                                        config.get('prefilter_labels','tracker'))
+    plan.timings = {}
+    pool = eventlet.GreenPool(args.concurrency)
+    passed = 0
+    start = time.time()
+    for i in range(0, len(payloads), args.concurrency):
+        results = csets_filter_batch(config, db, payloads[i:i+args.concurrency], pool,
+                                     decision_ttl=args.decision_ttl)
+        passed += len([r for r in results if r])
+    elapsed = time.time()-start
+    plan.timings, timings = None, plan.timings
+
+    print 'Filtered {} csets ({} passed) in {:.3f}s, {:.1f} csets/s'.format(len(payloads), passed, elapsed,
+                                                                       len(payloads)/max(elapsed, 1e-9))
+    print 'Label rule               Count   p50[ms]   p95[ms]   p99[ms]'
+    for (idx, label), t in sorted(timings.items()):
+        p50, p95, p99 = numpy.percentile(t, [50, 95, 99])*1000
+        print '{:2} {:20} {:7} {:9.3f} {:9.3f} {:9.3f}'.format(idx, label, len(t), p50, p95, p99)
+    print 'API calls per cset: {:.2f}'.format(sum(api.calls.values())/float(max(len(payloads), 1)))
+    for method, cnt in sorted(api.calls.items()):
+        print '  {:20} {:7}'.format(method, cnt)
+    return {'csets': len(payloads), 'passed': passed, 'elapsed': elapsed,
+            'timings': timings, 'api_calls': dict(api.calls)}
+
 def csets_filter_worker(args, config, db):
+    if args.replay:
+        csets_filter_replay(args, config, db)
+        return
+
 
     class FilterAmqp(messagebus.Amqp):
         def on_message(self, payload, message):
             logger.info('Filter: {}'.format(payload))
+            self.pending.append((payload, message, time.time()))
+            if len(self.pending) >= self.prefetch_count:
+                self.filter_pending()
+
+        def on_consume_ready(self, connection, channel, consumers, **kwargs):
+            # Deliveries from a lost channel can not be acked, they are
+            # redelivered by the broker
+            if self.pending:
+                logger.warning('Dropping {} csets pending filtering after reconnect'.format(len(self.pending)))
+            self.pending = []
+
+        def on_iteration(self):
+            # Filter partial batch when no more messages arrive
+            if self.pending and time.time()-self.pending[0][2] > FILTER_LINGER_S:
+                self.filter_pending()
+
+        def filter_pending(self):
+            pending, self.pending = self.pending, []
             start = time.time()
-            if cset_filter(self.config, self.db, payload):
-                amqp.send(payload, schema_name='cset', schema_version=1,
-                          routing_key='analysis_cset.osmtracker')
-                m_events.labels('analysis', 'in').inc()
-            m_events.labels('filter', 'out').inc()
-            elapsed = time.time()-start
-            m_filter_time.observe(elapsed)
-            logger.info('Filtering of cid {} took {:.2f}s'.format(payload['cid'], elapsed))
-            message.ack()
+            results = csets_filter_batch(self.config, self.db, [p for p, _, _ in pending], self.pool,
+                                         decision_ttl=args.decision_ttl)
+            # Publish and ack in order received
+            for (payload, message, received), passed in zip(pending, results):
+                if passed == FILTER_REFRESHED:
+                    # Only source updated, analysis is scheduled by the supervisor
+                    logger.debug('Cset {} refreshed, not forwarded'.format(payload['cid']))
+                elif passed:
+                    amqp.send(payload, schema_name='cset', schema_version=2,
+                              routing_key='analysis_cset.osmtracker')
+                    m_events.labels('analysis', 'in').inc()
+                m_events.labels('filter', 'out').inc()
+                m_filter_time.observe(time.time()-received)
+                message.ack()
+            logger.info('Filtering of {} csets took {:.2f}s'.format(len(pending), time.time()-start))
 
     amqp = FilterAmqp(args.amqp_url, AMQP_EXCHANGE_TOPIC, 'topic', AMQP_QUEUES, [AMQP_FILTER_QUEUE])
     amqp.config = config
     amqp.db = db
+    amqp.pending = []
+    amqp.prefetch_count = args.concurrency
+    amqp.pool = eventlet.GreenPool(args.concurrency)
 
     if args.metrics:
         m_events = prometheus_client.Counter('osmtracker_events',
@@ -352,8 +618,10 @@ def csets_filter_worker(args, config, db):
         m_filter_time = prometheus_client.Histogram('osmtracker_changeset_filter_processing_time_seconds',
                                                     'Changeset filtering time (seconds)')
 
-    logger.debug('Starting filter worker')
-    amqp.run()
+    logger.debug('Starting filter worker, concurrency {}'.format(args.concurrency))
+    # on_iteration() is only called when draining events returns, i.e. a
+    # partial batch waits at most about twice the linger time
+    amqp.run(safety_interval=FILTER_LINGER_S)
 
 def csets_analyse_initial(config, db, new_cset=None):
     # Initial and open changesets
@@ -589,6 +857,11 @@ def csets_analysis_worker(args, config, db):
     alt_source=config.get('osm_alt_source','tracker', default=None)
     if alt_source:
         logger.info('Using alternative source: {}'.format(alt_source))
+    osm.changeset.set_host_concurrency(config.get('api_host_concurrency', 'tracker',
+                                                  default=osm.changeset.HOST_CONCURRENCY))
+    # Element versions downloaded for one changeset are reused for later changesets
+    osm.changeset.element_store = osm.elemstore.ElementStore(
+        maxsize=config.get('element_cache_size', 'tracker', default=20000), backend=db)
     amqp.run()
 
 def supervisor(args, config, db):
@@ -675,9 +948,23 @@ def main():
     parser_diff_fetch.add_argument('--track', action='store_true', default=False,
                                    help='Fetch current and future minutely diffs')
     parser_diff_fetch.add_argument('--simulate', type=int, default=None, help='Simulate changeset observation')
+    parser_diff_fetch.add_argument('--catchup-window', dest='catchup_window', type=int, default=8,
+                                   help='Number of sequence numbers to fetch concurrently when behind head')
+    parser_diff_fetch.add_argument('--replication-url', dest='replication_url', default=None,
+                                   help='Base URL of replication files, e.g. a planet mirror or file:///path/replication/')
+    parser_diff_fetch.add_argument('--replication-mirror', dest='replication_mirror', default=None,
+                                   help='Local directory where fetched replication files are stored and read from')
+    parser_diff_fetch.add_argument('--region-prefilter', dest='region_prefilter', action='store_true', default=False,
+                                   help='Do not publish changesets with a bbox outside the areas required by prefilter_labels')
 
     parser_csets_filter = subparsers.add_parser('csets-filter')
     parser_csets_filter.set_defaults(func=csets_filter_worker)
+    parser_csets_filter.add_argument('--concurrency', dest='concurrency', type=int, default=8,
+                                     help='Number of changesets filtered concurrently')
+    parser_csets_filter.add_argument('--decision-ttl', dest='decision_ttl', type=int, default=3600,
+                                     help='Seconds filter decisions are reused for changesets seen again, 0 to disable')
+    parser_csets_filter.add_argument('--replay', dest='replay', default=None,
+                                     help='Benchmark filtering of changesets recorded in directory, no database or AMQP is used')
 
     parser_csets_analyse = subparsers.add_parser('csets-analyse')
     parser_csets_analyse.set_defaults(func=csets_analysis_worker)
@@ -703,7 +990,10 @@ def main():
         dbadm=True
     else:
         dbadm=False
-    db = database.DataBase(url=args.db_url, admin=dbadm)
+    if getattr(args, 'replay', None):
+        db = database.MemoryDataBase()
+    else:
+        db = database.DataBase(url=args.db_url, admin=dbadm)
     logger.info('DB URL: {} (RW={})'.format(db, dbadm))
 
     if args.amqp_url!='':
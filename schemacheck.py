@@ -30,7 +30,8 @@ def check(cset, meta, info):
                 'tagdiff': {'create':{}, 'delete':{}, 'modify':{}},
                 'simple_nodes': {'create':0, 'modify':0, 'delete':0},
                 'other_users': {},
-                'mileage_m': {'_navigable_create':0, '_navigable_delete':0, '_all_create':0, '_all_delete':0, 'by_type': {}},
+                'mileage_m': {'_navigable_create':0, '_navigable_modify':0, '_navigable_delete':0,
+                              '_all_create':0, '_all_modify':0, '_all_delete':0, 'by_type': {}},
                 'geometry': {'node': {}, 'way':{}, 'relation':{}}
         }
     return meta, info
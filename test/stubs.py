@@ -58,6 +58,7 @@ class testDB(object):
     def __init__(self, admin=False, sigint_on=[]):
         self.sigint_on = sigint_on
         self.csets = []
+        self.decisions = {}
         self.url = 'TESTDATABASE'
         self.generation = 1
         self.all_states = [self.STATE_NEW, self.STATE_BOUNDS_CHECK, self.STATE_BOUNDS_CHECKED,
@@ -143,6 +144,21 @@ class testDB(object):
     def chgset_append(self, cid, source=None):
         return self.test_add_cid(cid)
 
+    def chgset_refresh(self, cid, source):
+        c = self.find_cset(cid)
+        if not c:
+            return False
+        c['source'] = source
+        return True
+
+    def filter_decision_get(self, cid):
+        return self.decisions.get(cid, None)
+
+    def filter_decision_set(self, cid, passed, bbox=None, ttl=3600):
+        d = {'cid': cid, 'passed': passed, 'bbox': bbox}
+        self.decisions[cid] = d
+        return d
+
     def chgset_start_processing(self, istate, nstate, before=None, after=None, timestamp='state_changed', cid=None):
         c = self.chgsets_find(istate, before, after, timestamp, cid=cid)
         if c:
@@ -4,11 +4,14 @@ import mock
 from mock import patch, call
 import logging
 import osmtracker
+import config
 import db
 import stubs
 import osm.test.stubs
 import osm.diff as osmdiff
-import datetime
+import messagebus
+import datetime, pytz
+import eventlet
 import pprint
 
 logger = logging.getLogger('')
@@ -18,6 +21,10 @@ class Args:
     def __init__(self):
         self.metrics = True
         self.track = False
+        self.catchup_window = 4
+        self.region_prefilter = False
+        self.replication_url = None
+        self.replication_mirror = None
 
 class BaseTest(unittest.TestCase, stubs.FileWriter_Mixin):
     def setUp(self):
@@ -33,7 +40,7 @@ class BaseTest(unittest.TestCase, stubs.FileWriter_Mixin):
         
 class TestCsetDiff(BaseTest):
 
-    @patch('osm.diff.requests.get')
+    @patch('osm.diff.requests.Session.get')
     @patch('osm.poly.Poly')
     @patch('osm.changeset.OsmApi')
     def test_cset_diff_parse(self, OsmApi, Poly, UrlGet):
@@ -47,3 +54,169 @@ class TestCsetDiff(BaseTest):
         csets = osmtracker.diff_fetch_single(self.args, self.cfg, self.dapi, self.db, self.amqp, seqno)
         self.assertEqual(len(csets), 1)
         self.assertTrue(23456 in csets.keys())
+        self.assertEqual(self.amqp.send_batch.call_count, 1)
+        msgs = self.amqp.send_batch.call_args[0][0]
+        self.assertEqual([m['cid'] for m in msgs], [23456])
+
+class TestPublishBatch(unittest.TestCase):
+
+    def csets(self, num):
+        now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        return [{'cid': cid, 'bbox': osmdiff.poly.BBox(),
+                 'source': {'type': 'changesets', 'sequenceno': 1234, 'observed': now}}
+                for cid in range(num)]
+
+    def test_send_batch(self):
+        amqp = messagebus.Amqp('memory://', 'osmtracker', 'topic', osmtracker.AMQP_QUEUES)
+        csets = self.csets(10)
+        observed = csets[0]['source']['observed']
+        osmtracker.diff_fetch_publish(amqp, csets)
+        queue = [q for q in amqp.declare_queues if q.name=='new_cset'][0]
+        channel = amqp.producer_connection.channel()
+        received = []
+        while True:
+            msg = queue(channel).get(no_ack=True)
+            if not msg:
+                break
+            received.append(msg.payload)
+        self.assertEqual(len(received), 10)
+        self.assertEqual(received[0]['schema'], 'cset')
+        # Published changesets are left unmodified
+        self.assertEqual(csets[0]['source']['observed'], observed)
+
+    def confirming_channel(self, nack=()):
+        channel = mock.Mock()
+        channel.events = {'basic_ack': set(), 'basic_nack': set()}
+        published = []
+        def drain_events(timeout=None):
+            for tag in range(1, len(published)+1):
+                for cb in channel.events['basic_nack' if tag in nack else 'basic_ack']:
+                    cb(tag, False)
+        channel.connection.client.declared_entities = set()
+        return channel, published, drain_events
+
+    @patch('messagebus.kombu.Producer')
+    def test_send_batch_confirms(self, Producer):
+        amqp = messagebus.Amqp('memory://', 'osmtracker', 'topic', osmtracker.AMQP_QUEUES)
+        channel, published, drain_events = self.confirming_channel()
+        Producer.return_value.publish.side_effect = lambda msg, **kwargs: published.append(msg)
+        conn = mock.Mock(recoverable_connection_errors=())
+        conn.channel.return_value = channel
+        conn.drain_events.side_effect = drain_events
+        with patch.object(messagebus.Amqp, 'producer_connection', conn):
+            amqp.send_batch([{'cid': 1}, {'cid': 2}], 'cset', 2, 'new_cset.osmtracker')
+        channel.confirm_select.assert_called_once_with()
+        self.assertEqual(len(published), 2)
+        # Confirmations awaited once for the batch
+        self.assertEqual(conn.drain_events.call_count, 1)
+        self.assertTrue(channel.close.called)
+
+    @patch('messagebus.kombu.Producer')
+    def test_send_batch_nacked(self, Producer):
+        amqp = messagebus.Amqp('memory://', 'osmtracker', 'topic', osmtracker.AMQP_QUEUES)
+        channel, published, drain_events = self.confirming_channel(nack=(2,))
+        Producer.return_value.publish.side_effect = lambda msg, **kwargs: published.append(msg)
+        conn = mock.Mock(recoverable_connection_errors=())
+        conn.channel.return_value = channel
+        conn.drain_events.side_effect = drain_events
+        with patch.object(messagebus.Amqp, 'producer_connection', conn):
+            self.assertRaises(messagebus.PublishError, amqp.send_batch,
+                              [{'cid': 1}, {'cid': 2}], 'cset', 2, 'new_cset.osmtracker')
+
+    def test_points_bbox_message(self):
+        pindex = mock.Mock()
+        pindex.get.side_effect = lambda cid: {10: osmdiff.poly.BBox(10.0, 55.0)}.get(cid, None)
+        now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        source = {'type': 'changesets', 'sequenceno': 1234, 'observed': now}
+        msg = osmtracker.diff_fetch_message({'cid': 10, 'bbox': osmdiff.poly.BBox(), 'source': source}, pindex)
+        self.assertEqual(msg['points_bbox'], {'lat_min': 55.0, 'lat_max': 55.0, 'lon_min': 10.0, 'lon_max': 10.0})
+        msg = osmtracker.diff_fetch_message({'cid': 11, 'bbox': osmdiff.poly.BBox(), 'source': source}, pindex)
+        self.assertFalse('points_bbox' in msg)
+
+class TestRegionPrefilter(BaseTest):
+
+    def cset(self, cid, *bbox):
+        now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        return {'cid': cid, 'bbox': osmdiff.poly.BBox(*bbox),
+                'source': {'type': 'changesets', 'sequenceno': 1234, 'observed': now}}
+
+    @patch('osm.poly.Poly')
+    def test_prefilter(self, Poly):
+        Poly.return_value.contains_bbox.side_effect = lambda bbox: bbox['lon_min'] < 11.0
+        prefilter = osmtracker.region_prefilter_build(self.cfg)
+        Poly.assert_has_calls([call().load('region.poly')])
+        self.assertEqual(len(prefilter), 1)
+        inside = self.cset(1, 10.0, 54.0, 10.1, 54.1)
+        outside = self.cset(2, 12.0, 54.0, 12.1, 54.1)
+        nobbox = self.cset(3)
+        self.assertTrue(osmtracker.region_prefilter_pass(prefilter, inside))
+        self.assertFalse(osmtracker.region_prefilter_pass(prefilter, outside))
+        self.assertTrue(outside['prefiltered'])
+        self.assertTrue(osmtracker.region_prefilter_pass(prefilter, nobbox))
+        osmtracker.diff_fetch_publish(self.amqp, [inside, outside, nobbox], prefilter=prefilter)
+        msgs = self.amqp.send_batch.call_args[0][0]
+        self.assertEqual([m['cid'] for m in msgs], [1, 3])
+
+    @patch('osm.poly.Poly')
+    def test_prefilter_disabled_without_area_labels(self, Poly):
+        self.cfg.cfg['tracker']['prefilter_labels'] = [["inside-area"], ["adjustments"]]
+        self.assertEqual(osmtracker.region_prefilter_build(self.cfg), None)
+        self.cfg.cfg['tracker']['pre_labels'].append({"regex": [{".meta.tag.comment": "#denmark"}], "label": "inside-area"})
+        self.cfg.cfg['tracker']['prefilter_labels'] = [["inside-area"]]
+        self.assertEqual(osmtracker.region_prefilter_build(self.cfg), None)
+
+    @patch('osm.poly.Poly')
+    def test_prefilter_shipped_config(self, Poly):
+        cfg = config.Config()
+        cfg.load(cwd+'../config.json')
+        prefilter = osmtracker.region_prefilter_build(cfg)
+        Poly.assert_has_calls([call().load('/osm-regions/denmark.poly')])
+        self.assertEqual(len(prefilter), 1)
+
+class TestCatchup(BaseTest):
+
+    def setUp(self):
+        super(TestCatchup, self).setUp()
+        self.fail_seqno = None
+        self.dapi = mock.MagicMock()
+        self.dapi.get_cset_diff.side_effect = self.get_cset_diff
+        self.dapi.get_state.side_effect = self.get_state
+        self.published = []
+        self.amqp.send_batch.side_effect = lambda msgs, **kwargs: self.published.extend([m['cid'] for m in msgs])
+
+    def get_cset_diff(self, seqno):
+        # Later seqnos complete first
+        eventlet.sleep(0.01*(20-seqno%10))
+        if seqno == self.fail_seqno:
+            raise osmdiff.OsmDiffException('Failed fetching {}'.format(seqno))
+        now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        cset = {'cid': seqno*10, 'bbox': osmdiff.poly.BBox(),
+                'source': {'type': 'changesets', 'sequenceno': seqno, 'observed': now}}
+        return {cset['cid']: cset}
+
+    def get_state(self, stype, seqno=None):
+        st = osmdiff.State(stype, autoload=False, seqno=seqno)
+        st.state['timestamp_dt'] = datetime.datetime(2018, 11, 25, 10, 0, 0).replace(tzinfo=pytz.utc)
+        return st
+
+    def commit(self, seqno, state, chgsets):
+        self.assertEqual(seqno, self.db.pointer['seqno'])
+        self.db.pointer_advance()
+
+    def test_catchup_in_order(self):
+        ptr = self.db.pointer['seqno']
+        head = self.get_state('changesets', seqno=ptr+10)
+        last = osmtracker.diff_fetch_catchup(self.args, self.cfg, self.dapi, self.db, self.amqp,
+                                             ptr, head, 4, self.commit)
+        self.assertEqual(last, ptr+3)
+        self.assertEqual(self.db.pointer['seqno'], ptr+4)
+        self.assertEqual(self.published, [s*10 for s in range(ptr, ptr+4)])
+
+    def test_catchup_contiguous_on_error(self):
+        ptr = self.db.pointer['seqno']
+        head = self.get_state('changesets', seqno=ptr+10)
+        self.fail_seqno = ptr+2
+        self.assertRaises(osmdiff.OsmDiffException, osmtracker.diff_fetch_catchup, self.args,
+                          self.cfg, self.dapi, self.db, self.amqp, ptr, head, 4, self.commit)
+        self.assertEqual(self.db.pointer['seqno'], ptr+2)
+        self.assertEqual(self.published, [ptr*10, (ptr+1)*10])
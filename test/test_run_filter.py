@@ -360,5 +360,91 @@ class TestCsetFilter(BaseTest):
 #         osmtracker.csets_filter(None, self.cfg, self.db, None)
 #         self.assertEqual(self.db.csets[0]['state'], db.DataBase.STATE_BOUNDS_CHECKED)
 
+class TestCsetFilterBatch(BaseTest):
+
+    @patch('osm.poly.Poly')
+    @patch('osm.changeset.OsmApi')
+    def test_cset_filter_batch(self, OsmApi, Poly):
+        '''Changesets filtered concurrently with meta from one bulk request'''
+        OsmApi.return_value = self.osmapi
+        Poly.return_value.contains_bbox.return_value = True
+        self.osmapi.ChangesetGet = mock.Mock(side_effect=self.osmapi.ChangesetGet)
+        self.osmapi.ChangesetsGetByIds = mock.Mock(side_effect=self.osmapi.ChangesetsGetByIds)
+        payloads = [{'cid': cid, 'bbox': self.bbox, 'source': {'type': 'minute', 'sequenceno': 20000, 'observed': '2018-01-07T19:37:00'}}
+                    for cid in [10, 12, 11]]
+        pool = osmtracker.eventlet.GreenPool(4)
+        results = osmtracker.csets_filter_batch(self.cfg, self.db, payloads, pool)
+        self.assertEqual(results, [True, False, True])
+        self.osmapi.ChangesetsGetByIds.assert_called_once_with([10, 12, 11])
+        self.assertFalse(self.osmapi.ChangesetGet.called)
+        self.assertEqual(sorted([c['cid'] for c in self.db.csets]), [10, 11])
+        self.assertEqual(self.db.csets[0]['labels'], ['inside-area', 'adjustments'])
+
+class TestFilterDecisions(BaseTest):
+
+    @patch('osm.poly.Poly')
+    @patch('osm.changeset.OsmApi')
+    def test_admitted_refreshed(self, OsmApi, Poly):
+        '''Changeset seen again is refreshed without being reset to state NEW'''
+        OsmApi.return_value = self.osmapi
+        Poly.return_value.contains_bbox.return_value = True
+        new_cset = {'cid': 10, 'bbox': self.bbox, 'source': {'type': 'minute', 'sequenceno': 20000, 'observed': '2018-01-07T19:37:00'}}
+        self.assertTrue(osmtracker.cset_filter(self.cfg, self.db, new_cset, decision_ttl=60))
+        self.assertTrue(self.db.decisions[10]['passed'])
+        self.db.csets[0]['state'] = self.db.STATE_OPEN
+        new_cset['source']['sequenceno'] = 20001
+        with patch('osmtracker.osm.changeset.Changeset') as Cset:
+            self.assertEqual(osmtracker.cset_filter(self.cfg, self.db, new_cset, decision_ttl=60),
+                             osmtracker.FILTER_REFRESHED)
+            self.assertFalse(Cset.called)
+        self.assertEqual(len(self.db.csets), 1)
+        self.assertEqual(self.db.csets[0]['state'], self.db.STATE_OPEN)
+        self.assertEqual(self.db.csets[0]['source']['sequenceno'], 20001)
+
+    @patch('osm.poly.Poly')
+    @patch('osm.changeset.OsmApi')
+    def test_rejected_dropped(self, OsmApi, Poly):
+        '''Rejected changeset is dropped without filtering unless its bbox grows'''
+        OsmApi.return_value = self.osmapi
+        Poly.return_value.contains_bbox.return_value = False
+        bbox = {'lon_min':10.0, 'lat_min':54.0, 'lon_max':10.1, 'lat_max': 54.1}
+        new_cset = {'cid': 10, 'bbox': bbox, 'source': {'type': 'minute', 'sequenceno': 20000, 'observed': '2018-01-07T19:37:00'}}
+        self.assertFalse(osmtracker.cset_filter(self.cfg, self.db, new_cset, decision_ttl=60))
+        self.assertFalse(self.db.decisions[10]['passed'])
+        with patch('osmtracker.osm.changeset.Changeset') as Cset:
+            self.assertFalse(osmtracker.cset_filter(self.cfg, self.db, new_cset, decision_ttl=60))
+            self.assertFalse(Cset.called)
+        Poly.return_value.contains_bbox.return_value = True
+        new_cset['bbox'] = dict(bbox, lon_max=11.0)
+        self.assertTrue(osmtracker.cset_filter(self.cfg, self.db, new_cset, decision_ttl=60))
+        self.assertTrue(self.db.decisions[10]['passed'])
+
+    def test_bbox_within(self):
+        outer = {'lon_min':10.0, 'lat_min':54.0, 'lon_max':11.0, 'lat_max': 55.0}
+        self.assertTrue(osmtracker.bbox_within(dict(outer, lon_min=10.5), outer))
+        self.assertFalse(osmtracker.bbox_within(dict(outer, lat_max=55.5), outer))
+        self.assertFalse(osmtracker.bbox_within(outer, None))
+        self.assertTrue(osmtracker.bbox_within(None, None))
+
+class TestFilterReplay(BaseTest):
+
+    @patch('osm.poly.Poly')
+    @patch('osm.changeset.OsmApi')
+    def test_replay(self, OsmApi, Poly):
+        '''Replay of recorded changesets against recorded API responses'''
+        Poly.return_value.contains_bbox.return_value = True
+        self.args.replay = cwd+'../osm/test/data'
+        self.args.concurrency = 2
+        self.args.decision_ttl = 0
+        memdb = db.MemoryDataBase()
+        res = osmtracker.csets_filter_replay(self.args, self.cfg, memdb)
+        self.assertEqual(res['csets'], 3)
+        self.assertEqual(res['passed'], 2)
+        self.assertEqual(sorted(memdb.csets.keys()), [10, 11])
+        self.assertEqual(memdb.csets[10]['state'], memdb.STATE_BOUNDS_CHECKED)
+        self.assertEqual(res['api_calls']['ChangesetsGetByIds'], 2)
+        self.assertFalse(OsmApi.called)
+        self.assertEqual(sorted([label for _, label in res['timings']]), ['adjustments', 'inside-area'])
+
 if __name__ == '__main__':
     unittest.main()
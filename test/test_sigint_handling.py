@@ -23,10 +23,11 @@ class BaseTest(unittest.TestCase, stubs.FileWriter_Mixin):
         self.osmapi = osm.test.stubs.testOsmApi(datapath=cwd+'../osm/test/data')
         self.requests = osm.test.stubs.testRequests(datapath=cwd+'../osm/test/data',
                                                     sigint_on=[])
+        self.bbox = {'lat_min': 54.0, 'lat_max': 54.1, 'lon_min': 10.0, 'lon_max': 10.1}
 
 class TestSigInt(BaseTest):
 
-    @patch('osm.diff.requests.get')
+    @patch('osm.diff.requests.Session.get')
     def test_diff_fetch(self, UrlGet):
         UrlGet.side_effect = self.requests.get
 
@@ -52,7 +53,7 @@ class TestSigInt(BaseTest):
         self.db.test_add_cid(10, state=self.db.STATE_NEW, append=False)
 
         self.osmapi.sigint_on = ['ChangesetGet']
-        self.assertRaises(KeyboardInterrupt, osmtracker.cset_filter, self.cfg, self.db, {'cid': 10, 'source': {'sequenceno': 20000}})
+        self.assertRaises(KeyboardInterrupt, osmtracker.cset_filter, self.cfg, self.db, {'cid': 10, 'bbox': self.bbox, 'source': {'sequenceno': 20000}})
         self.assertEqual(self.db.csets[0]['state'], self.db.STATE_NEW)
 
     @patch('osm.diff.requests.get')
@@ -78,7 +79,7 @@ class TestSigInt(BaseTest):
 
         self.db.sigint_on = ['chgset_get_meta']
         self.osmapi.sigint_on = ['ChangesetGet']
-        self.assertRaises(KeyboardInterrupt, osmtracker.cset_filter, self.cfg, self.db, {'cid': 10, 'source': {'sequenceno': 20000}})
+        self.assertRaises(KeyboardInterrupt, osmtracker.cset_filter, self.cfg, self.db, {'cid': 10, 'bbox': self.bbox, 'source': {'sequenceno': 20000}})
         self.assertEqual(self.db.csets[0]['state'], self.db.STATE_NEW)
 
 if __name__ == '__main__':